@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+"""
+asyncio engine of the onion node (see OnionNode, engine=ASYNCIO_ENGINE).
+
+The node accepts its connections, reads and routes their cells, relays
+them and makes the GET requests of its exit circuits as coroutines on a
+single event loop, instead of using a thread per link and per request.
+It uses the same tables, links (one per neighbour) and protocol as the
+thread engine: the packets are processed by NodeSwitchboard's methods, and
+only the I/O is done differently.
+
+Handshakes are done in the node's handshake executor, whose answers are
+handed back to the event loop; without an executor (handshake_workers=0)
+they are done on the event loop.
+"""
+import asyncio
+
+import flow_control as fc
+import get_request as gr
+import packet_manager as pm
+from links import CONNECT_TIMEOUT, LinkManager, configure_socket
+from node_switchboard import NodeSwitchboard, AnswerFragments
+
+# largest number of pending connections of the node
+BACKLOG = 1024
+
+
+class AsyncLink():
+    """
+    A link (see links.Link) on the event loop.
+    Packets are written without waiting; the writer waits for them to be
+    sent (drain) before reading more cells, so that a slow neighbour
+    slows down the links that send to it instead of filling the memory.
+    Packets sent before the connection is open are kept until it is.
+    """
+
+    def __init__(self, address, outbound):
+        self.address = address
+        self.outbound = outbound
+        self.closed = False
+        self._reader = None
+        self._writer = None
+        self._waiting = []
+
+    def connection_made(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            configure_socket(sock)
+        self._reader = reader
+        self._writer = writer
+        for packet in self._waiting:
+            writer.write(packet)
+        self._waiting = []
+
+    def send(self, packet):
+        """ sends the cells of a packet; raises OSError if the link is closed """
+        if self.closed:
+            raise ConnectionError("link to {}:{} is closed".format(*self.address[:2]))
+        if self._writer is None:
+            self._waiting.append(packet)
+        else:
+            self._writer.write(packet)
+
+    async def drain(self):
+        """ waits until the packets sent on the link are mostly sent """
+        if self._writer is not None and not self.closed:
+            try:
+                await self._writer.drain()
+            except OSError:
+                self.closed = True
+
+    async def read_cell(self):
+        """
+        returns the next cell received on the link (see pm.recv_cell), or
+        None once the link is closed
+        """
+        try:
+            return await self._reader.readexactly(pm.CELL_SIZE)
+        except (asyncio.IncompleteReadError, OSError):
+            return None
+
+    def close(self):
+        self.closed = True
+        if self._writer is not None:
+            self._writer.close()
+
+
+class AsyncLinkManager(LinkManager):
+    """
+    The links of a node on the event loop (see links.LinkManager).
+    get_link returns the link to a neighbour right away; the connection is
+    opened in the background, and the packets sent meanwhile are kept.
+    """
+
+    def __init__(self, start_reader, connect_timeout=CONNECT_TIMEOUT):
+        super().__init__(start_reader, connect_timeout)
+        self._tasks = set()
+
+    def spawn(self, coroutine):
+        """ runs a coroutine on the event loop, and keeps it until it is done """
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def get_link(self, ip, port):
+        address = (ip, int(port))
+        with self._lock:
+            link = self._outbound.get(address)
+            if link is None or link.closed:
+                link = AsyncLink(address, outbound=True)
+                self._outbound[address] = link
+                self.spawn(self._connect(link))
+        return link
+
+    async def _connect(self, link):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(*link.address), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError):
+            print("ERROR    Could not connect to {}:{}\n".format(*link.address))
+            self.link_closed(link)
+            return
+        link.connection_made(reader, writer)
+        self.start_reader(link)
+
+    def accept(self, reader, writer):
+        """ adds an inbound link for a connection accepted by the node (asyncio.start_server callback) """
+        link = AsyncLink(writer.get_extra_info('peername'), outbound=False)
+        link.connection_made(reader, writer)
+        with self._lock:
+            self._inbound.add(link)
+        self.start_reader(link)
+        return link
+
+
+class AsyncNodeSwitchboard(NodeSwitchboard):
+    """
+    NodeSwitchboard of a link on the event loop: the packets are processed
+    by the same methods, the waits are coroutines.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = asyncio.get_running_loop()
+        # links written to while processing a packet; drained before the next one
+        self._written = set()
+
+    async def serve(self):
+        """ reads and processes the cells of the link until it is closed """
+        try:
+            while True:
+                cell = await self.link.read_cell()
+                if cell is None or not self._dispatch(cell):
+                    break
+                await self._drain()
+        finally:
+            self.link_manager.link_closed(self.link)
+
+    async def _drain(self):
+        written, self._written = self._written, set()
+        for link in written:
+            await link.drain()
+
+    def _send_back(self, circID, packet):
+        super()._send_back(circID, packet)
+        self._written.add(self.link_manager.get_circuit_link(circID))
+
+    def _relay(self, packet, ip, port):
+        link = self.link_manager.get_link(ip, port)
+        link.send(packet)
+        self._written.add(link)
+
+    def _handshake_done(self, message, future):
+        # called in a thread of the handshake executor: finish on the event loop
+        try:
+            self.loop.call_soon_threadsafe(super()._handshake_done, message, future)
+        except RuntimeError:
+            # the node was stopped meanwhile
+            pass
+
+    def _start_answer(self, circID, cipher, url, stream=0):
+        self.link_manager.spawn(self._send_answer_async(circID, cipher, url, stream))
+
+    async def _send_answer_async(self, circID, cipher, url, stream=0):
+        """ _send_answer, with the GET request made on the event loop """
+        windows = (self.node_key_table.get_stream_window(circID, stream),
+                   self.node_key_table.get_send_window(circID))
+        headers, chunks = await gr.web_request_stream_async(url, pm.FRAGMENT_DATA_SIZE)
+        answer = AnswerFragments(self.node_key_table.get_compression(circID),
+                                 headers.get('Content-Encoding'), stream)
+        try:
+            async for fragment in answer.fragments_async(chunks):
+                await self._send_answer_fragment(circID, cipher, windows, fragment)
+        except TimeoutError:
+            print("ERROR    The client stopped acknowledging the answer; answer dropped\n")
+            return
+        except OSError:
+            print("ERROR    Connection closed by the previous node; answer dropped\n")
+            return
+        finally:
+            self.node_key_table.remove_stream(circID, stream)
+        answer.print_summary(url)
+
+    async def _send_answer_fragment(self, circID, cipher, windows, fragment):
+        if not await fc.consume_all_async(windows, pm.cell_count(len(fragment))):
+            raise TimeoutError("window of circuit {} stayed closed".format(circID))
+        self._send_fragment(circID, cipher, fragment)
+        await self._drain()
+
+
+async def serve(node, poll_interval=1):
+    """
+    runs an initialized OnionNode on the event loop, until node.running is False
+    """
+    def start_switchboard(link):
+        switchboard = AsyncNodeSwitchboard(link, node.link_manager,
+                                           node.circuit_table,
+                                           node.node_key_table,
+                                           node.node_relay_table,
+                                           node.rsa_keys, node.ip, node.port,
+                                           node.ntor_keys,
+                                           node.handshake_executor,
+                                           node.circuit_ids)
+        node.link_manager.spawn(switchboard.serve())
+
+    node.link_manager = AsyncLinkManager(start_switchboard)
+    server = await asyncio.start_server(node.link_manager.accept, node.ip, node.port,
+                                        backlog=BACKLOG, reuse_port=node.reuse_port)
+    async with server:
+        while node.running:
+            await asyncio.sleep(poll_interval)
+    node.link_manager.close()
@@ -0,0 +1,375 @@
+#!/usr/bin/python3
+"""
+    Benchmarks for the cryptography of the onion network.
+
+    Every benchmark reports operations per second, and bytes per second when
+    it works on a payload. Results can be saved as a JSON baseline, and
+    compared with a baseline to flag the operations that got slower.
+
+    Use:
+        > python benchmark_crypto.py [-k 512 1024 2048] [-r 5] [-n 200]
+        > python benchmark_crypto.py -s layers -p 1024 1048576 -l 1 3 8
+        > python benchmark_crypto.py --save baseline.json
+        > python benchmark_crypto.py --compare baseline.json [-t 0.1]
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+
+import diffie_hellman as dh
+import encryption as enc
+import onion_client as oc
+import packet_manager as pm
+
+DEFAULT_KEY_SIZES = [512, 1024, 2048]
+DEFAULT_REPEAT = 5
+DEFAULT_HANDSHAKES = 200
+DEFAULT_PAYLOAD_SIZES = [1024, 16 * 1024, 128 * 1024, 1024 * 1024]
+DEFAULT_LAYER_COUNTS = [1, 2, 4, 8]
+DEFAULT_MODES = [enc.FERNET_MODE, enc.STREAM_MODE]
+DEFAULT_DH_GROUPS = [2048, 3072, 4096]
+DEFAULT_MIN_TIME = 0.2  # seconds spent on each measurement
+DEFAULT_THRESHOLD = 0.1  # a result is a regression if it is this much slower than the baseline
+
+SUITES = ["keygen", "handshake", "primes", "rsa", "fernet", "layers", "dh"]
+
+
+def time_function(function, repeat, *args):
+    """ runs function(*args) repeat times; returns the list of durations, in seconds """
+    durations = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function(*args)
+        durations.append(time.perf_counter() - start_time)
+    return durations
+
+
+def measure_rate(function, prepare=None, min_time=DEFAULT_MIN_TIME):
+    """
+    calls function until min_time seconds were spent in it; returns the calls per second.
+    prepare: if given, called (untimed) before each call; function gets its result.
+    """
+    calls = 0
+    elapsed = 0.0
+    while elapsed < min_time:
+        arg = prepare() if prepare is not None else None
+        start_time = time.perf_counter()
+        if prepare is not None:
+            function(arg)
+        else:
+            function()
+        elapsed += time.perf_counter() - start_time
+        calls += 1
+    return calls / elapsed
+
+
+def result(ops_per_s, payload_size=None):
+    """ one benchmark result, as stored in a baseline """
+    return {
+        'ops_per_s': ops_per_s,
+        'bytes_per_s': ops_per_s * payload_size if payload_size is not None else None
+    }
+
+
+def benchmark_keygen(key_sizes=DEFAULT_KEY_SIZES, repeat=DEFAULT_REPEAT):
+    """ time of get_private_key_rsa for each key size; returns {key_size: [durations]} """
+    results = {}
+    for key_size in key_sizes:
+        results[key_size] = time_function(enc.get_private_key_rsa, repeat, key_size)
+    return results
+
+
+def print_keygen_results(results):
+    print("{:>10} {:>12} {:>12} {:>12}".format("key size", "mean (ms)", "min (ms)", "max (ms)"))
+    for key_size, durations in results.items():
+        print("{:>10} {:>12.2f} {:>12.2f} {:>12.2f}".format(
+            key_size,
+            statistics.mean(durations) * 1000,
+            min(durations) * 1000,
+            max(durations) * 1000))
+
+
+def handshake_plain(ciphertext, rsa_keys):
+    """ node side of a "create" before the CRT parameters were kept """
+    shared_key = enc.decrypt_RSA(ciphertext, rsa_keys["private"], rsa_keys["modulus"])
+    return enc.new_cipher(shared_key)
+
+
+def handshake_crt(ciphertext, rsa_keys):
+    """ node side of a "create", as done in NodeSwitchboard._process_control """
+    shared_key = enc.decrypt_RSA_keys(ciphertext, rsa_keys)
+    return enc.new_cipher(shared_key)
+
+
+def benchmark_handshake(key_sizes=DEFAULT_KEY_SIZES, handshakes=DEFAULT_HANDSHAKES):
+    """
+    handshakes per second handled by a node, without and with CRT decryption
+    returns {key_size: (plain handshakes/s, CRT handshakes/s)}
+    """
+    results = {}
+    for key_size in key_sizes:
+        rsa_keys = enc.get_private_key_rsa(key_size)
+        ciphertexts = [enc.encrypt_RSA(enc.generate_fernet_key(), rsa_keys["public"], rsa_keys["modulus"])
+                       for _ in range(handshakes)]
+        rates = []
+        for handshake in (handshake_plain, handshake_crt):
+            start_time = time.perf_counter()
+            for ciphertext in ciphertexts:
+                handshake(ciphertext, rsa_keys)
+            rates.append(handshakes / (time.perf_counter() - start_time))
+        results[key_size] = tuple(rates)
+    return results
+
+
+def print_handshake_results(results):
+    print("{:>10} {:>14} {:>14} {:>10}".format("key size", "plain (hs/s)", "CRT (hs/s)", "speedup"))
+    for key_size, (plain, crt) in results.items():
+        print("{:>10} {:>14.1f} {:>14.1f} {:>9.2f}x".format(key_size, plain, crt, crt / plain))
+
+
+def benchmark_primes(key_sizes=DEFAULT_KEY_SIZES, min_time=DEFAULT_MIN_TIME):
+    """ checkIfPrime on the primes of an RSA key (key_size / 2 bits), the slowest case """
+    results = {}
+    for key_size in key_sizes:
+        prime = enc.getLargePrime(key_size // 2)
+        results["checkIfPrime bits={}".format(key_size // 2)] = result(
+            measure_rate(lambda: enc.checkIfPrime(prime), min_time=min_time))
+    return results
+
+
+def benchmark_rsa(key_sizes=DEFAULT_KEY_SIZES, min_time=DEFAULT_MIN_TIME):
+    """ encrypt_RSA, decrypt_RSA and decrypt_RSA_keys (CRT) of a shared key """
+    results = {}
+    for key_size in key_sizes:
+        rsa_keys = enc.get_private_key_rsa(key_size)
+        key = enc.generate_fernet_key()
+        ciphertext = enc.encrypt_RSA(key, rsa_keys["public"], rsa_keys["modulus"])
+        results["encrypt_RSA key_size={}".format(key_size)] = result(measure_rate(
+            lambda: enc.encrypt_RSA(key, rsa_keys["public"], rsa_keys["modulus"]), min_time=min_time))
+        results["decrypt_RSA key_size={}".format(key_size)] = result(measure_rate(
+            lambda: enc.decrypt_RSA(ciphertext, rsa_keys["private"], rsa_keys["modulus"]), min_time=min_time))
+        results["decrypt_RSA_keys key_size={}".format(key_size)] = result(measure_rate(
+            lambda: enc.decrypt_RSA_keys(ciphertext, rsa_keys), min_time=min_time))
+    return results
+
+
+def benchmark_fernet(payload_sizes=DEFAULT_PAYLOAD_SIZES, min_time=DEFAULT_MIN_TIME):
+    """ encrypt_fernet and decrypt_fernet of one string payload """
+    results = {}
+    key = enc.generate_fernet_key()
+    for payload_size in payload_sizes:
+        message = "x" * payload_size
+        token = enc.encrypt_fernet(message, key)
+        results["encrypt_fernet payload={}".format(payload_size)] = result(
+            measure_rate(lambda: enc.encrypt_fernet(message, key), min_time=min_time), payload_size)
+        results["decrypt_fernet payload={}".format(payload_size)] = result(
+            measure_rate(lambda: enc.decrypt_fernet(token, key), min_time=min_time), payload_size)
+    return results
+
+
+def _new_circuit_client(layer_count, mode):
+    """
+    an OnionClient with the keys of a circuit of layer_count nodes, without a
+    network; returns (client, node side ciphers from the entry node to the exit)
+    """
+    client = oc.OnionClient("127.0.0.1", 0, layer_count, mode)
+    client.circuit_id = 1
+    node_ciphers = []
+    for layer in range(layer_count):
+        key = enc.generate_fernet_key()
+        client.sender_key_table.add_key_entry(client.circuit_id, layer, key, mode)
+        node_ciphers.append(enc.new_cipher(key, mode))
+    return client, node_ciphers
+
+
+def _answer_through_circuit(payload, node_ciphers):
+    """ the cells the client receives when the exit node answers payload """
+    cells = pm.new_sealed_packet(1, "relay_ans", enc.serialize_payload(payload), node_ciphers[-1:])
+    for cipher in reversed(node_ciphers[:-1]):
+        cells = _add_layer(cells, cipher)
+    return cells
+
+
+def _add_layer(cells, cipher):
+    """ the layer a node adds to the cells of an answer (see NodeSwitchboard._relay_backward) """
+    if cipher.cell_layers:
+        return b''.join(
+            pm.new_cell(1, "relay_ans", pm.parse_cell_header(cells[offset:])[2],
+                        enc.encrypt_layer(pm.sealed_body(cells[offset:offset + pm.CELL_SIZE]), cipher))
+            for offset in range(0, len(cells), pm.CELL_SIZE))
+    packets = pm.PacketAssembler()
+    for offset in range(0, len(cells), pm.CELL_SIZE):
+        cell = cells[offset:offset + pm.CELL_SIZE]
+        circID, command, length = pm.parse_cell_header(cell)
+        body = packets.add(circID, command, length, pm.cell_body(cell))
+    return pm.new_relay_packet(1, "relay_ans", enc.encrypt_layer(body, cipher))
+
+
+def benchmark_layers(payload_sizes=DEFAULT_PAYLOAD_SIZES, layer_counts=DEFAULT_LAYER_COUNTS,
+                     modes=DEFAULT_MODES, min_time=DEFAULT_MIN_TIME):
+    """
+    OnionClient.successive_encrypt and successive_decrypt: the client side of
+    a request through a circuit, and of its answer
+    """
+    results = {}
+    for mode in modes:
+        for layer_count in layer_counts:
+            for payload_size in payload_sizes:
+                client, node_ciphers = _new_circuit_client(layer_count, mode)
+                payload = pm.new_payload(0, 0, "x" * payload_size)
+                name = "mode={} layers={} payload={}".format(mode, layer_count, payload_size)
+
+                results["successive_encrypt " + name] = result(measure_rate(
+                    lambda: client.successive_encrypt(payload, layer_count), min_time=min_time), payload_size)
+                # the answers are made in order, to keep the relay crypto state in step
+                results["successive_decrypt " + name] = result(measure_rate(
+                    client.successive_decrypt,
+                    prepare=lambda: _answer_through_circuit(payload, node_ciphers),
+                    min_time=min_time), payload_size)
+    return results
+
+
+def benchmark_dh(groups=DEFAULT_DH_GROUPS, min_time=DEFAULT_MIN_TIME):
+    """ diffie_hellman public key (fixed-base table) and shared secret, for each group """
+    results = {}
+    for group in groups:
+        dh.get_table(group)  # the table is built once, outside of the measurement
+        private_key = dh.generate_private_key(group)
+        other_public_key = dh.compute_public_key(dh.generate_private_key(group), group)
+        results["dh.compute_public_key group={}".format(group)] = result(measure_rate(
+            lambda: dh.compute_public_key(private_key, group), min_time=min_time))
+        results["dh.compute_shared_secret group={}".format(group)] = result(measure_rate(
+            lambda: dh.compute_shared_secret(private_key, other_public_key, group), min_time=min_time))
+    return results
+
+
+def print_results(results):
+    print("{:<60} {:>14} {:>14}".format("benchmark", "ops/s", "MB/s"))
+    for name, values in results.items():
+        bytes_per_s = values['bytes_per_s']
+        print("{:<60} {:>14.1f} {:>14}".format(
+            name,
+            values['ops_per_s'],
+            "{:.2f}".format(bytes_per_s / 1e6) if bytes_per_s is not None else "-"))
+
+
+def save_baseline(results, filename):
+    """ writes the results to a JSON baseline, with a description of the machine """
+    baseline = {
+        'created': time.time(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'results': results
+    }
+    with open(filename, 'w') as f:
+        json.dump(baseline, f, indent=4)
+
+
+def load_baseline(filename):
+    with open(filename) as f:
+        return json.load(f)['results']
+
+
+def find_regressions(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    compares results with a baseline
+    returns {name: (baseline ops/s, current ops/s)} for the benchmarks that are
+    more than threshold (a fraction) slower than in the baseline
+    """
+    regressions = {}
+    for name, values in results.items():
+        if name not in baseline:
+            continue
+        baseline_rate = baseline[name]['ops_per_s']
+        if values['ops_per_s'] < baseline_rate * (1 - threshold):
+            regressions[name] = (baseline_rate, values['ops_per_s'])
+    return regressions
+
+
+def print_regressions(regressions, threshold):
+    if not regressions:
+        print("No regression above {:.0%}".format(threshold))
+        return
+    print("REGRESSIONS above {:.0%}:".format(threshold))
+    print("{:<60} {:>14} {:>14} {:>8}".format("benchmark", "baseline ops/s", "ops/s", "change"))
+    for name, (baseline_rate, rate) in regressions.items():
+        print("{:<60} {:>14.1f} {:>14.1f} {:>7.1%}".format(name, baseline_rate, rate, rate / baseline_rate - 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cryptography used by the onion network.')
+    parser.add_argument('-k', '--key-sizes', type=int, nargs='+', dest='key_sizes', default=DEFAULT_KEY_SIZES,
+                        help='RSA modulus sizes, in bits.')
+    parser.add_argument('-r', '--repeat', type=int, dest='repeat', default=DEFAULT_REPEAT,
+                        help='Number of keys generated for each key size.')
+    parser.add_argument('-n', '--handshakes', type=int, dest='handshakes', default=DEFAULT_HANDSHAKES,
+                        help='Number of "create" handshakes timed for each key size.')
+    parser.add_argument('-s', '--suites', nargs='+', dest='suites', default=SUITES, choices=SUITES,
+                        help='Benchmarks to run.')
+    parser.add_argument('-p', '--payload-sizes', type=int, nargs='+', dest='payload_sizes',
+                        default=DEFAULT_PAYLOAD_SIZES, help='Payload sizes, in bytes.')
+    parser.add_argument('-l', '--layers', type=int, nargs='+', dest='layer_counts', default=DEFAULT_LAYER_COUNTS,
+                        help='Numbers of encryption layers (nodes in the circuit).')
+    parser.add_argument('-m', '--modes', nargs='+', dest='modes', default=DEFAULT_MODES, choices=DEFAULT_MODES,
+                        help='Relay crypto modes.')
+    parser.add_argument('-g', '--groups', type=int, nargs='+', dest='groups', default=DEFAULT_DH_GROUPS,
+                        choices=sorted(dh.GROUPS), help='Diffie-Hellman group sizes, in bits.')
+    parser.add_argument('--min-time', type=float, dest='min_time', default=DEFAULT_MIN_TIME,
+                        help='Seconds spent on each measurement.')
+    parser.add_argument('--save', dest='save', help='Save the results as a JSON baseline in this file.')
+    parser.add_argument('--compare', dest='compare', help='Compare the results with this JSON baseline.')
+    parser.add_argument('-t', '--threshold', type=float, dest='threshold', default=DEFAULT_THRESHOLD,
+                        help='Slowdown (as a fraction) above which a result is a regression.')
+    args = parser.parse_args()
+
+    results = {}
+    if "keygen" in args.suites:
+        print("RSA key generation (get_private_key_rsa)")
+        keygen_results = benchmark_keygen(args.key_sizes, args.repeat)
+        print_keygen_results(keygen_results)
+        print()
+        for key_size, durations in keygen_results.items():
+            results["get_private_key_rsa key_size={}".format(key_size)] = result(1 / statistics.mean(durations))
+
+    if "handshake" in args.suites:
+        print("Node side of the \"create\" handshake (RSA decryption + cipher setup)")
+        handshake_results = benchmark_handshake(args.key_sizes, args.handshakes)
+        print_handshake_results(handshake_results)
+        print()
+        for key_size, (plain, crt) in handshake_results.items():
+            results["handshake_plain key_size={}".format(key_size)] = result(plain)
+            results["handshake_crt key_size={}".format(key_size)] = result(crt)
+
+    suites = {
+        "primes": lambda: benchmark_primes(args.key_sizes, args.min_time),
+        "rsa": lambda: benchmark_rsa(args.key_sizes, args.min_time),
+        "fernet": lambda: benchmark_fernet(args.payload_sizes, args.min_time),
+        "layers": lambda: benchmark_layers(args.payload_sizes, args.layer_counts, args.modes, args.min_time),
+        "dh": lambda: benchmark_dh(args.groups, args.min_time),
+    }
+    other_results = {}
+    for suite in args.suites:
+        if suite in suites:
+            other_results.update(suites[suite]())
+    if other_results:
+        print_results(other_results)
+        print()
+    results.update(other_results)
+
+    if args.save:
+        save_baseline(results, args.save)
+        print("Baseline saved to", args.save)
+
+    if args.compare:
+        regressions = find_regressions(results, load_baseline(args.compare), args.threshold)
+        print_regressions(regressions, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,50 +1,64 @@
+from threading import Lock
+
+import encryption as enc
+import flow_control as fc
+
+
 class circuit_table():
     """
         kv table maintained by sender or node
         contains a list of circuit IDs that have been created, associated with the ip and port to contact
-        format: ip:port | circID
+        format: circID | ip:port
+        several circuits can go through the same ip and port (see links.py)
     """
     def __init__(self):
         self.table = {}
 
     def add_circuit_entry(self, ip, port, circID):
-        index = "{}:{}".format(ip, port)
-        self.table[index] = circID   # packet builder prevents duplicate circIDs from being created
+        self.table[circID] = "{}:{}".format(ip, port)   # packet builder prevents duplicate circIDs from being created
 
     def remove_circuit_entry(self, ip, port):
+        """ removes every circuit going through ip:port """
         index = "{}:{}".format(ip, port)
-        try:
-            del self.table[index]
-        except LookupError:
+        circIDs = [circID for circID, address in self.table.items() if address == index]
+        if not circIDs:
             print("ERROR    No such IP address in the key table; could not remove entry")
             return -1
+        for circID in circIDs:
+            del self.table[circID]
 
-    def get_circID(self, ip, port):
-        index = "{}:{}".format(ip, port)
+    def remove_circuit(self, circID):
         try:
-            return self.table[index]
+            del self.table[circID]
         except LookupError:
-            print("ERROR    No such IP address in the circuit table; could not return circuit ID")
+            print("ERROR    No such circuit ID in the circuit table; could not remove entry")
             return -1
 
+    def get_circID(self, ip, port):
+        index = "{}:{}".format(ip, port)
+        for circID, address in self.table.items():
+            if address == index:
+                return circID
+        print("ERROR    No such IP address in the circuit table; could not return circuit ID")
+        return -1
+
     # needed for nodes that have both incoming and outgoing circIDs; better than maintaining two tables
     def get_address(self, circID):
-        # print(circID)
-        #this is printed when the table is empty, even for first circuit that is built
+        # an empty table is how a sender looks for an unused circID: no error
         if not self.table:
             return -1
-        for k in self.table.keys():
-            if self.table[k] == circID:
-                return k
-        print("ERROR    No such circuit ID in the circuit table; could not return IP address")
-        return -1
+        try:
+            return self.table[circID]
+        except LookupError:
+            print("ERROR    No such circuit ID in the circuit table; could not return IP address")
+            return -1
 
     def get_length(self):
         return len(self.table)
 
     def print_table(self):
-        for k in self.table.keys():
-            print(k.format(": ", self.table[k]))
+        for circID, address in self.table.items():
+            print(address, ": ", circID)
 
 
 class sender_key_table():
@@ -56,23 +70,35 @@ class sender_key_table():
                 10:1 | bob shared key
                 10:2 | carol shared key
 
+        the cipher context of each key is prepared once, when the key is added
+        format: initial_circID:node # | cipher
     """
 
     def __init__(self):
         self.table = {}
+        self.ciphers = {}
 
-    def add_key_entry(self, circID, nodeNo, symmkey):
+    def add_key_entry(self, circID, nodeNo, symmkey, mode=enc.FERNET_MODE):
         index = "{}:{}".format(circID, nodeNo)
         self.table[index] = symmkey
+        self.ciphers[index] = enc.new_cipher(symmkey, mode, origin=True)
 
     def remove_key_entry(self, circID, nodeNo):
         index = "{}:{}".format(circID, nodeNo)
         try:
             del self.table[index]
+            del self.ciphers[index]
         except LookupError:
             print("ERROR    No such node address in the key table; could not remove entry")
             return -1
 
+    def remove_circuit(self, circID):
+        """ evict the keys and ciphers of every node along the circuit """
+        prefix = "{}:".format(circID)
+        for index in [k for k in self.table.keys() if k.startswith(prefix)]:
+            del self.table[index]
+            del self.ciphers[index]
+
     def get_key(self, circID, nodeNo):
         index = "{}:{}".format(circID, nodeNo)
         try:
@@ -81,6 +107,18 @@ class sender_key_table():
             print("ERROR    No such node address in the key table; could not return key")
             return -1
 
+    def get_cipher(self, circID, nodeNo):
+        index = "{}:{}".format(circID, nodeNo)
+        try:
+            return self.ciphers[index]
+        except LookupError:
+            print("ERROR    No such node address in the key table; could not return cipher")
+            return -1
+
+    def get_ciphers(self, circID, node_count):
+        """ ciphers of the first node_count nodes of the circuit, ordered from the entry node """
+        return [self.get_cipher(circID, nodeNo) for nodeNo in range(node_count)]
+
     def print_table(self):
         for k in self.table.keys():
             print(self.table[k])
@@ -91,17 +129,49 @@ class node_key_table():
         kv table maintained by a node
         contains the key to use when a relay packet is received from a circuit ID
         format: received_from_circID | key
+
+        the cipher context is prepared once, when the key is added, and evicted with the circuit
+        format: received_from_circID | cipher
+
+        the compression of the answers negotiated for the circuit (see compression.py)
+        format: received_from_circID | compression
+
+        the window of the answers sent back on the circuit (see flow_control.py)
+        format: received_from_circID | fc.SendWindow
+
+        the window of each stream of the circuit whose answer is being sent
+        format: received_from_circID:stream | fc.SendWindow
+
+        a lock per circuit, held while a packet is sealed, encrypted and sent
+        back, so that the packets of its streams are sent in the order of their layers
+        format: received_from_circID | Lock
     """
 
     def __init__(self):
         self.table = {}
+        self.ciphers = {}
+        self.compressions = {}
+        self.send_windows = {}
+        self.stream_windows = {}
+        self.send_locks = {}
 
-    def add_key_entry(self, fromID, symmkey):
+    def add_key_entry(self, fromID, symmkey, mode=enc.FERNET_MODE, compression=None):
         self.table[fromID] = symmkey
+        self.ciphers[fromID] = enc.new_cipher(symmkey, mode)
+        self.compressions[fromID] = compression
+        self.send_windows[fromID] = fc.SendWindow()
+        self.send_locks[fromID] = Lock()
 
     def remove_key_entry(self, fromID):
         try:
             del self.table[fromID]
+            del self.ciphers[fromID]
+            self.compressions.pop(fromID, None)
+            self.send_windows.pop(fromID, None)
+            self.send_locks.pop(fromID, None)
+            prefix = "{}:".format(fromID)
+            for index in [k for k in list(self.stream_windows) if k.startswith(prefix)]:
+                self.stream_windows.pop(index, None)
         except LookupError:
             print("ERROR    No such IP address in the key table; could not remove entry")
             return -1
@@ -113,6 +183,44 @@ class node_key_table():
             print("ERROR    No such IP address in the key table; could not return key")
             return -1
 
+    def get_cipher(self, fromID):
+        try:
+            return self.ciphers[fromID]
+        except LookupError:
+            print("ERROR    No such IP address in the key table; could not return cipher")
+            return -1
+
+    def get_compression(self, fromID):
+        """ compression of the answers on the circuit, None if they are not compressed """
+        return self.compressions.get(fromID)
+
+    def get_send_window(self, fromID):
+        try:
+            return self.send_windows[fromID]
+        except LookupError:
+            print("ERROR    No such IP address in the key table; could not return window")
+            return -1
+
+    def add_stream(self, fromID, stream):
+        """ opens the window of a stream of the circuit, for the answer to its request """
+        window = fc.SendWindow(fc.STREAM_WINDOW, fc.STREAM_SENDME_INCREMENT)
+        self.stream_windows["{}:{}".format(fromID, stream)] = window
+        return window
+
+    def get_stream_window(self, fromID, stream):
+        """ window of a stream of the circuit, None once its answer was sent """
+        return self.stream_windows.get("{}:{}".format(fromID, stream))
+
+    def remove_stream(self, fromID, stream):
+        self.stream_windows.pop("{}:{}".format(fromID, stream), None)
+
+    def get_send_lock(self, fromID):
+        try:
+            return self.send_locks[fromID]
+        except LookupError:
+            print("ERROR    No such IP address in the key table; could not return lock")
+            return -1
+
     def print_table(self):
         for k in self.table.keys():
             print(k)
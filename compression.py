@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+"""
+Compression of the answers sent back through a circuit.
+
+The client asks for a compression when it builds the circuit (see the
+'compression' field of pm.new_payload); the exit node compresses its answer
+before encrypting it, and marks the compressed fragments (see pm.new_fragment),
+which the client decompresses after decrypting them.
+Answers that the web server already compressed (Content-Encoding) are passed
+through as they are.
+"""
+import zlib
+
+ZLIB_COMPRESSION = "zlib"
+COMPRESSIONS = (ZLIB_COMPRESSION,)
+COMPRESSION_LEVEL = 6
+
+# content encodings of answers that would not get any smaller
+COMPRESSED_ENCODINGS = ("gzip", "x-gzip", "deflate", "compress", "br", "zstd")
+
+# largest piece of decompressed data held at once by a Decompressor
+MAX_OUTPUT_SIZE = 64 * 1024
+
+
+def negotiate(requested):
+    """ returns the compression used by the node for the requested one (None if not supported) """
+    if requested in COMPRESSIONS:
+        return requested
+    return None
+
+
+def is_compressed(content_encoding):
+    """ True if an answer with this Content-Encoding header (or None) is already compressed """
+    if not content_encoding:
+        return False
+    encodings = [encoding.strip().lower() for encoding in content_encoding.split(",")]
+    return any(encoding in COMPRESSED_ENCODINGS for encoding in encodings)
+
+
+def new_compressor(compression, content_encoding=None):
+    """
+    returns the Compressor for an answer on a circuit using compression,
+    or None if the answer is to be sent as it is
+    """
+    if compression != ZLIB_COMPRESSION or is_compressed(content_encoding):
+        return None
+    return Compressor()
+
+
+class Compressor():
+    """
+    Compresses an answer chunk by chunk; each chunk is flushed, so that the
+    client can decompress every fragment as soon as it is received.
+    """
+
+    def __init__(self, level=COMPRESSION_LEVEL):
+        self._compressor = zlib.compressobj(level)
+
+    def compress(self, chunk):
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """ returns the end of the compressed answer """
+        return self._compressor.flush()
+
+
+class Decompressor():
+    """
+    Decompresses an answer fragment by fragment, in pieces of at most
+    max_output_size bytes, whatever the compression ratio.
+    """
+
+    def __init__(self, max_output_size=MAX_OUTPUT_SIZE):
+        self.max_output_size = max_output_size
+        self._decompressor = zlib.decompressobj()
+
+    def decompress(self, data):
+        """
+        yields the decompressed pieces of data (bytes)
+        raises zlib.error if data is not part of a compressed answer
+        """
+        while data:
+            piece = self._decompressor.decompress(data, self.max_output_size)
+            data = self._decompressor.unconsumed_tail
+            if piece:
+                yield piece
+
+    @property
+    def finished(self):
+        """ True once the end of the compressed answer was decompressed """
+        return self._decompressor.eof
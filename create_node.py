@@ -9,6 +9,9 @@ import webbrowser
 import onion_client as oc
 import node
 from node import OnionNode
+from sharded_node import ShardedNode
+from keystore import KeyStore, DEFAULT_KEYSTORE_DIRECTORY
+import handshake as hs
 
 
 def main():
@@ -62,6 +65,54 @@ def main():
         default=directory_node_port,
         help='the Port the Directory Node is listening on.'
     )
+    parser.add_argument(
+        '-keystore',
+        action='store',
+        dest='keystore',
+        type=str,
+        default=DEFAULT_KEYSTORE_DIRECTORY,
+        help='the directory where the node keeps its RSA keys between restarts.'
+    )
+    parser.add_argument(
+        '-rotateKeys',
+        action='store_true',
+        dest='rotate_keys',
+        help='make new keys for the node instead of reusing the stored ones.'
+    )
+    parser.add_argument(
+        '-handshake',
+        action='store',
+        dest='handshake',
+        type=str,
+        default=hs.RSA_HANDSHAKE,
+        choices=[hs.RSA_HANDSHAKE, hs.NTOR_HANDSHAKE],
+        help='the circuit handshake offered by the node.'
+    )
+    parser.add_argument(
+        '-engine',
+        action='store',
+        dest='engine',
+        type=str,
+        default=node.THREAD_ENGINE,
+        choices=list(node.ENGINES),
+        help='run the node with a thread per connection, or on an asyncio event loop.'
+    )
+    parser.add_argument(
+        '-workers',
+        action='store',
+        dest='connection_workers',
+        type=int,
+        default=None,
+        help='serve the connections with a pool of that many threads (thread engine only).'
+    )
+    parser.add_argument(
+        '-shards',
+        action='store',
+        dest='shards',
+        type=int,
+        default=None,
+        help='serve the node with that many processes sharing its port (see sharded_node.py).'
+    )
 
     args = parser.parse_args()
 
@@ -76,15 +127,24 @@ def main():
 
     print("Creating an Onion Node at ", ip, ":", port)
 
-    node = OnionNode(ip, port)
-    node.connect(directory_node_ip, int(directory_node_port))
-    node.start()
+    keystore = KeyStore(args.keystore)
+    if args.rotate_keys:
+        keystore.rotate(ip, port)
+
+    if args.shards:
+        onion_node = ShardedNode(ip, port, args.shards, keystore=keystore, handshake=args.handshake,
+                                 engine=args.engine, connection_workers=args.connection_workers)
+    else:
+        onion_node = OnionNode(ip, port, keystore=keystore, handshake=args.handshake, engine=args.engine,
+                               connection_workers=args.connection_workers)
+    onion_node.connect(directory_node_ip, int(directory_node_port))
+    onion_node.start()
 
     while("exit" not in input()):
         time.sleep(1)
 
     print("Closing Node")
-    node.stop()
+    onion_node.stop()
 
 
 if __name__ == '__main__':
@@ -3,15 +3,155 @@
 Defines the different tasks that will be executed by nodes.
 """
 
+import secrets
 import socket
 import sys
 from threading import Thread, Lock
 from queues import ClosableQueue
-
-PUBLIC_ROOT = 23
-PUBLIC_BASE = 5
+import framing
+
+
+def _from_hex(text):
+    return int("".join(text.split()), 16)
+
+
+# MODP groups of RFC 3526 (https://tools.ietf.org/html/rfc3526), generator 2
+MODP_1536 = _from_hex("""
+    FFFFFFFF FFFFFFFF C90FDAA2 2168C234 C4C6628B 80DC1CD1 29024E08 8A67CC74
+    020BBEA6 3B139B22 514A0879 8E3404DD EF9519B3 CD3A431B 302B0A6D F25F1437
+    4FE1356D 6D51C245 E485B576 625E7EC6 F44C42E9 A637ED6B 0BFF5CB6 F406B7ED
+    EE386BFB 5A899FA5 AE9F2411 7C4B1FE6 49286651 ECE45B3D C2007CB8 A163BF05
+    98DA4836 1C55D39A 69163FA8 FD24CF5F 83655D23 DCA3AD96 1C62F356 208552BB
+    9ED52907 7096966D 670C354E 4ABC9804 F1746C08 CA237327 FFFFFFFF FFFFFFFF
+""")
+
+MODP_2048 = _from_hex("""
+    FFFFFFFF FFFFFFFF C90FDAA2 2168C234 C4C6628B 80DC1CD1 29024E08 8A67CC74
+    020BBEA6 3B139B22 514A0879 8E3404DD EF9519B3 CD3A431B 302B0A6D F25F1437
+    4FE1356D 6D51C245 E485B576 625E7EC6 F44C42E9 A637ED6B 0BFF5CB6 F406B7ED
+    EE386BFB 5A899FA5 AE9F2411 7C4B1FE6 49286651 ECE45B3D C2007CB8 A163BF05
+    98DA4836 1C55D39A 69163FA8 FD24CF5F 83655D23 DCA3AD96 1C62F356 208552BB
+    9ED52907 7096966D 670C354E 4ABC9804 F1746C08 CA18217C 32905E46 2E36CE3B
+    E39E772C 180E8603 9B2783A2 EC07A28F B5C55DF0 6F4C52C9 DE2BCBF6 95581718
+    3995497C EA956AE5 15D22618 98FA0510 15728E5A 8AACAA68 FFFFFFFF FFFFFFFF
+""")
+
+MODP_3072 = _from_hex("""
+    FFFFFFFF FFFFFFFF C90FDAA2 2168C234 C4C6628B 80DC1CD1 29024E08 8A67CC74
+    020BBEA6 3B139B22 514A0879 8E3404DD EF9519B3 CD3A431B 302B0A6D F25F1437
+    4FE1356D 6D51C245 E485B576 625E7EC6 F44C42E9 A637ED6B 0BFF5CB6 F406B7ED
+    EE386BFB 5A899FA5 AE9F2411 7C4B1FE6 49286651 ECE45B3D C2007CB8 A163BF05
+    98DA4836 1C55D39A 69163FA8 FD24CF5F 83655D23 DCA3AD96 1C62F356 208552BB
+    9ED52907 7096966D 670C354E 4ABC9804 F1746C08 CA18217C 32905E46 2E36CE3B
+    E39E772C 180E8603 9B2783A2 EC07A28F B5C55DF0 6F4C52C9 DE2BCBF6 95581718
+    3995497C EA956AE5 15D22618 98FA0510 15728E5A 8AAAC42D AD33170D 04507A33
+    A85521AB DF1CBA64 ECFB8504 58DBEF0A 8AEA7157 5D060C7D B3970F85 A6E1E4C7
+    ABF5AE8C DB0933D7 1E8C94E0 4A25619D CEE3D226 1AD2EE6B F12FFA06 D98A0864
+    D8760273 3EC86A64 521F2B18 177B200C BBE11757 7A615D6C 770988C0 BAD946E2
+    08E24FA0 74E5AB31 43DB5BFC E0FD108E 4B82D120 A93AD2CA FFFFFFFF FFFFFFFF
+""")
+
+MODP_4096 = _from_hex("""
+    FFFFFFFF FFFFFFFF C90FDAA2 2168C234 C4C6628B 80DC1CD1 29024E08 8A67CC74
+    020BBEA6 3B139B22 514A0879 8E3404DD EF9519B3 CD3A431B 302B0A6D F25F1437
+    4FE1356D 6D51C245 E485B576 625E7EC6 F44C42E9 A637ED6B 0BFF5CB6 F406B7ED
+    EE386BFB 5A899FA5 AE9F2411 7C4B1FE6 49286651 ECE45B3D C2007CB8 A163BF05
+    98DA4836 1C55D39A 69163FA8 FD24CF5F 83655D23 DCA3AD96 1C62F356 208552BB
+    9ED52907 7096966D 670C354E 4ABC9804 F1746C08 CA18217C 32905E46 2E36CE3B
+    E39E772C 180E8603 9B2783A2 EC07A28F B5C55DF0 6F4C52C9 DE2BCBF6 95581718
+    3995497C EA956AE5 15D22618 98FA0510 15728E5A 8AAAC42D AD33170D 04507A33
+    A85521AB DF1CBA64 ECFB8504 58DBEF0A 8AEA7157 5D060C7D B3970F85 A6E1E4C7
+    ABF5AE8C DB0933D7 1E8C94E0 4A25619D CEE3D226 1AD2EE6B F12FFA06 D98A0864
+    D8760273 3EC86A64 521F2B18 177B200C BBE11757 7A615D6C 770988C0 BAD946E2
+    08E24FA0 74E5AB31 43DB5BFC E0FD108E 4B82D120 A9210801 1A723C12 A787E6D7
+    88719A10 BDBA5B26 99C32718 6AF4E23C 1A946834 B6150BDA 2583E9CA 2AD44CE8
+    DBBBC2DB 04DE8EF9 2E8EFC14 1FBECAA6 287C5947 4E6BC05D 99B2964F A090C3A2
+    233BA186 515BE7ED 1F612970 CEE2D7AF B81BDD76 2170481C D0069127 D5B05AA9
+    93B4EA98 8D8FDDC1 86FFB7DC 90A6C08F 4DF435C9 34063199 FFFFFFFF FFFFFFFF
+""")
+
+GROUPS = {
+    1536: MODP_1536,
+    2048: MODP_2048,
+    3072: MODP_3072,
+    4096: MODP_4096,
+}
+DEFAULT_GROUP = 2048
+
+PUBLIC_ROOT = GROUPS[DEFAULT_GROUP]
+PUBLIC_BASE = 2
+
+# size of the private exponents, from the estimates of RFC 3526 (section 8)
+PRIVATE_KEY_BITS = {
+    1536: 240,
+    2048: 320,
+    3072: 420,
+    4096: 480,
+}
+
+# bits of the exponent handled by each row of a fixed-base table
+WINDOW_BITS = 6
 
 MAX_PUBLIC_KEY_LENGTH_BYTES = 1024
+DEFAULT_TIMEOUT = 1  # timeout value for all blocking socket operations.
+
+
+class FixedBaseTable():
+    """ Precomputed powers of a fixed base, for fast modular exponentiation.
+
+    Row i holds base ** (d * 2 ** (WINDOW_BITS * i)) % modulus for every
+    window digit d, so base ** exponent is the product of one entry per
+    window of the exponent: no squarings are needed.
+    Exponents longer than exponent_bits fall back to pow().
+    """
+
+    def __init__(self, base, modulus, exponent_bits, window_bits=WINDOW_BITS):
+        self.base = base
+        self.modulus = modulus
+        self.exponent_bits = exponent_bits
+        self.window_bits = window_bits
+
+        self._rows = []
+        row_base = base
+        for _ in range(-(-exponent_bits // window_bits)):
+            row = [1]
+            for _ in range((1 << window_bits) - 1):
+                row.append(row[-1] * row_base % modulus)
+            self._rows.append(row)
+            # base ** (2 ** (window_bits * (i + 1)))
+            row_base = row[-1] * row_base % modulus
+
+    def pow(self, exponent):
+        """ returns base ** exponent % modulus """
+        if exponent < 0 or exponent.bit_length() > self.exponent_bits:
+            return pow(self.base, exponent, self.modulus)
+
+        modulus = self.modulus
+        mask = (1 << self.window_bits) - 1
+        result = 1
+        for row in self._rows:
+            if not exponent:
+                break
+            digit = exponent & mask
+            if digit:
+                result = result * row[digit] % modulus
+            exponent >>= self.window_bits
+        return result
+
+
+_tables = {}
+_tables_lock = Lock()
+
+
+def get_table(group=DEFAULT_GROUP):
+    """ returns the fixed-base table of the generator of the given group,
+    building it on first use. """
+    with _tables_lock:
+        table = _tables.get(group)
+        if table is None:
+            table = FixedBaseTable(PUBLIC_BASE, GROUPS[group], PRIVATE_KEY_BITS[group])
+            _tables[group] = table
+        return table
 
 
 class DiffieHellmanReceiver(Thread):
@@ -22,16 +162,20 @@ class DiffieHellmanReceiver(Thread):
     :shared_secrets: dict.
     """
 
-    def __init__(self, receiving_port, private_key, shared_secrets):
+    def __init__(self, receiving_port, private_key, shared_secrets, group=DEFAULT_GROUP):
         """ Creates a new Receiver Thread that responds to key exchange requests.
 
         Arguments:
             - receiving_port: The port on which to listen for requests.
             - private_key: The private key to use while creating keys.
             - shared_secrets: : the dictionary of shared_secrets.
+            - group: The size of the RFC 3526 group to use (a key of GROUPS).
         """
         super().__init__()
         self._private_key = private_key
+        self._group = group
+        # the public key is the same for every exchange: compute it once.
+        self._public_key = compute_public_key(private_key, group)
 
         self._host = socket.gethostname()
         self._port = receiving_port
@@ -39,25 +183,42 @@ class DiffieHellmanReceiver(Thread):
 
         self._running_flag = False
         self._running_lock = Lock()
+        # the exchanges in progress, joined before run() returns.
+        self._client_threads = []
 
     def run(self):
         self.running = True
         with socket.socket() as receiving_socket:
+            receiving_socket.settimeout(DEFAULT_TIMEOUT)
             receiving_socket.bind((self._host, self._port))
             receiving_socket.listen()  # Listen
 
             while self.running:
-                client_socket, address = receiving_socket.accept()
+                try:
+                    client_socket, address = receiving_socket.accept()
+                except socket.timeout:
+                    continue
                 # print(f"got a connection from {address}")
                 client_specific_thread = Thread(
-                    target=get_and_store_keys(
+                    target=get_and_store_keys,
+                    args=(
                         client_socket,
                         address,
                         self._private_key,
-                        self.shared_secrets
+                        self.shared_secrets,
+                        self._group,
+                        self._public_key
                     )
                 )
                 client_specific_thread.start()
+                self._client_threads = [
+                    thread for thread in self._client_threads if thread.is_alive()
+                ]
+                self._client_threads.append(client_specific_thread)
+
+        # every accepted exchange has stored its keys once the receiver is joined.
+        for thread in self._client_threads:
+            thread.join()
 
     @property
     def running(self) -> bool:
@@ -73,51 +234,72 @@ class DiffieHellmanReceiver(Thread):
         self.running = False
 
 
-def get_and_store_keys(client_socket, address, private_key, shared_secrets):
+def get_and_store_keys(client_socket, address, private_key, shared_secrets,
+                       group=DEFAULT_GROUP, public_key=None):
     """ Retrieves the shared secret using *exchange_keys()* and stores it in the
     given dict as a tuple (public_key, shared_secret).
     """
-    public_key, secret = exchange_keys(client_socket, private_key)
-    # print(f"public key: {public_key}, secret: {secret}")
-    shared_secrets[address] = (public_key, secret)
-    client_socket.close()
-
-
-def get_shared_secret(server_ip, server_receiving_port, private_key):
+    try:
+        public_key, secret = exchange_keys(client_socket, private_key, group, public_key)
+    except (ValueError, ConnectionError) as e:
+        print("ERROR    Key exchange with", address, "failed:", e)
+    else:
+        # print(f"public key: {public_key}, secret: {secret}")
+        shared_secrets[address] = (public_key, secret)
+    finally:
+        client_socket.close()
+
+
+def get_shared_secret(server_ip, server_receiving_port, private_key, group=DEFAULT_GROUP):
     """Perform a key exchange with the specified remote host.
     Returns:
         a tuple containing (the other host's public key, our shared secret)
     """
     with socket.socket() as my_socket:
         my_socket.connect((server_ip, server_receiving_port))
-        return exchange_keys(my_socket, private_key)
+        return exchange_keys(my_socket, private_key, group)
 
 
-def exchange_keys(exchange_socket, private_key):
-    """ exchange public keys over the given socket. """
-    my_number = compute_public_key(private_key)
-    exchange_socket.send(key_to_bytes(my_number))
-    server_key_in_bytes = exchange_socket.recv(MAX_PUBLIC_KEY_LENGTH_BYTES)
+def exchange_keys(exchange_socket, private_key, group=DEFAULT_GROUP, public_key=None):
+    """ exchange public keys over the given socket.
+    public_key: our public key, if it was already computed.
+    """
+    my_number = public_key if public_key is not None else compute_public_key(private_key, group)
+    framing.send_frame(exchange_socket, key_to_bytes(my_number))
+    server_key_in_bytes = framing.recv_frame(exchange_socket)
+    if server_key_in_bytes is None:
+        raise ConnectionError("connection closed during the key exchange")
     server_public_key = key_from_bytes(server_key_in_bytes)
     # print(f"sent {my_number}, received {server_public_key}")
-    our_shared_secret = compute_shared_secret(private_key, server_public_key)
+    our_shared_secret = compute_shared_secret(private_key, server_public_key, group)
     return server_public_key, our_shared_secret
 
 
-def compute_public_key(private_key):
+def generate_private_key(group=DEFAULT_GROUP):
+    """ Returns a random private key of PRIVATE_KEY_BITS[group] bits. """
+    bits = PRIVATE_KEY_BITS[group]
+    return secrets.randbits(bits) | (1 << (bits - 1))
+
+
+def compute_public_key(private_key, group=DEFAULT_GROUP):
     """ Computes the public key associated with the given private key. 
 
-    Uses the publicly available PUBLIC_BASE and PUBLIC_MODULUS variables.
+    Uses the generator PUBLIC_BASE of the given group, through its
+    precomputed fixed-base table.
     """
-    return PUBLIC_BASE ** private_key % PUBLIC_ROOT
+    return get_table(group).pow(private_key)
 
 
-def compute_shared_secret(private_key, other_public_key):
+def compute_shared_secret(private_key, other_public_key, group=DEFAULT_GROUP):
     """ Computes the shared secret given the private key and the peer's
-    public key. """
-    return (other_public_key ** private_key) % PUBLIC_ROOT
-
-
+    public key.
+    Raises ValueError if the peer's public key is not in the group (this
+    would let the peer force a known shared secret).
+    """
+    modulus = GROUPS[group]
+    if not 1 < other_public_key < modulus - 1:
+        raise ValueError("Invalid Diffie-Hellman public key")
+    return pow(other_public_key, private_key, modulus)
 
 
 def key_from_bytes(some_bytes: bytes) -> int:
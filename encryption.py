@@ -5,12 +5,28 @@
     https://svn.torproject.org/svn/projects/design-paper/tor-design.html
     http://doctrina.org/How-RSA-Works-With-Examples.html
 """
-import random as rd
 import ssl
 import json
-from cryptography.fernet import Fernet
+import base64
+import hashlib
+import hmac
+import os
+import struct
+import time
+from threading import Lock
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 random_function = ssl.RAND_bytes
 
+# first byte of every Fernet token; the serialized payload (JSON) never starts with it
+FERNET_VERSION = 0x80
+
+# relay crypto modes, chosen by the client for each circuit
+FERNET_MODE = "fernet"
+STREAM_MODE = "aes-ctr"
+
 
 """
     Fernet encryption using Cryptography library
@@ -45,51 +61,340 @@ def decrypt_fernet(message, key):
     return test
 
 
+"""
+    Layered (onion) encryption on raw bytes
+    the payload is serialized once at the edge of the circuit (serialize_payload), and every
+    layer after that works on bytes. Fernet tokens are base64 text; each layer keeps the
+    decoded token, so a layer costs a constant number of bytes instead of growing the
+    payload by 4/3. The outermost layer is base64-encoded once to fit in a JSON packet.
+
+    layers are applied with prepared ciphers (new_cipher), which the key tables create
+    once per circuit when the key is added. Every cipher has the same interface:
+        seal(payload)   : prepare a payload at the end of the circuit where it originates
+        encrypt(data)   : add one layer
+        decrypt(data)   : remove one layer
+        open(data)      : payload if the layer that was just removed was the last one, else None
+"""
+
+class LayerCipher():
+    """
+        prepared Fernet context for one shared key
+        the key is parsed and split into its signing and encryption halves once, when the
+        circuit is created. Produces and reads raw (base64-decoded) Fernet tokens:
+            version (1) | timestamp (8) | IV (16) | AES-128-CBC ciphertext | HMAC-SHA256 (32)
+        a token covers a whole packet: a node gathers its cells before removing the layer
+    """
+    cell_layers = False
+
+    def __init__(self, key):
+        raw_key = base64.urlsafe_b64decode(key)
+        if len(raw_key) != 32:
+            raise ValueError("Fernet key must be 32 url-safe base64-encoded bytes.")
+        self.key = key
+        self._signing_key = raw_key[:16]
+        self._algorithm = algorithms.AES(raw_key[16:])
+
+    def encrypt(self, data):
+        iv = os.urandom(16)
+        padder = padding.PKCS7(algorithms.AES.block_size).padder()
+        padded_data = padder.update(bytes(data)) + padder.finalize()
+        encryptor = Cipher(self._algorithm, modes.CBC(iv)).encryptor()
+        ciphertext = encryptor.update(padded_data) + encryptor.finalize()
+
+        basic_parts = struct.pack(">BQ", FERNET_VERSION, int(time.time())) + iv + ciphertext
+        return basic_parts + hmac.new(self._signing_key, basic_parts, "sha256").digest()
+
+    def decrypt(self, token):
+        token = memoryview(token)
+        if len(token) < 57 or token[0] != FERNET_VERSION:
+            raise InvalidToken
+        digest = hmac.new(self._signing_key, token[:-32], "sha256").digest()
+        if not hmac.compare_digest(digest, token[-32:]):
+            raise InvalidToken
+
+        iv = bytes(token[9:25])
+        decryptor = Cipher(self._algorithm, modes.CBC(iv)).decryptor()
+        try:
+            padded_data = decryptor.update(token[25:-32]) + decryptor.finalize()
+            unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+            return unpadder.update(padded_data) + unpadder.finalize()
+        except ValueError:
+            raise InvalidToken
+
+    def seal(self, payload):
+        return payload
+
+    def open(self, data):
+        if is_layered(data):
+            return None
+        return data
+
+
+class RelayCrypto():
+    """
+        stateful stream-cipher relay crypto for one hop of a circuit (STREAM_MODE)
+        the shared key from the create/extend handshake seeds, through HKDF:
+            - a forward (client -> exit) and a backward (exit -> client) AES-128-CTR stream
+            - a forward and a backward running SHA-256 digest
+        each hop XORs every cell with its keystream; no IV, MAC or padding is added per layer.
+        The hop where a cell originates seals it with a header checked by the hop it is meant for:
+            recognized (2, zero) | digest (4, running digest of all cells so far) | payload
+        both ends of a hop must process the cells of a circuit in the same order.
+        every cell is sealed and layered on its own (see pm.new_sealed_packet), so that the
+        nodes can relay the cells of a packet one by one.
+    """
+    cell_layers = True
+    RECOGNIZED = b"\x00\x00"
+    HEADER_LENGTH = 6
+
+    def __init__(self, key, origin=False):
+        raw_key = base64.urlsafe_b64decode(key)
+        material = HKDF(algorithm=hashes.SHA256(), length=96, salt=None,
+                        info=b"onion routing relay crypto").derive(raw_key)
+        forward_key, backward_key = material[0:16], material[16:32]
+        forward_digest, backward_digest = material[32:64], material[64:96]
+
+        self.key = key
+        self._lock = Lock()
+        forward = Cipher(algorithms.AES(forward_key), modes.CTR(bytes(16))).encryptor()
+        backward = Cipher(algorithms.AES(backward_key), modes.CTR(bytes(16))).encryptor()
+
+        # the client encrypts forward and decrypts backward; a node does the opposite
+        if origin:
+            self._send_stream, self._recv_stream = forward, backward
+            self._send_digest = hashlib.sha256(forward_digest)
+            self._recv_digest = hashlib.sha256(backward_digest)
+        else:
+            self._send_stream, self._recv_stream = backward, forward
+            self._send_digest = hashlib.sha256(backward_digest)
+            self._recv_digest = hashlib.sha256(forward_digest)
+
+    def encrypt(self, data):
+        with self._lock:
+            return self._send_stream.update(data)
+
+    def decrypt(self, data):
+        with self._lock:
+            return self._recv_stream.update(data)
+
+    def seal(self, payload):
+        with self._lock:
+            self._send_digest.update(self.RECOGNIZED + bytes(4))
+            self._send_digest.update(payload)
+            return self.RECOGNIZED + self._send_digest.digest()[:4] + bytes(payload)
+
+    def open(self, data):
+        # the payload is returned as a memoryview of data, without copying it
+        data = memoryview(data)
+        if len(data) < self.HEADER_LENGTH or bytes(data[:2]) != self.RECOGNIZED:
+            return None
+        with self._lock:
+            # only commit to the new digest state if the cell was meant for this hop
+            digest = self._recv_digest.copy()
+            digest.update(self.RECOGNIZED + bytes(4))
+            digest.update(data[self.HEADER_LENGTH:])
+            if not hmac.compare_digest(digest.digest()[:4], bytes(data[2:self.HEADER_LENGTH])):
+                return None
+            self._recv_digest = digest
+        return data[self.HEADER_LENGTH:]
+
+
+def new_cipher(key, mode=FERNET_MODE, origin=False):
+    """
+    prepare the cipher context for a shared key; done once per circuit
+    origin: True for the client that built the circuit, False for a node along it
+    """
+    if mode == STREAM_MODE:
+        return RelayCrypto(key, origin)
+    return LayerCipher(key)
+
+def serialize_payload(payload):
+    # dict -> json -> bytes
+    return json.dumps(payload).encode('utf-8')
+
+def deserialize_payload(data):
+    # bytes -> json -> dict
+    return json.loads(bytes(data).decode('utf-8'))
+
+def encrypt_layer(data, cipher):
+    """add one encryption layer to data (bytes) using a prepared cipher, returns bytes"""
+    return cipher.encrypt(data)
+
+def decrypt_layer(data, cipher):
+    """remove one encryption layer from data (bytes) using a prepared cipher, returns bytes"""
+    return cipher.decrypt(data)
+
+def encrypt_layers(data, ciphers):
+    """
+    seal data for the last node, then add every layer
+    ciphers are ordered from the entry node to the last node; the last one is applied first
+    """
+    data = ciphers[-1].seal(data)
+    for cipher in reversed(ciphers):
+        data = cipher.encrypt(data)
+    return data
+
+def decrypt_layers(data, ciphers):
+    """
+    remove layers until one of the nodes is recognized as the origin of data
+    ciphers are ordered from the entry node to the last node
+    returns the payload, or None if no node was recognized
+    """
+    for cipher in ciphers:
+        data = cipher.decrypt(data)
+        payload = cipher.open(data)
+        if payload is not None:
+            return payload
+    return None
+
+def is_layered(data):
+    """True if data is still wrapped in an encryption layer, False if it is a serialized payload"""
+    return len(data) > 0 and data[0] == FERNET_VERSION
+
+def to_packet_data(data):
+    # bytes -> str, to be placed in a JSON packet
+    return base64.urlsafe_b64encode(bytes(data)).decode('ascii')
+
+def from_packet_data(string):
+    # str -> bytes
+    return base64.urlsafe_b64decode(string.encode('ascii'))
+
+
 """
     RSA encryption (self-implemented)
 """
 
+# size of the modulus, in bits
+DEFAULT_RSA_KEY_SIZE = 512
+PUBLIC_EXP = 2**16 + 1   # 65537
+
+
+class BufferedRandom():
+    """
+    CSPRNG that draws bytes from random_function in large blocks, and hands them out
+    in slices: one call into OpenSSL serves many candidates and witnesses
+    """
+
+    def __init__(self, block_size=4096, source=None):
+        self.block_size = block_size
+        self.source = source if source is not None else random_function
+        self._buffer = b''
+        self._position = 0
+        self._lock = Lock()
+
+    def read(self, n):
+        with self._lock:
+            if self._position + n > len(self._buffer):
+                self._buffer = self._buffer[self._position:] + self.source(max(self.block_size, n))
+                self._position = 0
+            chunk = self._buffer[self._position:self._position + n]
+            self._position += n
+            return chunk
+
+    def randbits(self, bits):
+        """random integer with at most the given number of bits"""
+        rand = int.from_bytes(self.read((bits + 7) // 8), byteorder='big')
+        return rand >> (-bits % 8)
+
+    def randbelow(self, n):
+        """random integer in [0, n), by rejection sampling"""
+        bits = n.bit_length()
+        rand = self.randbits(bits)
+        while rand >= n:
+            rand = self.randbits(bits)
+        return rand
+
+    def randrange(self, start, stop):
+        return start + self.randbelow(stop - start)
+
+csprng = BufferedRandom()
+
+
+def _small_primes(limit):
+    """sieve of Eratosthenes: all primes below limit"""
+    sieve = bytearray([1]) * limit
+    sieve[0:2] = b'\x00\x00'
+    for i in range(2, int(limit ** 0.5) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = bytes(len(range(i * i, limit, i)))
+    return [i for i in range(limit) if sieve[i]]
+
+# precomputed table for trial division and for sieving candidate windows
+SMALL_PRIMES = _small_primes(2048)
+SMALL_PRIME_SET = frozenset(SMALL_PRIMES)
+
+
 def getSamplesLargeNumber(p, iterations):
     """Generates a sample with size iterations of large numbers from 1<n<p-1"""
-    aValues = []
+    aValues = set()
     while len(aValues) != iterations:
-        sample = rd.randrange(2, p - 1)
-        if sample not in aValues:
-            aValues.append(sample)
-    return aValues
+        aValues.add(csprng.randrange(2, p - 1))
+    return list(aValues)
 
 
 def primeClaim(s, p, a, d):
-    """helper method for the Rabbin-Miller Algorithm"""
-    for i in range(s):
-        power = pow(a, pow(2, i) * d, p)
+    """helper method for the Rabbin-Miller Algorithm
+    a^d, then s-1 squarings, instead of a full exponentiation for every a^(2^i * d)"""
+    power = pow(a, d, p)
+    if power == 1 or power == p - 1:
+        return True
+    for i in range(s - 1):
+        power = power * power % p
         if power == p - 1:
             return True
-        elif i == 0:
-            if power == 1 or power == p - 1:
-                return True
+        elif power == 1:
+            return False
     return False
 
 def genRandom(bits):
-    """generate an odd number"""
-    rand = 0
-    bytes = bits // 8 + 8
-    while rand.bit_length() < bits:
-        rand = int.from_bytes(random_function(bytes), byteorder='big')
-    if not rand & 1:
-        rand += 1
-    return rand
-
-def getLargePrime(length=200):
-    newPrime = genRandom(length)
-    while not checkIfPrime(newPrime):
-        newPrime += 2
-    return newPrime
-
-def checkIfPrime(p, iterations=64):
-    """check if a number if prime using the Rabin-Miller Algorithm, 64 iterations has 1/2^128 error"""
-    if p == 2:
-        return True
+    """generate an odd number of exactly the given number of bits"""
+    rand = csprng.randbits(bits)
+    # set the top two bits, so that the product of two primes has the full size
+    return rand | (3 << (bits - 2)) | 1
+
+def getLargePrime(length=200, public_exp=None):
+    """
+    find a prime of the given bit length
+    candidates are taken in windows of consecutive odd numbers starting at a random point.
+    each window is sieved once with the small prime table (one modular reduction per small
+    prime per window), so Miller-Rabin only runs on candidates without a small factor.
+    public_exp: if given, skip primes p for which p - 1 is a multiple of public_exp
+    """
+    if length < 2:
+        raise ValueError("There is no prime of {} bits".format(length))
+    window = max(64, length)
+    while True:
+        base = genRandom(length)
+        # composite[i] is set if base + 2*i has a small factor
+        composite = bytearray(window)
+        for prime in SMALL_PRIMES[1:]:
+            # solve base + 2*i = 0 (mod prime)
+            start = (prime - base % prime) * ((prime + 1) // 2) % prime
+            composite[start::prime] = b'\x01' * len(range(start, window, prime))
+
+        for i in range(window):
+            candidate = base + 2 * i
+            # the sieve also marks the small primes themselves: those are checked in the table
+            if composite[i] and candidate > SMALL_PRIMES[-1]:
+                continue
+            if candidate.bit_length() != length:
+                break
+            if public_exp is not None and candidate % public_exp == 1:
+                continue
+            if checkIfPrime(candidate, trial_division=False):
+                return candidate
+
+def checkIfPrime(p, iterations=64, trial_division=True):
+    """check if a number if prime using the Rabin-Miller Algorithm, 64 iterations has 1/2^128 error
+    trial division by the small prime table is done first; it can be skipped for sieved candidates"""
+    if p < 2:
+        return False
+    if p <= SMALL_PRIMES[-1]:
+        return p in SMALL_PRIME_SET
+    if trial_division:
+        for prime in SMALL_PRIMES:
+            if p % prime == 0:
+                return False
     elif not p & 1:
         return False
 
@@ -98,32 +403,32 @@ def checkIfPrime(p, iterations=64):
     while pow2 % 2 == 0:
         pow2 >>= 1
         s += 1
-    d = (p - 1) // pow(2, s)
+    d = pow2
 
     # ensure enough values for 64 Miller-Rabin tests
     if p < iterations:
         iterations = p // 2
-    # check if prime is larger than 2^15 - 1, as rd.sample needs ssize_t
-    # ssize_t can store values of at least the range [-1 ... 2^15-1] per POSIX
-    if p > pow(2, 15) - 1:
-        aValues = getSamplesLargeNumber(p, iterations)
-    else:
-        aValues = rd.sample(range(2, p - 1), iterations)
+    aValues = getSamplesLargeNumber(p, iterations)
     while aValues:
         if not primeClaim(s, p, aValues.pop(), d):
             return False
     return True
 
-def get_private_key_rsa():
+def get_private_key_rsa(key_size=DEFAULT_RSA_KEY_SIZE):
     """generate a public and private key to be used in a shared key exchange
+    key_size: size of the modulus, in bits
     optimization: extended Euclidean algorithm"""
-    nums = [getLargePrime(), getLargePrime()]
+    # choose public exp s.t. 1 < e < phi and e is coprime to phi
+    public_exp = PUBLIC_EXP
+
+    p = getLargePrime(key_size // 2, public_exp)
+    q = getLargePrime(key_size - key_size // 2, public_exp)
+    while q == p:
+        q = getLargePrime(key_size - key_size // 2, public_exp)
+    nums = [p, q]
     mod = nums[0] * nums[1]
     phi = (nums[0] - 1) * (nums[1] - 1)   # totient of n: number of coprimes of n
 
-    # choose public exp s.t. 1 < e < phi and e is coprime to phi
-    public_exp = 2**16 + 1   # 65537
-
     # extended euclidean algorithm
     private_exp = mulinv(public_exp, phi)
 
@@ -131,6 +436,13 @@ def get_private_key_rsa():
     rsa_keys["modulus"] = mod
     rsa_keys["public"] = public_exp
     rsa_keys["private"] = private_exp
+
+    # Chinese Remainder Theorem parameters, for decrypt_RSA_keys
+    rsa_keys["p"] = p
+    rsa_keys["q"] = q
+    rsa_keys["dP"] = private_exp % (p - 1)
+    rsa_keys["dQ"] = private_exp % (q - 1)
+    rsa_keys["qInv"] = mulinv(q, p)
     return rsa_keys
 
 # only using RSA to encode a byte key
@@ -140,6 +452,19 @@ def encrypt_RSA(message, e, n):
 def decrypt_RSA(ciphertext, d, n):
     return convertNumberToKey(pow(ciphertext, int(d), int(n)))
 
+def decrypt_RSA_keys(ciphertext, rsa_keys):
+    """decrypt with a private key from get_private_key_rsa
+    uses the Chinese Remainder Theorem when the key has its CRT parameters: two
+    exponentiations with half-size exponents and moduli instead of one full-size one"""
+    if "qInv" not in rsa_keys:
+        # keys made before the CRT parameters were kept
+        return decrypt_RSA(ciphertext, rsa_keys["private"], rsa_keys["modulus"])
+    p, q = rsa_keys["p"], rsa_keys["q"]
+    m1 = pow(ciphertext, rsa_keys["dP"], p)
+    m2 = pow(ciphertext, rsa_keys["dQ"], q)
+    h = rsa_keys["qInv"] * (m1 - m2) % p
+    return convertNumberToKey(m2 + h * q)
+
 #https://en.wikibooks.org/wiki/Algorithm_Implementation/Mathematics/Extended_Euclidean_algorithm
 def xgcd(b, n):
     x0, x1, y0, y1 = 1, 0, 0, 1
@@ -21,3 +21,7 @@ class OnionRuntimeError(OnionError):
 
 class OnionClientError(OnionError):
     pass
+
+
+class OnionOverloadError(OnionRuntimeError):
+    pass
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+"""
+SENDME-style flow control of the answers sent back through a circuit.
+
+The exit node may only send cells while its window is open: each fragment
+it sends consumes the cells it is made of (see pm.cell_count), and the
+client gives credit back with a "sendme" packet every SENDME_INCREMENT cells
+it has delivered. At most CIRCUIT_WINDOW cells of a circuit are in flight
+between the exit node and the client, whatever the speed of the client.
+Cells are counted on the fragments themselves, which are the same size at
+both ends of the circuit.
+
+Each stream of a circuit (see pm.new_payload) has a window of its own, of
+STREAM_WINDOW cells: a fragment is only sent once both windows hold all of
+its cells (see consume_all), so that neither window is ever overdrawn.
+The client acknowledges the cells of the circuit as it receives them, and
+the cells of a stream as they are read from it, so that a stream nobody
+reads stops its own answer without holding back the other streams.
+"""
+import asyncio
+import time
+from threading import Condition
+
+CIRCUIT_WINDOW = 1000
+SENDME_INCREMENT = 100
+STREAM_WINDOW = 500
+STREAM_SENDME_INCREMENT = 50
+
+# seconds a sender waits for credit before giving up on the answer
+FLOW_TIMEOUT = 60
+
+
+class SendWindow():
+    """
+    Cells that a sender may still send before they are acknowledged.
+    consume() blocks (consume_async waits) while the window is closed;
+    replenish() is called for each "sendme" received.
+    """
+
+    def __init__(self, size=CIRCUIT_WINDOW, increment=SENDME_INCREMENT):
+        self.size = size
+        self.increment = increment
+        self.available = size
+        self._condition = Condition()
+        # (loop, future) of the coroutines waiting for credit
+        self._waiters = []
+
+    def consume(self, cells, timeout=FLOW_TIMEOUT):
+        """
+        waits until the window holds cells, then takes them from it
+        (a fragment larger than the whole window waits for it to be fully open)
+        returns False if it stayed too small for timeout seconds
+        """
+        needed = min(cells, self.size)
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.available >= needed, timeout):
+                return False
+            self.available -= cells
+            return True
+
+    async def consume_async(self, cells, timeout=FLOW_TIMEOUT):
+        """ consume(), for a coroutine """
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._condition:
+                if self.available >= min(cells, self.size):
+                    self.available -= cells
+                    return True
+                future = loop.create_future()
+                self._waiters.append((loop, future))
+            try:
+                await asyncio.wait_for(future, max(0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                return False
+
+    def replenish(self):
+        """
+        gives back the credit of one "sendme"
+        returns False if it acknowledges cells that were never sent
+        """
+        with self._condition:
+            if self.available + self.increment > self.size:
+                return False
+            self.available += self.increment
+        self._release()
+        return True
+
+    def refund(self, cells):
+        """ gives back cells that were consumed but never sent """
+        with self._condition:
+            self.available += cells
+        self._release()
+
+    def _release(self):
+        """ wakes up everyone waiting for credit """
+        with self._condition:
+            self._condition.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake_up, future)
+
+
+def consume_all(windows, cells, timeout=FLOW_TIMEOUT):
+    """
+    takes cells from every window, or from none of them:
+    returns False, with the credit already taken given back, if one of the
+    windows stayed too small for timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    taken = []
+    for window in windows:
+        if not window.consume(cells, max(0, deadline - time.monotonic())):
+            for consumed in taken:
+                consumed.refund(cells)
+            return False
+        taken.append(window)
+    return True
+
+
+async def consume_all_async(windows, cells, timeout=FLOW_TIMEOUT):
+    """ consume_all(), for a coroutine """
+    deadline = time.monotonic() + timeout
+    taken = []
+    for window in windows:
+        if not await window.consume_async(cells, max(0, deadline - time.monotonic())):
+            for consumed in taken:
+                consumed.refund(cells)
+            return False
+        taken.append(window)
+    return True
+
+
+def _wake_up(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ReceiveWindow():
+    """
+    Cells delivered by a receiver; tells when to acknowledge them with a "sendme".
+    """
+
+    def __init__(self, increment=SENDME_INCREMENT):
+        self.increment = increment
+        self.delivered = 0
+
+    def deliver(self, cells):
+        """ counts delivered cells; returns the number of "sendme" packets to send """
+        self.delivered += cells
+        sendmes, self.delivered = divmod(self.delivered, self.increment)
+        return sendmes
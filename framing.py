@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+"""
+Framing of everything sent over the sockets of the onion network.
+
+Every message is sent as one frame:
+    length (4 bytes, big-endian) | message
+and read back by a FrameDecoder, which works incrementally on the bytes
+received so far. Messages that all have the same size (the cells of
+packet_manager.py) are sent back to back, without a length, and read by a
+RecordDecoder. The bytes are received into a buffer allocated once per
+connection (socket.recv_into), and frames can be handed over as memoryviews
+of it: a received byte is not copied until it is parsed.
+"""
+import struct
+
+LENGTH_PREFIX = struct.Struct(">I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+BUFFER_SIZE = 65536
+
+
+def encode_frame(message):
+    """ returns the frame (bytes) carrying the given message (bytes-like) """
+    return LENGTH_PREFIX.pack(len(message)) + message
+
+
+def send_frame(sock, message):
+    """ sends the given message (bytes-like) as one frame """
+    sock.sendall(encode_frame(message))
+
+
+class FrameDecoder():
+    """
+    Splits a stream of bytes into frames.
+    Bytes are received straight into the buffer of the decoder with
+    recv_into(), or given with feed(); the complete frames are taken out with
+    next_frame(), next_frame_view(), or by iterating over the decoder.
+    The buffer is allocated once, and only replaced by a larger one for a
+    frame that does not fit in it; the bytes of a frame are moved within it
+    at most once, when the frame reaches its end.
+    """
+
+    # bytes before the message of a frame
+    prefix_size = LENGTH_PREFIX.size
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, buffer_size=BUFFER_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer_size = buffer_size
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        # bytes received but not yet returned in a frame: _view[_start:_end]
+        self._start = 0
+        self._end = 0
+
+    def feed(self, data):
+        """ adds received bytes to the decoder """
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def recv_into(self, sock):
+        """
+        receives bytes from a socket into the buffer of the decoder, without copying them
+        returns the number of bytes received, 0 once the connection is closed
+        raises ValueError if the frame being received is larger than max_frame_size
+        """
+        self._reserve(max(self._frame_size() - self.buffered, 1))
+        received = sock.recv_into(self._view[self._end:])
+        self._end += received
+        return received
+
+    def next_frame_view(self):
+        """
+        returns the message of the next complete frame as a memoryview of the
+        buffer of the decoder, or None if it was not completely received yet
+        the memoryview is only valid until bytes are added to the decoder
+        raises ValueError if the frame is larger than max_frame_size
+        """
+        size = self._frame_size()
+        if self.buffered < size:
+            return None
+        end = self._start + size
+        message = self._view[self._start + self.prefix_size:end]
+        if end == self._end:
+            # nothing left: the next bytes go to the start of the buffer
+            self._start = self._end = 0
+            if len(self._buffer) > self.buffer_size:
+                # back to the usual size after a large frame
+                self._buffer = bytearray(self.buffer_size)
+                self._view = memoryview(self._buffer)
+        else:
+            self._start = end
+        return message
+
+    def next_frame(self):
+        """
+        returns the message of the next complete frame (bytes), or None if
+        it was not completely received yet
+        raises ValueError if the frame is larger than max_frame_size
+        """
+        message = self.next_frame_view()
+        if message is None:
+            return None
+        return bytes(message)
+
+    @property
+    def buffered(self):
+        """ number of bytes received but not yet returned in a frame """
+        return self._end - self._start
+
+    def views(self):
+        """ iterates over the complete frames, as memoryviews (see next_frame_view) """
+        while True:
+            message = self.next_frame_view()
+            if message is None:
+                return
+            yield message
+
+    def __iter__(self):
+        while True:
+            message = self.next_frame()
+            if message is None:
+                return
+            yield message
+
+    def _frame_size(self):
+        """ size of the next frame, prefix included, as far as it is known """
+        if self.buffered < LENGTH_PREFIX.size:
+            return LENGTH_PREFIX.size
+        length, = LENGTH_PREFIX.unpack_from(self._buffer, self._start)
+        if length > self.max_frame_size:
+            raise ValueError("Frame of {} bytes is too large".format(length))
+        return LENGTH_PREFIX.size + length
+
+    def _reserve(self, size):
+        """ makes room for at least size more bytes at the end of the buffer """
+        if len(self._buffer) - self._end >= size:
+            return
+        pending = self.buffered
+        needed = pending + size
+        if needed > len(self._buffer) or len(self._buffer) > self.buffer_size >= needed:
+            # a larger buffer for a large frame, and back to the usual size after it
+            buffer = bytearray(max(needed, self.buffer_size))
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        else:
+            # move the start of the next frame to the start of the buffer
+            self._view[:pending] = self._view[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+
+class RecordDecoder(FrameDecoder):
+    """
+    A FrameDecoder for messages of record_size bytes each, sent back to back
+    without a length prefix.
+    """
+    prefix_size = 0
+
+    def __init__(self, record_size, buffer_size=BUFFER_SIZE):
+        super().__init__(record_size, buffer_size)
+        self.record_size = record_size
+
+    def _frame_size(self):
+        return self.record_size
+
+
+class FrameReader():
+    """
+    Reads frames from a socket; bytes received after a frame are kept for
+    the next call.
+    record_size: the size of every message, for messages sent without a
+    length prefix (see RecordDecoder)
+    """
+
+    def __init__(self, sock, buffer_size=BUFFER_SIZE, max_frame_size=MAX_FRAME_SIZE, record_size=None):
+        self.sock = sock
+        self.buffer_size = buffer_size
+        if record_size is None:
+            self.decoder = FrameDecoder(max_frame_size, buffer_size)
+        else:
+            self.decoder = RecordDecoder(record_size, buffer_size)
+
+    def read_frame(self):
+        """
+        returns the message of the next frame (bytes), or None if the
+        connection was closed before a complete frame was received
+        """
+        message = self.read_frame_view()
+        if message is None:
+            return None
+        return bytes(message)
+
+    def read_frame_view(self):
+        """
+        read_frame, returning the message as a memoryview of the buffer of the
+        reader instead of a copy; it is only valid until the next read
+        """
+        while True:
+            message = self.decoder.next_frame_view()
+            if message is not None:
+                return message
+            if not self.decoder.recv_into(self.sock):
+                return None
+
+
+def recv_frame(sock):
+    """
+    reads one frame from a socket that carries a single message
+    (use a FrameReader for sockets that carry several)
+    """
+    return FrameReader(sock).read_frame()
@@ -1,29 +1,153 @@
 import urllib.request,urllib.parse,urllib.error
+import asyncio
+import email.parser
 import socket
+import ssl
 import http
+import http.client
+
+
+CHUNK_SIZE = 16 * 1024
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+REQUEST_ERRORS = (
+    urllib.error.URLError,
+    socket.error,
+    socket.timeout,
+    socket.gaierror,
+    UnicodeEncodeError,
+    http.client.BadStatusLine,
+    http.client.IncompleteRead,
+    urllib.error.HTTPError,
+)
 
 
 def web_request(url):
-    """Returns bytes of response for get request to url"""
+    """Returns bytes of response for get request to url ('' if it fails or is cut short)"""
+    try:
+        response_data = b''.join(web_request_chunks(url))
+    except REQUEST_ERRORS:
+        response_data = b''
+    if not response_data:
+        response_data = ''
+    return response_data
+
+
+def web_request_chunks(url, chunk_size=CHUNK_SIZE):
+    """
+    Yields the response for get request to url, chunk_size bytes at a time,
+    as it is received; yields nothing if the request fails, and raises one of
+    REQUEST_ERRORS (e.g. http.client.IncompleteRead) if the body is cut short
+    """
+    _, chunks = web_request_stream(url, chunk_size)
+    return chunks
+
+
+def web_request_stream(url, chunk_size=CHUNK_SIZE):
+    """
+    Makes a get request to url; returns (headers, chunks):
+        headers: the headers of the response (empty if the request failed)
+        chunks: iterator over the body of the response, chunk_size bytes at a time
+    """
     if not url.startswith("http://") and not url.startswith("https://"):
         url = "http://" + url
     try:
-        with urllib.request.urlopen(url) as response:
-            response_data = response.read()
-    except urllib.error.URLError as e:
-        response_data = ''
-    except socket.error:
-        response_data = ''
-    except socket.timeout:
-        response_data = ''
-    except socket.gaierror:
-        response_data = ''
-    except UnicodeEncodeError:
-        response_data = ''
-    except http.client.BadStatusLine:
-        response_data = ''
-    except http.client.IncompleteRead:
-        response_data = ''
-    except urllib.error.HTTPError:
-            response_data = ''
-    return response_data
\ No newline at end of file
+        response = urllib.request.urlopen(url)
+    except REQUEST_ERRORS:
+        return {}, iter(())
+    return response.headers, _read_chunks(response, chunk_size)
+
+
+def _read_chunks(response, chunk_size):
+    """
+    yields the body of response; once the headers are in, errors are raised:
+    http.client.IncompleteRead if the body is shorter than its Content-Length
+    """
+    remaining = response.length
+    with response:
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+    if remaining:
+        raise http.client.IncompleteRead(b'', remaining)
+
+
+async def web_request_stream_async(url, chunk_size=CHUNK_SIZE):
+    """
+    asyncio version of web_request_stream, for the asyncio node engine (see async_node.py):
+    returns (headers, chunks), chunks being an asynchronous iterator.
+    the request is made in HTTP/1.0, following redirects like urlopen does
+    """
+    if not url.startswith("http://") and not url.startswith("https://"):
+        url = "http://" + url
+    try:
+        for _ in range(MAX_REDIRECTS + 1):
+            status, headers, reader, writer = await _open_async(url)
+            if status in REDIRECT_STATUSES and headers.get('Location'):
+                writer.close()
+                url = urllib.parse.urljoin(url, headers['Location'])
+                continue
+            if status >= 400:
+                writer.close()
+                break
+            return headers, _read_chunks_async(reader, writer, chunk_size, headers.get('Content-Length'))
+    except REQUEST_ERRORS + (ValueError, asyncio.IncompleteReadError):
+        pass
+    return {}, _no_chunks()
+
+
+async def _open_async(url):
+    """ sends the request; returns (status, headers, reader, writer) once the headers are received """
+    parts = urllib.parse.urlsplit(url)
+    https = parts.scheme == "https"
+    port = parts.port or (443 if https else 80)
+    reader, writer = await asyncio.open_connection(
+        parts.hostname, port, ssl=ssl.create_default_context() if https else None)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    request = "GET {} HTTP/1.0\r\nHost: {}\r\nUser-Agent: Python-urllib\r\nConnection: close\r\n\r\n"
+    writer.write(request.format(path, parts.netloc).encode('ascii'))
+    try:
+        status_line = (await reader.readline()).decode('iso-8859-1').split(None, 2)
+        if len(status_line) < 2 or not status_line[0].startswith("HTTP/"):
+            raise http.client.BadStatusLine(" ".join(status_line))
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            header_lines.append(line.decode('iso-8859-1'))
+        headers = email.parser.Parser(_class=http.client.HTTPMessage).parsestr("".join(header_lines))
+        return int(status_line[1]), headers, reader, writer
+    except BaseException:
+        writer.close()
+        raise
+
+
+async def _read_chunks_async(reader, writer, chunk_size, content_length):
+    """ asyncio version of _read_chunks: raises http.client.IncompleteRead if the body is cut short """
+    remaining = int(content_length) if content_length is not None else None
+    try:
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = await reader.read(size)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+    finally:
+        writer.close()
+    if remaining:
+        raise http.client.IncompleteRead(b'', remaining)
+
+
+async def _no_chunks():
+    return
+    yield
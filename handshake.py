@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+"""
+    Circuit handshakes: how the client and a node agree on the shared key of a
+    circuit hop, in one round trip (create/created, or extend/extended).
+
+    rsa:  the client picks a Fernet key and sends it encrypted with the node's
+          RSA public key (public_exp, modulus from the node descriptor).
+    ntor: X25519 handshake modelled on Tor's ntor. The node publishes a static
+          X25519 key B in its descriptor; the client sends an ephemeral key X, the
+          node answers with an ephemeral key Y and an authenticator. Both sides
+          derive the shared key with HKDF from EXP(X, y) and EXP(X, b).
+          https://gitweb.torproject.org/torspec.git/tree/tor-spec.txt (5.1.4)
+
+    Shared keys are 32 url-safe base64-encoded bytes in both cases, so they can
+    be used by any of the relay crypto modes (encryption.new_cipher).
+"""
+import base64
+import hmac
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.kdf.hkdf import HKDFExpand
+
+import encryption as enc
+from errors import OnionRuntimeError
+
+RSA_HANDSHAKE = "rsa"
+NTOR_HANDSHAKE = "ntor"
+
+PROTOID = b"ntor-curve25519-sha256-1"
+T_MAC = PROTOID + b":mac"
+T_KEY = PROTOID + b":key_extract"
+T_VERIFY = PROTOID + b":verify"
+M_EXPAND = PROTOID + b":key_expand"
+
+KEY_LENGTH = 32
+AUTH_LENGTH = 32
+
+
+def generate_ntor_keys():
+    """ static X25519 key pair of a node, as url-safe base64 strings """
+    private_key = X25519PrivateKey.generate()
+    return {
+        'private': _encode(private_key.private_bytes_raw()),
+        'public': _encode(private_key.public_key().public_bytes_raw())
+    }
+
+
+def get_handshake(node):
+    """ handshake to use with a node, from its descriptor in the network list """
+    return node.get('handshake', RSA_HANDSHAKE)
+
+
+def client_create(node):
+    """
+    first half of the handshake, done by the client
+    node: the node descriptor
+    returns (state to keep until the answer arrives, data to send in the create/extend payload)
+    """
+    if get_handshake(node) == NTOR_HANDSHAKE:
+        x = X25519PrivateKey.generate()
+        return x, _encode(x.public_key().public_bytes_raw())
+
+    key = enc.generate_fernet_key()
+    return key, enc.encrypt_RSA(key, node['public_exp'], node['modulus'])
+
+
+def server_reply(handshake, data, node_id, rsa_keys=None, ntor_keys=None):
+    """
+    node side of the handshake
+    node_id: "ip:port" of the node
+    returns (shared key, reply to send back to the client in the created payload)
+    raises ValueError if data can't be interpreted
+    """
+    if handshake == NTOR_HANDSHAKE:
+        b = X25519PrivateKey.from_private_bytes(_decode(ntor_keys['private']))
+        B = _decode(ntor_keys['public'])
+        X = _decode(data)
+        y = X25519PrivateKey.generate()
+        Y = y.public_key().public_bytes_raw()
+
+        X_key = X25519PublicKey.from_public_bytes(X)
+        secret_input = y.exchange(X_key) + b.exchange(X_key) + node_id.encode() + B + X + Y + PROTOID
+        key, auth = _derive(secret_input, node_id.encode(), B, X, Y)
+        return key, Y + auth
+
+    shared_key = enc.decrypt_RSA_keys(int(data), rsa_keys)
+    return shared_key, b''
+
+
+def client_finish(node, state, reply):
+    """
+    second half of the handshake, done by the client with the node's reply
+    returns the shared key
+    raises OnionRuntimeError if the node could not prove it knows its private key
+    """
+    if get_handshake(node) != NTOR_HANDSHAKE:
+        return state
+
+    x = state
+    node_id = "{}:{}".format(node['ip'], node['port']).encode()
+    B = _decode(node['ntor_key'])
+    X = x.public_key().public_bytes_raw()
+    Y, auth = reply[:KEY_LENGTH], reply[KEY_LENGTH:]
+    if len(Y) != KEY_LENGTH or len(auth) != AUTH_LENGTH:
+        raise OnionRuntimeError("ERROR    Malformed ntor handshake reply\n")
+
+    try:
+        secret_input = (x.exchange(X25519PublicKey.from_public_bytes(Y)) +
+                        x.exchange(X25519PublicKey.from_public_bytes(B)) +
+                        node_id + B + X + Y + PROTOID)
+    except ValueError:
+        raise OnionRuntimeError("ERROR    Invalid ntor handshake reply\n")
+    key, expected_auth = _derive(secret_input, node_id, B, X, Y)
+    if not hmac.compare_digest(auth, expected_auth):
+        raise OnionRuntimeError("ERROR    ntor handshake authentication failed\n")
+    return key
+
+
+def _derive(secret_input, node_id, B, X, Y):
+    """ returns (shared key, AUTH) """
+    key_seed = _h(secret_input, T_KEY)
+    verify = _h(secret_input, T_VERIFY)
+    auth = _h(verify + node_id + B + Y + X + PROTOID + b"Server", T_MAC)
+    key = HKDFExpand(algorithm=hashes.SHA256(), length=KEY_LENGTH, info=M_EXPAND).derive(key_seed)
+    return base64.urlsafe_b64encode(key), auth
+
+
+def _h(message, tweak):
+    return hmac.new(tweak, message, "sha256").digest()
+
+
+def _encode(raw):
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def _decode(string):
+    return base64.urlsafe_b64decode(string.encode('ascii'))
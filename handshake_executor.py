@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+"""
+Defines the HandshakeExecutor, which runs the node side of circuit handshakes
+(handshake.server_reply) in worker processes, so that a burst of "create"
+packets does not hold the GIL and stall the relaying of every other circuit.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+import time
+
+import handshake as hs
+from errors import OnionOverloadError
+
+DEFAULT_MAX_PENDING = 32
+
+# identity of the node, installed once in each worker process
+_worker_identity = None
+
+
+def _init_worker(node_id, rsa_keys, ntor_keys):
+    global _worker_identity
+    _worker_identity = (node_id, rsa_keys, ntor_keys)
+
+
+def _server_reply(handshake, data):
+    node_id, rsa_keys, ntor_keys = _worker_identity
+    return hs.server_reply(handshake, data, node_id, rsa_keys, ntor_keys)
+
+
+class HandshakeExecutor():
+    """
+    Bounded process pool for the handshakes of one node.
+    At most max_pending handshakes can be queued or running; past that, new
+    handshakes are rejected right away with an OnionOverloadError, instead of
+    waiting behind the others.
+
+    Params:
+        - node_id: "ip:port" of the node.
+        - rsa_keys, ntor_keys: keys of the node, sent once to each worker.
+        - max_workers: number of worker processes (default: one per core).
+        - max_pending: maximum number of handshakes queued or running.
+    """
+
+    def __init__(self, node_id, rsa_keys=None, ntor_keys=None,
+                 max_workers=None, max_pending=DEFAULT_MAX_PENDING):
+        self.max_pending = max_pending
+
+        self._executor = ProcessPoolExecutor(max_workers,
+                                             initializer=_init_worker,
+                                             initargs=(node_id, rsa_keys, ntor_keys))
+        self._lock = Lock()
+        self._pending = 0
+        self.closed = False
+
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+
+    @property
+    def depth(self):
+        """ number of handshakes queued or running """
+        with self._lock:
+            return self._pending
+
+    def submit(self, handshake, data):
+        """
+        Schedules the node side of a handshake (see handshake.server_reply).
+        Returns a Future of (shared key, reply).
+        Raises OnionOverloadError if the queue is full or the executor is closed.
+        """
+        with self._lock:
+            if self.closed or self._pending >= self.max_pending:
+                self._rejected += 1
+                raise OnionOverloadError("ERROR    Too many pending handshakes")
+            self._pending += 1
+
+        start = time.perf_counter()
+        future = self._executor.submit(_server_reply, handshake, data)
+        future.add_done_callback(lambda f: self._handshake_done(f, start))
+        return future
+
+    def server_reply(self, handshake, data, timeout=None):
+        """ same as handshake.server_reply, run in a worker process; waits for the result. """
+        return self.submit(handshake, data).result(timeout)
+
+    def metrics(self):
+        """
+        returns a dict with the current queue depth, the number of handshakes
+        completed, failed and rejected, and their latency (from submission to
+        result, in seconds)
+        """
+        with self._lock:
+            done = self._completed + self._failed
+            return {
+                'queue_depth': self._pending,
+                'max_pending': self.max_pending,
+                'completed': self._completed,
+                'failed': self._failed,
+                'rejected': self._rejected,
+                'mean_latency': self._total_latency / done if done else 0.0,
+                'max_latency': self._max_latency,
+            }
+
+    def close(self):
+        """ stops the worker processes; queued handshakes are dropped. """
+        with self._lock:
+            self.closed = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _handshake_done(self, future, start):
+        latency = time.perf_counter() - start
+        with self._lock:
+            self._pending -= 1
+            if future.cancelled() or future.exception() is not None:
+                self._failed += 1
+            else:
+                self._completed += 1
+            self._total_latency += latency
+            self._max_latency = max(self._max_latency, latency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+"""
+Defines the KeyPool, which pre-generates RSA key pairs in worker processes so
+that nodes do not generate their keys serially, on one core, at startup.
+"""
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from threading import Condition
+
+import encryption as enc
+
+DEFAULT_TARGET_DEPTH = 4
+
+
+class KeyPool():
+    """
+    Keeps up to target_depth RSA key pairs ready, generated in parallel by a
+    ProcessPoolExecutor. Whenever a key pair is handed out, a new one is
+    scheduled. If no key pair is ready, the caller waits for one that is being
+    generated; if the pool is empty, the key pair is generated inline.
+
+    Params:
+        - target_depth: number of key pairs to keep ready (or being generated).
+        - key_size: size of the RSA modulus, in bits.
+        - max_workers: number of worker processes (default: one per core).
+        - max_keys: total number of key pairs the pool generates, e.g. the
+          number of keys that will be taken (default: no limit).
+    """
+
+    def __init__(self,
+                 target_depth=DEFAULT_TARGET_DEPTH,
+                 key_size=enc.DEFAULT_RSA_KEY_SIZE,
+                 max_workers=None,
+                 max_keys=None):
+        self.target_depth = target_depth
+        self.key_size = key_size
+        self.max_keys = max_keys
+
+        self._executor = ProcessPoolExecutor(max_workers)
+        self._keys = collections.deque()
+        self._pending = 0
+        self._scheduled = 0
+        self._lock = Condition()
+        self.closed = False
+
+        self._refill()
+
+    @property
+    def depth(self):
+        """ number of key pairs ready to be handed out """
+        with self._lock:
+            return len(self._keys)
+
+    def get_keys(self, wait=True):
+        """
+        Returns an RSA key pair (see encryption.get_private_key_rsa), taken
+        from the pool if one is ready, generated inline otherwise.
+        wait: if no key pair is ready, wait for one being generated in the pool.
+        """
+        with self._lock:
+            if wait:
+                self._lock.wait_for(lambda: self._keys or self._pending == 0 or self.closed)
+            rsa_keys = self._keys.popleft() if self._keys else None
+        self._refill()
+        if rsa_keys is None:
+            rsa_keys = enc.get_private_key_rsa(self.key_size)
+        return rsa_keys
+
+    def close(self):
+        """ stops the worker processes; key pairs still being generated are dropped. """
+        with self._lock:
+            self.closed = True
+            self._lock.notify_all()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _refill(self):
+        """
+        schedules key generation until the pool is back at its target depth,
+        or until max_keys key pairs have been scheduled.
+        """
+        with self._lock:
+            while not self.closed and len(self._keys) + self._pending < self.target_depth:
+                if self.max_keys is not None and self._scheduled >= self.max_keys:
+                    break
+                future = self._executor.submit(enc.get_private_key_rsa, self.key_size)
+                self._pending += 1
+                self._scheduled += 1
+                future.add_done_callback(self._key_ready)
+
+    def _key_ready(self, future):
+        with self._lock:
+            self._pending -= 1
+            if future.cancelled():
+                pass
+            elif future.exception() is not None:
+                print("ERROR    Could not generate RSA keys in the key pool:", future.exception())
+            else:
+                self._keys.append(future.result())
+            self._lock.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
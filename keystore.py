@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+"""
+Defines the KeyStore, where nodes keep their RSA identity between restarts.
+"""
+import json
+import mmap
+import os
+import time
+
+import encryption as enc
+import handshake as hs
+
+DEFAULT_KEYSTORE_DIRECTORY = "keystore"
+
+
+class KeyStore():
+    """
+    On-disk store of node identities, keyed by (ip, port).
+    Each identity is a JSON file in the given directory:
+        <ip>_<port>.json : {"created": timestamp, "rsa_keys": {...}, "ntor_keys": {...}}
+
+    A stored identity is reused until it is rotated explicitly (rotate), or
+    until it is older than max_key_age seconds, if given.
+    """
+
+    def __init__(self, directory=DEFAULT_KEYSTORE_DIRECTORY, max_key_age=None):
+        self.directory = directory
+        self.max_key_age = max_key_age
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get_keys(self, ip, port, generate=enc.get_private_key_rsa):
+        """
+        Returns the stored RSA keys of the node at ip:port. If there are none,
+        or if the rotation policy says they are too old, new keys are made by
+        calling generate() and stored.
+        """
+        return self._get(ip, port, 'rsa_keys', generate)
+
+    def get_ntor_keys(self, ip, port, generate=hs.generate_ntor_keys):
+        """ same as get_keys, for the static X25519 keys of the ntor handshake. """
+        return self._get(ip, port, 'ntor_keys', generate)
+
+    def save_keys(self, ip, port, rsa_keys):
+        """ stores the RSA keys of the node at ip:port, replacing the old ones. """
+        entry = self._load(ip, port) or {'created': time.time()}
+        entry['rsa_keys'] = rsa_keys
+        self._save(ip, port, entry)
+
+    def _get(self, ip, port, name, generate):
+        entry = self._load(ip, port)
+        if entry is None or self._expired(entry):
+            entry = {'created': time.time()}
+        if name not in entry:
+            entry[name] = generate()
+            self._save(ip, port, entry)
+        return entry[name]
+
+    def _save(self, ip, port, entry):
+        """ writes an identity, replacing the old file atomically. """
+        path = self._path(ip, port)
+        tmp_path = path + ".tmp"
+        # the file holds private keys: only the owner may read it
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def rotate(self, ip, port):
+        """ drops the stored identity of ip:port; new keys are made on the next get_keys. """
+        try:
+            os.remove(self._path(ip, port))
+        except FileNotFoundError:
+            pass
+
+    def _expired(self, entry):
+        if self.max_key_age is None:
+            return False
+        return time.time() - entry['created'] > self.max_key_age
+
+    def _path(self, ip, port):
+        return os.path.join(self.directory, "{}_{}.json".format(ip, port))
+
+    def _load(self, ip, port):
+        """ reads a stored identity, memory-mapping the file where possible. """
+        try:
+            with open(self._path(ip, port), 'rb') as f:
+                try:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        return json.loads(mapped[:])
+                except (ValueError, OSError):
+                    # empty file, or a file system that can't be mapped
+                    return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError:
+            print("ERROR    Stored keys of {}:{} are corrupted; generating new ones".format(ip, port))
+            return None
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+"""
+Long-lived connections between the nodes of the onion network.
+
+A node keeps one outbound link per neighbour (ip, port) it sends packets to,
+opened the first time it is needed and shared by every circuit going through
+that neighbour, and one inbound link per connection accepted from a client
+or a previous node. Packets arriving on an outbound link come from the next
+node of a circuit; packets arriving on an inbound link come from the
+previous one.
+"""
+import socket
+from threading import Event, Lock
+
+import packet_manager as pm
+
+CONNECT_TIMEOUT = 10
+
+# keepalive probes, where the platform lets them be configured
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+
+
+def configure_socket(sock):
+    """ disables Nagle's algorithm (cells are sent as soon as they are ready) and enables keepalive """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+                          ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                          ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+class Link():
+    """
+    A connection to a neighbour, carrying the packets of many circuits.
+    Packets can be sent from any thread; they are read cell by cell, by one
+    thread only (see read_cell).
+    """
+
+    def __init__(self, sock, address, outbound):
+        configure_socket(sock)
+        self.sock = sock
+        self.address = address
+        self.outbound = outbound
+        self._reader = pm.new_cell_reader(sock)
+        self._send_lock = Lock()
+        self.closed = False
+
+    def send(self, packet):
+        """ sends the cells of a packet; raises OSError if the link is broken """
+        with self._send_lock:
+            pm.send_packet(self.sock, packet)
+
+    def read_cell(self):
+        """
+        returns the next cell received on the link (see pm.recv_cell), or
+        None once the link is closed
+        """
+        try:
+            return pm.recv_cell(self._reader)
+        except OSError:
+            return None
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class LinkManager():
+    """
+    The links of a node.
+    start_reader(link) is called once for every new link, to start reading
+    its packets (see node_switchboard.NodeSwitchboard).
+    The manager also remembers the inbound link each circuit comes from, to
+    send the packets of the circuit back.
+    """
+
+    def __init__(self, start_reader, connect_timeout=CONNECT_TIMEOUT):
+        self.start_reader = start_reader
+        self.connect_timeout = connect_timeout
+        self._lock = Lock()
+        self._outbound = {}
+        self._inbound = set()
+        self._circuits = {}
+        # neighbours being connected to: address -> Event set once it is done
+        self._connecting = {}
+
+    def get_link(self, ip, port):
+        """
+        returns the outbound link to (ip, port), connecting to it if there is none yet
+        while a neighbour is being connected to, the links to the others can be used,
+        and the other callers wanting that neighbour wait for the same connection
+        raises OSError if the neighbour cannot be reached
+        """
+        address = (ip, int(port))
+        with self._lock:
+            link = self._outbound.get(address)
+            if link is not None and not link.closed:
+                return link
+            connected = self._connecting.get(address)
+            connecting = connected is None
+            if connecting:
+                connected = self._connecting[address] = Event()
+        if not connecting:
+            connected.wait(self.connect_timeout)
+            with self._lock:
+                link = self._outbound.get(address)
+            if link is None or link.closed:
+                raise ConnectionError("could not connect to {}:{}".format(*address))
+            return link
+
+        try:
+            sock = socket.create_connection(address, self.connect_timeout)
+            sock.settimeout(None)
+            link = Link(sock, address, outbound=True)
+            with self._lock:
+                self._outbound[address] = link
+            self.start_reader(link)
+        finally:
+            with self._lock:
+                del self._connecting[address]
+            connected.set()
+        return link
+
+    def accept(self, sock, address):
+        """ adds an inbound link for a connection accepted by the node, and returns it """
+        link = Link(sock, address, outbound=False)
+        with self._lock:
+            self._inbound.add(link)
+        self.start_reader(link)
+        return link
+
+    def link_closed(self, link):
+        """ forgets a link, and the circuits coming from it """
+        link.close()
+        with self._lock:
+            if link.outbound:
+                if self._outbound.get(link.address) is link:
+                    del self._outbound[link.address]
+            else:
+                self._inbound.discard(link)
+                for circID in [circID for circID, other in self._circuits.items() if other is link]:
+                    del self._circuits[circID]
+
+    def set_circuit_link(self, circID, link):
+        """ the packets of circuit circID are sent back on link, the inbound link it came from """
+        with self._lock:
+            self._circuits[circID] = link
+
+    def get_circuit_link(self, circID):
+        """ returns the link circuit circID comes from, or None """
+        with self._lock:
+            return self._circuits.get(circID)
+
+    def remove_circuit(self, circID):
+        with self._lock:
+            self._circuits.pop(circID, None)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'outbound_links': len(self._outbound),
+                'inbound_links': len(self._inbound),
+                'circuits': len(self._circuits),
+            }
+
+    def close(self):
+        """ closes every link """
+        with self._lock:
+            links = list(self._outbound.values()) + list(self._inbound)
+            self._outbound.clear()
+            self._inbound.clear()
+            self._circuits.clear()
+        for link in links:
+            link.close()
@@ -1,6 +1,11 @@
 import argparse
+import contextlib
 import onion_client as oc
 import node
+import encryption as enc
+import handshake as hs
+import compression as cmp
+from key_pool import KeyPool
 import webbrowser
 import os
 
@@ -24,6 +29,18 @@ if __name__ == "__main__":
                         help='Requested url')
     parser.add_argument('-n', '--node-count', type=int, action='store', dest='node_count', default=3,
                         help='Number of nodes in circuit.')
+    parser.add_argument('-c', '--relay-crypto', action='store', dest='relay_crypto', default=enc.FERNET_MODE,
+                        choices=[enc.FERNET_MODE, enc.STREAM_MODE],
+                        help='Encryption used on the circuit.')
+    parser.add_argument('-k', '--handshake', action='store', dest='handshake', default=hs.RSA_HANDSHAKE,
+                        choices=[hs.RSA_HANDSHAKE, hs.NTOR_HANDSHAKE],
+                        help='Circuit handshake offered by the nodes.')
+    parser.add_argument('-z', '--compression', action='store', dest='compression', default=None,
+                        choices=list(cmp.COMPRESSIONS),
+                        help='Compression of the answers sent back by the exit node.')
+    parser.add_argument('-e', '--engine', action='store', dest='engine', default=node.THREAD_ENGINE,
+                        choices=list(node.ENGINES),
+                        help='Engine of the nodes: a thread per connection, or an asyncio event loop.')
 
     args = parser.parse_args()
     print("Creating onion routing with {} nodes".format(args.node_count))
@@ -34,19 +51,26 @@ if __name__ == "__main__":
     dir = node.DirectoryNode(dir_ip, dir_port)
     dir.start()
 
-    node1 = node.OnionNode('127.0.0.1', 14440)
+    # generate the RSA keys of the three nodes in parallel (ntor nodes need none)
+    if args.handshake == hs.RSA_HANDSHAKE:
+        key_pool_context = KeyPool(target_depth=3, max_keys=3)
+    else:
+        key_pool_context = contextlib.nullcontext()
+    with key_pool_context as key_pool:
+        node1 = node.OnionNode('127.0.0.1', 14440, key_pool, handshake=args.handshake, engine=args.engine)
+        node2 = node.OnionNode('127.0.0.1', 8880, key_pool, handshake=args.handshake, engine=args.engine)
+        node3 = node.OnionNode('127.0.0.1', 55610, key_pool, handshake=args.handshake, engine=args.engine)
+
     node1.connect(dir_ip, dir_port)
     node1.start()
 
-    node2 = node.OnionNode('127.0.0.1', 8880)
     node2.connect(dir_ip, dir_port)
     node2.start()
 
-    node3 = node.OnionNode('127.0.0.1', 55610)
     node3.connect(dir_ip, dir_port)
     node3.start()
 
-    client = oc.OnionClient('127.0.0.1', 54320, args.node_count)
+    client = oc.OnionClient('127.0.0.1', 54320, args.node_count, args.relay_crypto, args.compression)
     client.connect(dir_ip, dir_port)
     #client.start()
 
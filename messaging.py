@@ -4,7 +4,7 @@ Module where message format, encoding and decoding is defined.
 """
 
 import json
-from json import JSONEncoder, JSONDecodeError
+from json import JSONEncoder, JSONDecoder, JSONDecodeError
 
 import collections
 IpInfo = collections.namedtuple("IpInfo", ["ip", "port"])
@@ -17,6 +17,8 @@ class JsonConversionMixin(object):
     The class :must: have a *to_dict(self)* method, and a constructor
     accepting all required object fields as keyword arguments.
     """
+    __slots__ = ()
+
     @classmethod
     def from_json_string(cls, string):
         """
@@ -27,16 +29,27 @@ class JsonConversionMixin(object):
         return cls(**kwargs)
 
     @classmethod
-    def is_valid_string(cls, string):
+    def parse(cls, string):
+        """
+        Same as from_json_string, but returns None if the string is not a
+        valid instance of the class.
+        """
         try:
-            bob = cls.from_json_string(string)
-            return True
+            return cls.from_json_string(string)
         except JSONDecodeError as err:
             # print("Error: Provided string is not a valid JSON.", err)
-            return False
+            return None
         except TypeError as err:
             # print("Error: JSON does not match required arguments:", err)
-            return False
+            return None
+
+    @classmethod
+    def is_valid_string(cls, string):
+        """
+        NOTE: use parse() to validate a string and keep the instance, instead
+        of parsing it twice.
+        """
+        return cls.parse(string) is not None
 
     def to_json_string(self):
         """
@@ -47,6 +60,8 @@ class JsonConversionMixin(object):
 
 class ToDictMixin(object):
     """ Mixin for converting an object to a dictionary """
+    __slots__ = ()
+
     def to_dict(self):
         return self._traverse_dict(self.__dict__)
 
@@ -69,22 +84,87 @@ class ToDictMixin(object):
             return value
 
 
-class OnionMessage(ToDictMixin, JsonConversionMixin):
+def _encode_default(value):
+    """ converts the values that json can not encode by itself """
+    if isinstance(value, ToDictMixin):
+        return value.to_dict()
+    elif hasattr(value, '__dict__'):
+        return value.__dict__
+    raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+
+
+# created once, instead of on every message
+_ENCODER = JSONEncoder(default=_encode_default)
+_DECODER = JSONDecoder()
+
+
+def _to_ip_info(value):
+    """ [ip, port] lists (IpInfos, once decoded from JSON) become IpInfos again """
+    if isinstance(value, list) and len(value) == 2:
+        return IpInfo(*value)
+    return value
+
+
+def _message_field(name):
+    """ property for a field of OnionMessage; assigning it drops the cached serialization """
+    attribute = "_" + name
+
+    def get(self):
+        return getattr(self, attribute)
+
+    def set(self, value):
+        setattr(self, attribute, value)
+        self._json_string = None
+        self._bytes = None
+
+    return property(get, set)
+
+
+class OnionMessage(JsonConversionMixin):
     """
     Represents a message in the onion routing network.
+
+    The message is serialized at most once: its JSON string and bytes are
+    cached until one of its fields is assigned again. (Changing a field in
+    place, e.g. a key of a data dict, does not drop the cache.)
     """
     HEADER = "ONION ROUTING G12"
 
+    __slots__ = ("_header", "_source", "_destination", "_data", "_json_string", "_bytes")
+
+    header = _message_field("header")
+    source = _message_field("source")
+    destination = _message_field("destination")
+    data = _message_field("data")
+
     def __init__(self,
                  source: IpInfo = None,
                  destination: IpInfo = None,
                  data=None,
                  header=HEADER,
                  ):
-        self.header = header
-        self.source = source
-        self.destination = destination
-        self.data = data
+        self._header = header
+        self._source = _to_ip_info(source)
+        self._destination = _to_ip_info(destination)
+        self._data = data
+        self._json_string = None
+        self._bytes = None
+
+    def to_dict(self):
+        return {
+            'header': self._header,
+            'source': self._source,
+            'destination': self._destination,
+            'data': self._data,
+        }
+
+    def to_json_string(self):
+        """
+        Serializes the object into a JSON-formatted string
+        """
+        if self._json_string is None:
+            self._json_string = _ENCODER.encode(self.to_dict())
+        return self._json_string
 
     def __repr__(self):
         """
@@ -93,12 +173,31 @@ class OnionMessage(ToDictMixin, JsonConversionMixin):
         return self.to_json_string()
 
     def to_bytes(self):
-        return str(self).encode()
+        if self._bytes is None:
+            self._bytes = self.to_json_string().encode()
+        return self._bytes
+
+    @classmethod
+    def from_json_string(cls, string):
+        """
+        Transforms the given String or bytes into a message
+        string: - a valid JSON with all required fields
+        """
+        if isinstance(string, (bytes, bytearray)):
+            string = string.decode()
+        return cls(**_DECODER.decode(string))
 
     @classmethod
     def from_json(cls, json_object):
-        string = json.dumps(json_object)
-        return cls.from_json_string(string)
+        """ creates a message from an already parsed JSON object """
+        return cls(**json_object)
 
     def __eq__(self, value):
-        return str(self) == str(value)
+        if not isinstance(value, OnionMessage):
+            return NotImplemented
+        return (self._header == value._header and
+                self._source == value._source and
+                self._destination == value._destination and
+                self._data == value._data)
+
+    __hash__ = None
@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 
+import asyncio
 import collections
 import sys
 import socket
@@ -16,24 +17,103 @@ import circuit_tables as ct
 from relaying import IntermediateRelay
 from workers import *
 import encryption as enc
+import framing
+import handshake as hs
+from handshake_executor import HandshakeExecutor, DEFAULT_MAX_PENDING
 import node_switchboard as ns
+from links import LinkManager
+from worker_pool import WorkerPool, DEFAULT_MAX_QUEUED, DEFAULT_MAX_WAIT
+import async_node
+from errors import OnionOverloadError
 import packet_manager as pm
 
 DEFAULT_TIMEOUT = 1  # timeout value for all blocking socket operations.
 
+# engines of the node: a thread per link, or coroutines on one event loop (see async_node.py)
+THREAD_ENGINE = "threads"
+ASYNCIO_ENGINE = "asyncio"
+ENGINES = (THREAD_ENGINE, ASYNCIO_ENGINE)
+
 
 class OnionNode(threading.Thread):
     """A Node in the onion-routing network"""
 
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, key_pool=None, keystore=None, handshake=hs.RSA_HANDSHAKE,
+                 handshake_workers=None, max_pending_handshakes=DEFAULT_MAX_PENDING,
+                 engine=THREAD_ENGINE, connection_workers=None,
+                 max_queued_connections=DEFAULT_MAX_QUEUED, keys=None,
+                 reuse_port=False, circuit_ids=ns.CIRCUIT_IDS,
+                 max_connection_wait=DEFAULT_MAX_WAIT):
+        """
+        key_pool: optional key_pool.KeyPool to take the RSA keys from, instead
+        of generating them here.
+        keystore: optional keystore.KeyStore; the node reuses the keys it
+        stored there for ip:port, and only makes new ones if it has none.
+        handshake: circuit handshake offered by the node in its descriptor,
+        hs.RSA_HANDSHAKE or hs.NTOR_HANDSHAKE. An ntor node has no RSA keys.
+        handshake_workers: number of processes doing the handshakes of the
+        node (default: one per core); 0 to do them in the connection threads.
+        max_pending_handshakes: circuits are refused while that many
+        handshakes are waiting (see handshake_executor.HandshakeExecutor).
+        engine: THREAD_ENGINE (a thread per link and per exit request) or
+        ASYNCIO_ENGINE (one event loop, see async_node.py).
+        connection_workers: with the thread engine, number of threads serving
+        the accepted connections (see worker_pool.WorkerPool); None for a new
+        thread per connection. A worker serves one connection until it is
+        closed, so this is also the number of connections served at once.
+        max_queued_connections: accepted connections are closed right away
+        while that many are waiting for a free connection worker.
+        max_connection_wait: seconds an accepted connection can wait for a
+        free connection worker; it is closed after that, so that its
+        neighbour is refused instead of left unanswered (None: no limit).
+        keys: keys the node already has (its RSA keys, or the ntor keys of an
+        ntor node), e.g. those of the ShardedNode it is a shard of; key_pool
+        and keystore are not used then.
+        reuse_port: bind the port with SO_REUSEPORT, so that other processes
+        can accept the connections of the node too (see sharded_node.py).
+        circuit_ids: (lowest, highest) circID given by the node to the
+        circuits it extends.
+        """
         super().__init__()
         self.ip = ip
         self.port = port
+        self.handshake = handshake
+        self.handshake_workers = handshake_workers
+        self.max_pending_handshakes = max_pending_handshakes
+        self.engine = engine
+        self.connection_workers = connection_workers
+        self.max_queued_connections = max_queued_connections
+        self.max_connection_wait = max_connection_wait
+        self.reuse_port = reuse_port
+        self.circuit_ids = circuit_ids
+        self.handshake_executor = None
+        self.link_manager = None
+        self.connection_pool = None
 
         self.network_list = {}
 
-        # Create a public key, private key and modulus for key exchange
-        self.rsa_keys = enc.get_private_key_rsa()
+        self.rsa_keys = None
+        self.ntor_keys = None
+        if handshake == hs.NTOR_HANDSHAKE:
+            if keys is not None:
+                self.ntor_keys = keys
+            elif keystore is not None:
+                self.ntor_keys = keystore.get_ntor_keys(ip, port)
+            else:
+                self.ntor_keys = hs.generate_ntor_keys()
+        else:
+            # Create a public key, private key and modulus for key exchange
+            if key_pool is not None:
+                generate_keys = key_pool.get_keys
+            else:
+                generate_keys = enc.get_private_key_rsa
+
+            if keys is not None:
+                self.rsa_keys = keys
+            elif keystore is not None:
+                self.rsa_keys = keystore.get_keys(ip, port, generate_keys)
+            else:
+                self.rsa_keys = generate_keys()
 
         self.circuit_table = ct.circuit_table()
         self.node_key_table = ct.node_key_table()
@@ -51,50 +131,120 @@ class OnionNode(threading.Thread):
         self.running = True
 
         if self.initialized:
-            with socket.socket() as receiving_socket:
-                receiving_socket.settimeout(DEFAULT_TIMEOUT)
-                receiving_socket.bind((self.ip, self.port))
-                receiving_socket.listen()
-                while self.running:
-                    # Wait for the next message to arrive.
-                    try:
-                        client_socket, address = receiving_socket.accept()
-                        client_thread = ns.NodeSwitchboard(client_socket, address,
-                                                           self.circuit_table,
-                                                           self.node_key_table,
-                                                           self.node_relay_table,
-                                                           self.rsa_keys, self.ip, self.port)
-                        client_thread.start()
-                    except socket.timeout:
-                        continue
+            if self.handshake_workers != 0:
+                self.handshake_executor = HandshakeExecutor(
+                    "{}:{}".format(self.ip, self.port),
+                    self.rsa_keys, self.ntor_keys,
+                    self.handshake_workers, self.max_pending_handshakes)
+            if self.engine == ASYNCIO_ENGINE:
+                asyncio.run(async_node.serve(self, DEFAULT_TIMEOUT))
+            else:
+                self._serve()
+            if self.handshake_executor is not None:
+                self.handshake_executor.close()
         else:
             print("ERROR    Node not initialized. Call node.connect() first")
 
+    def _serve(self):
+        """ thread engine: accepts the connections until the node is stopped """
+        # one long-lived link per neighbour, each read by a NodeSwitchboard
+        self.link_manager = LinkManager(self._start_switchboard)
+        if self.connection_workers is not None:
+            self.connection_pool = WorkerPool(self._serve_connection,
+                                              self.connection_workers,
+                                              self.max_queued_connections,
+                                              "{}:{}".format(self.ip, self.port),
+                                              self.max_connection_wait,
+                                              self._refuse_connection)
+        with socket.socket() as receiving_socket:
+            receiving_socket.settimeout(DEFAULT_TIMEOUT)
+            if self.reuse_port:
+                receiving_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            receiving_socket.bind((self.ip, self.port))
+            receiving_socket.listen()
+            while self.running:
+                if self.connection_pool is not None:
+                    self.connection_pool.expire()
+                # Wait for the next message to arrive.
+                try:
+                    client_socket, address = receiving_socket.accept()
+                    client_socket.settimeout(None)
+                except socket.timeout:
+                    continue
+                if self.connection_pool is None:
+                    self.link_manager.accept(client_socket, address)
+                    continue
+                try:
+                    self.connection_pool.submit((client_socket, address))
+                except OnionOverloadError:
+                    print("ERROR    Too many queued connections; connection from {}:{} refused\n".format(*address[:2]))
+                    client_socket.close()
+        self.link_manager.close()
+        if self.connection_pool is not None:
+            self.connection_pool.close(DEFAULT_TIMEOUT)
+
+    def _serve_connection(self, connection):
+        """ connection worker: serves an accepted connection until it is closed """
+        client_socket, address = connection
+        self.link_manager.accept(client_socket, address)
+
+    def _refuse_connection(self, connection):
+        """ closes an accepted connection that waited too long for a connection worker """
+        client_socket, address = connection
+        print("ERROR    No free connection worker; connection from {}:{} refused\n".format(*address[:2]))
+        client_socket.close()
+
+    def _start_switchboard(self, link):
+        """ starts reading the packets of a new link of the node """
+        switchboard = ns.NodeSwitchboard(link, self.link_manager,
+                                         self.circuit_table,
+                                         self.node_key_table,
+                                         self.node_relay_table,
+                                         self.rsa_keys, self.ip, self.port,
+                                         self.ntor_keys,
+                                         self.handshake_executor,
+                                         self.circuit_ids)
+        if self.connection_pool is None or link.outbound:
+            switchboard.start()
+        else:
+            # accepted by _serve_connection: read in the current worker thread
+            switchboard.run()
+
     def connect(self, dir_ip, dir_port):
         self._contact_dir_node(dir_ip, dir_port)
         self.initialized = True
 
+    def descriptor(self):
+        """
+        public information the clients need to do a handshake with this node,
+        published in the network list of the directory node
+        """
+        if self.handshake == hs.NTOR_HANDSHAKE:
+            return {'handshake': hs.NTOR_HANDSHAKE, 'ntor_key': self.ntor_keys['public']}
+        return {'public_exp': self.rsa_keys['public'], 'modulus': self.rsa_keys['modulus']}
+
     def _contact_dir_node(self, dir_ip, dir_port):
         """
             make the node known to the directory node
             contact directory node with a dir_update packet
             give info:
                 ip, port (known through socket)
-                public rsa keys of this node
+                descriptor of this node (public keys for the handshake)
             dir node answers with a list of all nodes in onion network
 
         """
 
-        pkt = pm.new_dir_packet("dir_update", (self.ip, self.port), self.rsa_keys)
+        pkt = pm.new_dir_packet("dir_update", (self.ip, self.port), self.descriptor())
         self._create(dir_ip, dir_port)
         self._send(pkt)
 
         # wait for a response packet; 3 tries
         tries = 3
         rec_bytes = 0
+        reader = framing.FrameReader(self.client_socket)
         while tries != 0:
             try:
-                rec_bytes = self.client_socket.recv(BUFFER_SIZE)
+                rec_bytes = reader.read_frame()
                 break
             except socket.timeout:
                 tries -= 1
@@ -105,6 +255,10 @@ class OnionNode(threading.Thread):
                     return
                 continue
 
+        if rec_bytes is None:
+            print("ERROR    Connection closed by the directory")
+            self._close()
+            return
         message = json.loads(rec_bytes.decode())
 
         if message['type'] != "dir":
@@ -138,7 +292,7 @@ class OnionNode(threading.Thread):
 
     def _send(self, message_str):
         message_bytes = message_str.encode('utf-8')
-        self.client_socket.sendall(message_bytes)
+        framing.send_frame(self.client_socket, message_bytes)
 
     def _close(self):
         self.client_socket.close()
@@ -156,7 +310,8 @@ class DirectoryNode(Thread):
         Contains information on all nodes
         each node has the following information:
             - ip address : receiving port
-            - public rsa key pair (e, n) = (public exp, modulus) to be used for key exchange
+            - public rsa key pair (e, n) = (public exp, modulus) to be used for key exchange,
+              or the handshake it uses and its public ntor key (see handshake.py)
 
         the directory node can do the following:
             - answer:  sends the network_info.json file to client
@@ -184,7 +339,7 @@ class DirectoryNode(Thread):
         json.dump(new, f)
         f.close()
 
-    def write_to_json(self, ip, port, public_exp, modulus):
+    def write_to_json(self, ip, port, descriptor):
         try:
             with open('network_list.json', 'r') as f:
                 data = json.load(f)
@@ -192,26 +347,20 @@ class DirectoryNode(Thread):
             print("ERROR    network_list.json does not exist. Use create_json to create it\n")
             return
 
-        # if a node is already in the list, then it is trying to update its RSA info
-        updated = 0
-        test = len(data['nodes in network'])
+        new_entry = {'ip': ip, 'port': port}
+        new_entry.update(descriptor)
 
-        if len(data['nodes in network']) > 0:
-            for n in data['nodes in network']:
-                if n['ip'] == ip and n['port'] == port:
-                    n['public_exp'] = public_exp
-                    n['modulus'] = modulus
-                    updated = 1
+        # if a node is already in the list, then it is trying to update its descriptor
+        updated = 0
+        nodes = data['nodes in network']
+        for index, n in enumerate(nodes):
+            if n['ip'] == ip and n['port'] == port:
+                nodes[index] = new_entry
+                updated = 1
 
         # node is new: add it to network file
         if updated == 0:
-            new_entry = {
-                'ip': ip,
-                'port': port,
-                'public_exp': public_exp,
-                'modulus': modulus
-            }
-            data['nodes in network'].append(new_entry)
+            nodes.append(new_entry)
             updated = 1
 
         with open('network_list.json', 'w') as f:
@@ -242,7 +391,9 @@ class DirectoryNode(Thread):
                     client_socket, client_address = recv_socket.accept()
                     with client_socket:  # Closes it automatically.
                         client_socket.settimeout(DEFAULT_TIMEOUT)
-                        rec_bytes = client_socket.recv(1024)
+                        rec_bytes = framing.recv_frame(client_socket)
+                        if rec_bytes is None:
+                            continue
                         message = json.loads(rec_bytes.decode())
 
                         if message['type'] != "dir":
@@ -253,14 +404,16 @@ class DirectoryNode(Thread):
                         updated = 0
                         if message['command'] == "dir_update":
                             print("GOT A CONNECTION FROM", client_address, "(NEW NODE)")
-                            updated = self.write_to_json(message['ip'], message['port'], message['public_exp'], message['modulus'])
+                            descriptor = {k: v for k, v in message.items()
+                                          if k not in ('type', 'command', 'ip', 'port')}
+                            updated = self.write_to_json(message['ip'], message['port'], descriptor)
                         else:
                             print("GOT A CONNECTION FROM", client_address, "(ONION CLIENT)")
 
                         pkt = pm.new_dir_packet("dir_answer", updated, self.return_json())
                         message_bytes = pkt.encode('utf-8')
                         #client_socket.connect((ip, port))
-                        client_socket.sendall(message_bytes)
+                        framing.send_frame(client_socket, message_bytes)
                         client_socket.close()
 
                 except socket.timeout:
@@ -1,81 +1,179 @@
-import socket
+from concurrent.futures import CancelledError
+from concurrent.futures.process import BrokenProcessPool
 from threading import Thread
-import json
 import random
 from random import randint
 import string
 import encryption as enc
 import packet_manager as pm
 import get_request as gr
-import base64
+import handshake as hs
+import compression as cmp
+import flow_control as fc
+from errors import OnionOverloadError
 
 
 BUFFER_SIZE = 4096
 
+# (lowest, highest) circID given by a node to the circuits it extends
+CIRCUIT_IDS = (0, 10000)
+
+
+class AnswerFragments():
+    """
+    Turns the answer of a GET request, chunk by chunk, into the payloads of
+    its fragments on a stream (see pm.new_fragment).
+    The answer is compressed if the circuit negotiated it, unless the web
+    server already compressed it (see compression.py).
+    """
+
+    def __init__(self, compression, content_encoding=None, stream=0):
+        self.stream = stream
+        self.compressor = cmp.new_compressor(compression, content_encoding)
+        self.compressed = self.compressor is not None
+        self.seq = 0
+        self.size = 0
+        self.sent = 0
+
+    def next_fragment(self, chunk):
+        data = self.compressor.compress(chunk) if self.compressed else chunk
+        fragment = pm.new_fragment(self.stream, self.seq, data, compressed=self.compressed)
+        self.seq += 1
+        self.size += len(chunk)
+        self.sent += len(data)
+        return fragment
+
+    def last_fragment(self, failed=False):
+        """ failed: the answer was cut short; the client is told so (see pm.FRAGMENT_FAILED) """
+        if failed:
+            print("ERROR    The answer to the get request was cut short; sending it back as failed")
+        elif self.seq == 0:
+            print("ERROR    Could not complete get request; sending back an empty answer")
+        data = self.compressor.finish() if self.compressed else b''
+        self.sent += len(data)
+        return pm.new_fragment(self.stream, self.seq, data, last=True, compressed=self.compressed,
+                               failed=failed)
+
+    def fragments(self, chunks):
+        """
+        yields the fragments of the answer made of chunks, the last one
+        included; it is marked as failed if reading the chunks fails
+        """
+        try:
+            for chunk in chunks:
+                yield self.next_fragment(chunk)
+        except gr.REQUEST_ERRORS:
+            yield self.last_fragment(failed=True)
+            return
+        yield self.last_fragment()
+
+    async def fragments_async(self, chunks):
+        """ fragments, for the asynchronous iterator of chunks of gr.web_request_stream_async """
+        try:
+            async for chunk in chunks:
+                yield self.next_fragment(chunk)
+        except gr.REQUEST_ERRORS:
+            yield self.last_fragment(failed=True)
+            return
+        yield self.last_fragment()
+
+    def print_summary(self, url):
+        print("FORWARDED ANSWER FROM NETWORK:")
+        print(url, self.size, "bytes in", self.seq + 1, "fragments,", self.sent, "bytes sent\n")
+
 class NodeSwitchboard(Thread):
 
     """
-    class that is created when a node (node.py) accepts a connection from a socket.
+    class that is created for each link (links.Link) of a node (node.py): the
+    connections it accepts, and the connections it opens to its neighbours.
     it does the following, in order:
-        receives the packet from the connecting socket,
-        parses the packet and decides what to do with the data
-        creates and sends a new packet as appropriate
-        closes itself
+        receives the cells from the link, one after the other
+        routes each cell from its header: relay cells for the other nodes of a
+        circuit are sent on as soon as they are read, the cells of the packets
+        meant for this node are gathered until the packet is complete
+        parses those packets and decides what to do with the data
+        creates and sends new packets as appropriate, on the links of the node
+        closes the link once the neighbour closed it
+    cells from the previous node of a circuit arrive on inbound links, and
+    cells from the next node on outbound links; the cells of a circuit
+    are processed in the order they were sent.
+    the answer of an exit node can be made of several packets (see pm.new_fragment),
+    which are forwarded backwards one by one, as they arrive
     """
 
     def __init__(self,
-                 client_socket : socket,
-                 addr,
+                 link,
+                 link_manager,
                  circuit_table,
                  node_key_table,
                  node_relay_table,
-                 rsa_keys, ip, port):
-        super().__init__()
-        self.client_socket = client_socket
-        self.addr = addr
+                 rsa_keys, ip, port,
+                 ntor_keys=None,
+                 handshake_executor=None,
+                 circuit_ids=CIRCUIT_IDS):
+        super().__init__(daemon=True)
+        self.link = link
+        # links.LinkManager of the node, shared by all its switchboards
+        self.link_manager = link_manager
         self.circuit_table = circuit_table
         self.node_key_table = node_key_table
         self.node_relay_table = node_relay_table
         self.rsa_keys = rsa_keys
+        self.ntor_keys = ntor_keys
+        # handshake_executor.HandshakeExecutor of the node; handshakes are done inline if None
+        self.handshake_executor = handshake_executor
+        # range of the circIDs this node gives (see sharded_node.shard_circuit_ids)
+        self.circuit_ids = circuit_ids
         self.ip = ip
         self.port = port
+        # the packets meant for this node, whose cells are being received
+        self._packets = pm.PacketAssembler()
 
     def run(self):
-        message_bytes = self.client_socket.recv(BUFFER_SIZE)
-        message_json = message_bytes.decode('utf-8')
-        self._process_message(message_json)
-
-    def _send(self, message_str):
-        message_bytes = message_str.encode('utf-8')
-        self.client_socket.sendall(message_bytes)
-        self._close()
-
-    def _relay(self, message_str, ip, port):
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((ip, int(port)))
-        client_socket.sendall(message_str.encode('utf-8'))
-        # wait for a response packet; 3 tries
-        tries = 3
-        rec_bytes = 0
-        while tries != 0:
-            try:
-                rec_bytes = client_socket.recv(BUFFER_SIZE)
-                break
-            except socket.timeout:
-                tries -= 1
-                if tries == 0:
-                    print("ERROR    Timeout while waiting for confirmation packet [3 tries]\n")
-                    print("         Directory connection exiting. . .")
-                    self._close()
-                    return
-                continue
-        message_str = rec_bytes.decode('utf-8')
-        self._process_message(message_str)
-        #self._send(rec_bytes.decode('UTF-8'))
+        try:
+            while True:
+                cell = self.link.read_cell()
+                if cell is None or not self._dispatch(cell):
+                    break
+        finally:
+            self.link_manager.link_closed(self.link)
+
+    def _dispatch(self, cell):
+        """
+        processes a cell read from the link (see _process_cell)
+        returns False if the link must be closed (malformed cells); any other
+        error only drops the cell, and the packet of its circuit being received
+        """
+        try:
+            circID, command, length = pm.parse_cell_header(cell)
+        except ValueError:
+            print("ERROR    Received malformed cells\n")
+            return False
+        try:
+            self._process_cell(cell, circID, command, length)
+        except ValueError:
+            print("ERROR    Received malformed cells\n")
+            return False
+        except OSError as e:
+            print("ERROR    Could not forward packet of circuit", circID, ":", e, "\n")
+        except Exception as e:
+            print("ERROR    Could not process cell of circuit", circID, ":", repr(e), "\n")
+            self._packets.remove(circID)
+        return True
+
+    def _send_back(self, circID, packet):
+        """
+        sends a packet to the previous node of circuit circID
+        raises OSError if the link to it is closed
+        """
+        link = self.link_manager.get_circuit_link(circID)
+        if link is None:
+            raise ConnectionError("no link to the previous node of circuit {}".format(circID))
+        link.send(packet)
 
-    def _close(self):
-        #self.client_socket.shutdown(socket.SHUT_RDWR)
-        self.client_socket.close()
+    def _relay(self, packet, ip, port):
+        """ sends a packet to the next node, on the link to (ip, port) """
+        self.link_manager.get_link(ip, port).send(packet)
 
     def _generate_new_circID(self):
         # define a limit to how many circuits the node can be part of
@@ -88,153 +186,296 @@ class NodeSwitchboard(Thread):
 
         # generate a circID that is not in use in the node_relay_table
         while True:
-            circID = randint(0, 10000)
+            circID = randint(*self.circuit_ids)
             if self.node_relay_table.get_from_id(circID) == -1 and self.node_relay_table.get_dest_id(circID) == -1:
                 break
 
         return circID
 
-    def _process_message(self, json_object):
+    def _next_hop(self, circID):
+        """
+        returns (destID, ip, port): circuit circID on the link to its next node,
+        or None if the circuit has no next node
+        """
+        destID = self.node_relay_table.get_dest_id(circID)
+        if destID == -1:
+            return None
+        address = self.circuit_table.get_address(destID)
+        if address == -1:
+            return None
+        ip, port = address.split(':')
+        return destID, ip, int(port)
+
+    def _process_cell(self, cell, circID, command, length):
         """
-        parses the packet that was received, and acts accordingly
+        acts according to a cell that was received (see pm.parse_cell_header):
+        control packets are processed once all their cells are received, relay
+        cells are passed on at once (see _relay_forward and _relay_backward)
+        raises ValueError if the cell does not follow the previous cells of its circuit
         """
+        if command in pm.CONTROL_COMMANDS:
+            body = self._packets.add(circID, command, length, pm.cell_body(cell))
+            if body is not None:
+                self._process_control(pm.parse_packet(circID, command, body), from_next_hop=self.link.outbound)
+        elif command in pm.FORWARD_COMMANDS:
+            self._relay_forward(cell, circID, command, length)
+        else:
+            self._relay_backward(cell, circID, command, length)
 
-        message = json.loads(json_object)
-        if message['type'] == "relay":
-            self._process_relay(message)
-        elif message['type'] == "control":
-            self._process_control(message)
+    def _relay_forward(self, cell, circID, command, length):
+        """
+        a relay cell going forwards: decrypt one layer
+        a cell meant for this node is recognized once the layer is removed, and
+        gathered until its packet is complete (see _process_relay); the other
+        cells are sent along to the next node as they are, one by one
+        a Fernet layer covers a whole packet: on those circuits, the cells are
+        gathered before the layer is removed, and the packet is sent along
+        """
+        cipher = self.node_key_table.get_cipher(circID)
+        if cipher == -1:
+            print("ERROR    Received a", command, "cell of unknown circuit", circID, "; cell dropped\n")
+            return
+        # answers go back on the link the circuit was last used from
+        self.link_manager.set_circuit_link(circID, self.link)
+        if cipher.cell_layers:
+            decrypted_data = enc.decrypt_layer(pm.sealed_body(cell), cipher)
+            recognized_data = cipher.open(decrypted_data)
+            recognized = recognized_data is not None
+            if recognized:
+                recognized_data = self._packets.add(circID, command, length, recognized_data)
         else:
-            print("ERROR    Received message has invalid type\n")
+            body = self._packets.add(circID, command, length, pm.cell_body(cell))
+            if body is None:
+                return
+            decrypted_data = enc.decrypt_layer(body, cipher)
+            recognized_data = cipher.open(decrypted_data)
+            recognized = recognized_data is not None
+
+        if recognized:
+            # last layer removed: the payload is meant for this node
+            if recognized_data is not None:
+                self._process_relay(circID, command, recognized_data, cipher)
             return
 
-    def _process_relay(self, message):
-        # message is going forwards,  decrypt one layer
-        if message['command'] == "extend" or message['command'] == "relay_data":
-            key = self.node_key_table.get_key(message['circID'])
-            decrypted_payload = enc.decrypt_fernet(message['encrypted_data'], key)
-            if 'isDecrypted' in decrypted_payload:
-                if message['command'] == "extend":
-                    # message has extend command and managed to decrypt it
-                    # -> create a new control packet cmd=create, send to next node
-                    destID = self._generate_new_circID()
-                    self.node_relay_table.add_relay_entry(message['circID'], destID)
-                    payload = pm.new_payload(self.ip, self.port, decrypted_payload['data'])
-                    pkt = pm.new_control_packet(destID, "create", payload)
-
-                    #oli garbage code
-                    self.circuit_table.add_circuit_entry(decrypted_payload['ip'], decrypted_payload['port'], destID)
-                    self._relay(pkt, decrypted_payload['ip'], decrypted_payload['port'])
-                    #self._sendExtend(pkt, decrypted_payload['ip'], decrypted_payload['port'])
-                    #self._send(pkt, decrypted_payload['ip'], decrypted_payload['port'])
-                elif message['command'] == "relay_data":
-
-
-                    # fully decrypted a relay_data packet
-                    # -> node is an exit node; make a GET request, wait for answer,
-                    #    send encrypted answer back to connecting node using same key
-                    ans = base64.urlsafe_b64encode(gr.web_request(decrypted_payload['data'])).decode("UTF-8")
-                    
-                    if ans == '':
-                        print("ERROR    Could not complete get request; sending back gibberish")
-                        ans = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in
-                                      range(len(16)))
-
-                    # TODO: place address of website here
-                    payload = pm.new_relay_payload(0, 0, ans)
-
-                    print("FORWARDING MESSAGE TO NETWORK:")
-                    print(json.dumps(payload, indent='\t'), "\n")
-
-                    encrypted_payload = enc.encrypt_fernet(payload, key)
-
-                    pkt = pm.new_relay_packet(message['circID'], "relay_ans", encrypted_payload)
-                    ip, port = self.circuit_table.get_address(message['circID']).split(':')
-
-                    #oli garbage
-                    self._send(pkt)
-                    #self._relay(pkt, ip, port)
-
-            else:
-                # could not decrypt payload, meant for a node further along
-                # -> get next node addr from table, replace circID, remove one layer, and send packet along
-
-                if(message['command'] != "extend"):
-                    print("FORWARDING MESSAGE IN CIRCUIT:")
-                    print(json.dumps(message, indent='\t'), "\n")
-
-                destID = self.node_relay_table.get_dest_id(message['circID'])
-                message['circID'] = destID
-                message['encrypted_data'] = decrypted_payload
-                ip, port = self.circuit_table.get_address(message['circID']).split(':')
-                
-                #oli garbage
-                #self._send(message)
-                self._relay(json.dumps(message), ip, int(port))
-
-        # message is going backwards, encrypt one layer
-        elif message['command'] == "extended" or message['command'] == "relay_ans":
-            # if A -> B and message was received from B and goes backwards, send it to A
-            fromID = self.node_relay_table.get_from_id(message['circID'])
-            key = self.node_key_table.get_key(fromID)
-            encrypted_payload = enc.encrypt_fernet(message['encrypted_data'], key)
-
-            pkt = pm.new_relay_packet(fromID, message['command'], encrypted_payload)
-            ip, port = self.circuit_table.get_address(fromID).split(':')
-            self._send(pkt)
-
+        # could not decrypt payload, meant for a node further along
+        # -> get next node addr from table, replace circID, remove one layer, and send it along
+        if command == "relay_data":
+            print("FORWARDING MESSAGE IN CIRCUIT:")
+            print(command, "circID", circID, len(decrypted_data), "bytes\n")
+        next_hop = self._next_hop(circID)
+        if next_hop is None:
+            print("ERROR    Circuit", circID, "has no next node; cell dropped\n")
+            self._packets.remove(circID)
+            return
+        destID, ip, port = next_hop
+        if cipher.cell_layers:
+            self._relay(pm.new_cell(destID, command, length, decrypted_data), ip, port)
+        else:
+            self._relay(pm.new_relay_packet(destID, command, decrypted_data), ip, port)
 
-    def _process_control(self, message):
+    def _relay_backward(self, cell, circID, command, length):
+        """
+        a relay cell going backwards: encrypt one layer, and send it to the
+        previous node right away (or once its packet is complete, see _relay_forward)
+        """
+        # if A -> B and message was received from B and goes backwards, send it to A
+        fromID = self.node_relay_table.get_from_id(circID)
+        cipher = self.node_key_table.get_cipher(fromID)
+        if cipher == -1:
+            print("ERROR    Received a", command, "cell of unknown circuit", circID, "; cell dropped\n")
+            return
+        if cipher.cell_layers:
+            encrypted_data = enc.encrypt_layer(pm.sealed_body(cell), cipher)
+            self._send_back(fromID, pm.new_cell(fromID, command, length, encrypted_data))
+            return
+        body = self._packets.add(circID, command, length, pm.cell_body(cell))
+        if body is not None:
+            encrypted_payload = enc.encrypt_layer(body, cipher)
+            self._send_back(fromID, pm.new_relay_packet(fromID, command, encrypted_payload))
+
+    def _process_relay(self, circID, command, recognized_data, cipher):
+        """ acts according to a relay packet meant for this node, once its layers are removed """
+        decrypted_payload = enc.deserialize_payload(recognized_data)
+        if command == "extend":
+            # message has extend command and managed to decrypt it
+            # -> create a new control packet cmd=create, send to next node
+            destID = self._generate_new_circID()
+            self.node_relay_table.add_relay_entry(circID, destID)
+            payload = pm.new_payload(self.ip, self.port, decrypted_payload['data'],
+                                     decrypted_payload.get('mode', enc.FERNET_MODE),
+                                     decrypted_payload.get('handshake', hs.RSA_HANDSHAKE),
+                                     decrypted_payload.get('compression'))
+            pkt = pm.new_control_packet(destID, "create", payload)
+
+            self.circuit_table.add_circuit_entry(decrypted_payload['ip'], decrypted_payload['port'], destID)
+            self._relay(pkt, decrypted_payload['ip'], decrypted_payload['port'])
+        elif command == "relay_data":
+
+
+            # fully decrypted a relay_data packet
+            # -> node is an exit node; make a GET request, and send the answer
+            #    back to connecting node using same key, fragment by fragment
+            #    as it is received, on the stream of the request; the link
+            #    keeps carrying other circuits and streams meanwhile
+            stream = decrypted_payload.get('stream', 0)
+            self.node_key_table.add_stream(circID, stream)
+            self._start_answer(circID, cipher, decrypted_payload['data'], stream)
+        elif command == "sendme" and 'stream' in decrypted_payload:
+            # the client read cells of the answer of a stream: it may get more
+            window = self.node_key_table.get_stream_window(circID, decrypted_payload['stream'])
+            # the answer may have been sent completely meanwhile
+            if window is not None and not window.replenish():
+                print("ERROR    Unexpected sendme on stream", decrypted_payload['stream'],
+                      "of circuit", circID, "\n")
+        elif command == "sendme":
+            # the client received cells of the answers: the exit node may send more
+            window = self.node_key_table.get_send_window(circID)
+            if window == -1 or not window.replenish():
+                print("ERROR    Unexpected sendme on circuit", circID, "\n")
+
+    def _start_answer(self, circID, cipher, url, stream=0):
+        """ exit node: sends the answer of the GET request to url, in its own thread """
+        Thread(target=self._send_answer, args=(circID, cipher, url, stream), daemon=True).start()
+
+    def _send_answer(self, circID, cipher, url, stream=0):
+        """
+        exit node: sends the answer of the GET request to url backwards on a
+        stream, one "relay_ans" packet per fragment, followed by a last
+        fragment (see AnswerFragments), as the windows of the circuit and of
+        the stream allow
+        """
+        windows = (self.node_key_table.get_stream_window(circID, stream),
+                   self.node_key_table.get_send_window(circID))
+        headers, chunks = gr.web_request_stream(url, pm.FRAGMENT_DATA_SIZE)
+        answer = AnswerFragments(self.node_key_table.get_compression(circID),
+                                 headers.get('Content-Encoding'), stream)
+        try:
+            for fragment in answer.fragments(chunks):
+                if not fc.consume_all(windows, pm.cell_count(len(fragment))):
+                    print("ERROR    The client stopped acknowledging the answer; answer dropped\n")
+                    return
+                self._send_fragment(circID, cipher, fragment)
+        except OSError:
+            print("ERROR    Connection closed by the previous node; answer dropped\n")
+            return
+        finally:
+            self.node_key_table.remove_stream(circID, stream)
+        answer.print_summary(url)
+
+    def _send_fragment(self, circID, cipher, fragment):
+        """ sends a fragment back; the streams of a circuit take turns """
+        lock = self.node_key_table.get_send_lock(circID)
+        if lock == -1:
+            raise ConnectionError("circuit {} was destroyed".format(circID))
+        with lock:
+            self._send_back(circID, pm.new_sealed_packet(circID, "relay_ans", fragment, [cipher]))
+
+    def _process_control(self, message, from_next_hop=False):
         if message['command'] == "create":
-            # received half of a RSA key exchange
+            # received half of a key exchange (RSA or ntor, see handshake.py)
             # -> create association with sender in table, deal with keys, send back a "created" packet
-            cipher_shared_key = message['payload']['data']
+            #    the handshake is done in the handshake executor if there is one, and
+            #    the "created" packet is sent when it is done, without holding the link
+            circID = message['circID']
+            self.link_manager.set_circuit_link(circID, self.link)
+            handshake = message['payload'].get('handshake', hs.RSA_HANDSHAKE)
             try:
-                cipher_shared_key = int(cipher_shared_key)
-            except ValueError:
+                if self.handshake_executor is not None:
+                    future = self.handshake_executor.submit(handshake, message['payload']['data'])
+                    future.add_done_callback(lambda future: self._handshake_done(message, future))
+                    return
+                shared_key, handshake_reply = hs.server_reply(
+                    handshake, message['payload']['data'], "{}:{}".format(self.ip, self.port),
+                    self.rsa_keys, self.ntor_keys)
+            except OnionOverloadError:
+                # too many handshakes waiting: refuse the circuit right away
+                print("ERROR    Too many pending handshakes; refusing circuit", circID)
+                self._send_back(circID, pm.new_control_packet(circID, "destroy", pm.DESTROY_RESOURCE_LIMIT))
+                self.link_manager.remove_circuit(circID)
+                return
+            except (ValueError, TypeError, KeyError):
                 print("ERROR    Could not interpret cipher shared key\n")
-                self._close()
+                self.link_manager.remove_circuit(circID)
                 return
-            shared_key = enc.decrypt_RSA(cipher_shared_key, self.rsa_keys['private'], self.rsa_keys['modulus'])
-            #shared key is in bytes at this point, should decode?
-            ip, port = self.addr
-            self.circuit_table.add_circuit_entry(message['payload']['ip'], message['payload']['port'], message['circID'])
-            self.node_key_table.add_key_entry(message['circID'], shared_key)
-
-            # send back useless data with the same length as the shared key
-            pad = ''.join(
-                random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(len(shared_key)))
-            key = self.node_key_table.get_key(message['circID'])
-            encrypted_payload = enc.encrypt_fernet(pad, key)
-
-            pkt = pm.new_control_packet(message['circID'], "created", encrypted_payload)
-            self._send(pkt)
-            #self._sendExtend(pkt,ip,port)
+            self._send_created(message, shared_key, handshake_reply)
 
         elif message['command'] == "created":
             # node was appended to circuit, is adjacent, and confirms its creation
-            # -> wrap payload in "extended" packet, send it backwards
+            # -> wrap payload in "extended" packet, sealed by this node, send it backwards
+            fromID = self.node_relay_table.get_from_id(message['circID'])
+            cipher = self.node_key_table.get_cipher(fromID)
+            if cipher == -1:
+                print("ERROR    Received a created packet of unknown circuit", message['circID'], "\n")
+                return
+
+            pkt = pm.new_sealed_packet(fromID, "extended", message['payload'], [cipher])
+            self._send_back(fromID, pkt)
+
+        elif message['command'] == "destroy" and from_next_hop:
+            # the next node refused to extend the circuit
+            # -> forget the next node, send the "destroy" backwards
             fromID = self.node_relay_table.get_from_id(message['circID'])
-            key = self.node_key_table.get_key(fromID)
-            encrypted_payload = enc.encrypt_fernet(message['payload'], key)
+            if fromID == -1:
+                print("ERROR    Received a destroy packet of unknown circuit", message['circID'], "\n")
+                return
+            self.circuit_table.remove_circuit(message['circID'])
+            self.node_relay_table.remove_relay_entry(fromID)
 
-            pkt = pm.new_relay_packet(fromID, "extended", encrypted_payload)
-            ip, port = self.circuit_table.get_address(fromID).split(':')
-            self._send(pkt)
+            self._send_back(fromID, pm.new_control_packet(fromID, "destroy", message['payload']))
+            self.link_manager.remove_circuit(fromID)
 
         elif message['command'] == "destroy":
             # destroy association to sender, then forward message to next node
             destID = self.node_relay_table.get_dest_id(message['circID'])
 
+            # keys and ciphers are evicted together with the circuit
+            self.node_key_table.remove_key_entry(message['circID'])
+            self.link_manager.remove_circuit(message['circID'])
+            self._packets.remove(message['circID'])
+
             # exit node, i.e. reached end of circuit
             if destID == -1:
                 return
 
-            self.node_key_table.remove_key_entry(message['circID'])
+            next_hop = self._next_hop(message['circID'])
             self.node_relay_table.remove_relay_entry(message['circID'])
-            message['circID'] = destID
+            self.circuit_table.remove_circuit(destID)
+            if next_hop is None:
+                return
+            destID, ip, port = next_hop
 
-            ip, port = self.circuit_table.get_address(message['circID']).split(':')
-            self.circuit_table.remove_circuit_entry(ip, port)
+            self._relay(pm.new_control_packet(destID, "destroy", message['payload']), ip, port)
 
-            self._send(message)
+    def _handshake_done(self, message, future):
+        """ called by the handshake executor once the handshake of a "create" packet is done """
+        try:
+            shared_key, handshake_reply = future.result()
+        except (CancelledError, BrokenProcessPool):
+            # the executor was closed while the handshake was waiting
+            self.link_manager.remove_circuit(message['circID'])
+            return
+        except (ValueError, TypeError, KeyError):
+            print("ERROR    Could not interpret cipher shared key\n")
+            self.link_manager.remove_circuit(message['circID'])
+            return
+        try:
+            self._send_created(message, shared_key, handshake_reply)
+        except OSError:
+            print("ERROR    Connection closed by the previous node before the circuit was created\n")
+
+    def _send_created(self, message, shared_key, handshake_reply):
+        """ adds the circuit of a "create" packet to the tables, and confirms it to the previous node """
+        self.circuit_table.add_circuit_entry(message['payload']['ip'], message['payload']['port'], message['circID'])
+        self.node_key_table.add_key_entry(message['circID'], shared_key,
+                                          message['payload'].get('mode', enc.FERNET_MODE),
+                                          cmp.negotiate(message['payload'].get('compression')))
+
+        # send back useless data with the same length as the shared key
+        pad = ''.join(
+            random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(len(shared_key)))
+        cipher = self.node_key_table.get_cipher(message['circID'])
+        encrypted_payload = enc.encrypt_layer(cipher.seal(enc.serialize_payload(pad)), cipher)
+        created_payload = pm.new_created_payload(handshake_reply, encrypted_payload)
+
+        pkt = pm.new_control_packet(message['circID'], "created", created_payload)
+        self._send_back(message['circID'], pkt)
@@ -3,18 +3,24 @@
     Module that defines the Onion Client, used by the user to communicate
     through the onion routing network
 """
+import collections
 from contextlib import contextmanager
-from threading import Thread
+from threading import Condition, Lock, Thread
 import random
 from random import randint
 import socket
 import json
 import time
+import zlib
 import packet_manager as pm
-import base64
 
 import circuit_tables as ct
 import encryption as enc
+import framing
+import links
+import handshake as hs
+import compression as cmp
+import flow_control as fc
 from errors import OnionError, OnionRuntimeError, OnionClientError
 
 BUFFER_SIZE = 4096
@@ -24,20 +30,48 @@ DEFAULT_DIRECTORY_NODE_PORT = 12345
 
 
 class OnionClient():
-    def __init__(self, ip, port, number_of_nodes):
+    def __init__(self, ip, port, number_of_nodes, relay_crypto=enc.FERNET_MODE, compression=None):
+        """
+        relay_crypto: encryption used on the circuit; enc.FERNET_MODE or
+        enc.STREAM_MODE (per-circuit AES-CTR streams with a running digest)
+        compression: compression of the answers asked to the exit node
+        (cmp.ZLIB_COMPRESSION), or None
+        """
         self.initialized = False
         self.ip = ip
         self.port = port
         self.number_of_nodes_in_circuit = number_of_nodes
+        self.relay_crypto = relay_crypto
+        self.compression = compression
 
         self.circuit_table = ct.circuit_table()
         self.sender_key_table = ct.sender_key_table()
         self.network_list = {}
 
         self.client_socket = None
+        self._reader = None
+        # the packets received from the entry node, whose cells are being received
+        self._packets = pm.PacketAssembler()
+        self._receive_window = fc.ReceiveWindow()
         self.circuit_id = None
         self._entry_node = None
 
+        # held while a packet is encrypted and sent: the layers are added in sending order
+        self._send_lock = Lock()
+        # the streams of the circuit (see make_get_request_to_url): stream ID ->
+        # fragments received and not read yet, and the window of each stream
+        self._streams = {}
+        self._stream_windows = {}
+        # streams whose reading stopped before the end of the answer: the rest
+        # of their fragments is acknowledged and dropped as it arrives
+        self._abandoned_streams = {}
+        # streams whose answer was not read yet, in the order of their requests
+        self._unread_streams = collections.deque()
+        self._last_stream = 0
+        # one thread at a time reads the packets of the entry node, for every stream
+        self._streams_condition = Condition()
+        self._reading = False
+
     def connect_to_directory(
         self,
         directory_node_ip=DEFAULT_DIRECTORY_NODE_IP,
@@ -70,6 +104,9 @@ class OnionClient():
         """
         called from exterior to tell client to make a get request to the given
         URL through the circuit.
+        The request is made on a new stream of the circuit, whose ID is
+        returned: several requests can be made before their answers are read
+        (see recv), and their answers come back at the same time.
         """
         if not self.initialized:
             raise OnionClientError(
@@ -79,65 +116,214 @@ class OnionClient():
                 """
             )
 
-        # TODO:  make sure we shouldn't just reuse the same socket for
-        # multiple 'sends' to the same circuit ID
-        # (i.e. using a persistent relaying mechanism)
-
         if self.client_socket is None:
             # If we already had a client_socket, this means we are already
-            # connected with the entry node. No need to re-create the socket.
-            self.client_socket = socket.socket()
-            self.client_socket.connect((self._entry_node['ip'],
-                                        self._entry_node['port']))
-
-        message = pm.new_payload(0, 0, url)
-
-        # apply three encryption layers to message
-        encrypted_data = self.successive_encrypt(
-            message,
-            self.number_of_nodes_in_circuit
-        )
+            # connected with the entry node: the circuit was built on it.
+            # Otherwise, the entry node sends the answer on the new connection.
+            self._connect_to_entry_node()
+
+        stream = self._open_stream()
+        message = pm.new_payload(0, 0, url, stream=stream)
+
+        with self._send_lock:
+            # apply three encryption layers to message
+            pkt = self.successive_encrypt(
+                message,
+                self.number_of_nodes_in_circuit,
+                "relay_data"
+            )
 
-        pkt = pm.new_relay_packet(
-            self.circuit_id,
-            "relay_data",
-            encrypted_data)
+            done = False
+            while not done:
+                try:
+                    pm.send_packet(self.client_socket, pkt)
+                except ConnectionResetError:
+                    # The remote host closed their end of the socket, we have to
+                    # re-connect.
+                    self.client_socket.close()
+                    self._connect_to_entry_node()
+                else:
+                    done = True
+        return stream
+
+    def recv(self, buffer_size=None, stream=None):
+        """
+        Receives the answer of the host through the previously established
+        connection: the answer on the given stream (see
+        make_get_request_to_url), or to the oldest request not read yet.
+        NOTE: buffer_size is not needed anymore: the answer is read cell by cell.
+        """
+        return b''.join(self.recv_stream(stream)).decode("UTF-8")
 
-        done = False
-        while not done:
+    def recv_stream(self, stream=None):
+        """
+        Yields the answer of the host (bytes) on a stream (by default, the
+        oldest request not read yet) fragment by fragment, as the exit node
+        receives it; only the fragments not read yet are held.
+        Compressed fragments are decompressed piece by piece.
+        Streams can be read one after the other, or at the same time by
+        several threads; the fragments of the other streams are kept for them.
+        The exit node is sent a "sendme" as the fragments are received, and
+        one for the stream as they are read (see flow_control.py): it stops
+        sending on a stream that is not read.
+        An answer that is not read until the end is dropped as it arrives.
+        """
+        stream = self._start_reading(stream)
+        expected_seq = 0
+        decompressor = None
+        complete = False
+        try:
+            while True:
+                seq, last, compressed, data, cells, failed = self._next_fragment(stream)
+                if seq != expected_seq:
+                    raise OnionRuntimeError(
+                        "ERROR    Received answer fragment {} instead of {}\n".format(seq, expected_seq)
+                    )
+                expected_seq += 1
+                if compressed:
+                    if decompressor is None:
+                        decompressor = cmp.Decompressor()
+                    try:
+                        yield from decompressor.decompress(data)
+                    except zlib.error:
+                        raise OnionRuntimeError(
+                            "ERROR    Could not decompress the answer\n"
+                        )
+                elif data:
+                    yield data
+                if last:
+                    if failed:
+                        complete = True
+                        raise OnionRuntimeError(
+                            "ERROR    The exit node received a truncated answer\n"
+                        )
+                    if decompressor is not None and not decompressor.finished:
+                        raise OnionRuntimeError(
+                            "ERROR    Received a truncated compressed answer\n"
+                        )
+                    complete = True
+                    return
+                # the fragment was read: give the stream credit back
+                for _ in range(self._stream_windows[stream].deliver(cells)):
+                    self._send_sendme(stream)
+        finally:
+            self._stop_reading(stream, complete)
+
+    def _open_stream(self):
+        """ returns the ID of a new stream of the circuit """
+        with self._streams_condition:
+            for _ in range(pm.MAX_STREAM_ID):
+                self._last_stream = self._last_stream % pm.MAX_STREAM_ID + 1
+                stream = self._last_stream
+                if stream not in self._streams and stream not in self._abandoned_streams:
+                    break
+            else:
+                raise OnionClientError("ERROR    Too many open streams on the circuit")
+            self._streams[stream] = collections.deque()
+            self._stream_windows[stream] = fc.ReceiveWindow(fc.STREAM_SENDME_INCREMENT)
+            self._unread_streams.append(stream)
+            return stream
+
+    def _start_reading(self, stream):
+        """ returns the stream to read (see recv_stream) """
+        with self._streams_condition:
+            if stream is None:
+                if not self._unread_streams:
+                    raise OnionClientError("ERROR    No answer to receive; make a request first")
+                return self._unread_streams.popleft()
+            if stream not in self._streams:
+                raise OnionClientError("ERROR    No such stream:", stream)
+            if stream in self._unread_streams:
+                self._unread_streams.remove(stream)
+            return stream
+
+    def _stop_reading(self, stream, complete):
+        """ closes a stream; if its answer was not read until the end, the rest is dropped """
+        with self._streams_condition:
+            fragments = self._streams.pop(stream)
+            window = self._stream_windows.pop(stream)
+            if complete or self.client_socket is None:
+                return
+            self._abandoned_streams[stream] = window
+        try:
+            for fragment in fragments:
+                self._drop_fragment(stream, window, fragment)
+        except OSError:
+            # the connection is gone: there is nothing left to acknowledge
+            pass
+
+    def _next_fragment(self, stream):
+        """
+        returns the next fragment received on a stream, as
+        (seq, last, compressed, data, cells, failed); reads the packets of the entry
+        node, unless another thread already does
+        """
+        while True:
+            with self._streams_condition:
+                while True:
+                    fragments = self._streams[stream]
+                    if fragments:
+                        return fragments.popleft()
+                    if not self._reading:
+                        self._reading = True
+                        break
+                    self._streams_condition.wait()
             try:
-                self.client_socket.sendall(pkt.encode())
-            except ConnectionResetError:
-                # The remote host closed their end of the socket, we have to
-                # re-connect.
-                self.client_socket.close()
-                self.client_socket = socket.socket()
-                self.client_socket.connect(
-                    (self._entry_node['ip'], self._entry_node['port'])
+                self._receive_fragment()
+            finally:
+                with self._streams_condition:
+                    self._reading = False
+                    self._streams_condition.notify_all()
+
+    def _receive_fragment(self):
+        """ receives one fragment from the entry node, and hands it to its stream """
+        if self.client_socket is None:
+            raise OnionRuntimeError(
+                "ERROR    The connection to the entry node was closed\n"
+            )
+        try:
+            command, fragment = self._recv_packet()
+            if command != "relay_ans":
+                raise OnionRuntimeError(
+                    "ERROR    Did not receive expected answer packet\n"
                 )
-            else:
-                done = True
-
-    def recv(self, buffer_size):
-        """
-        Receives the given number of bytes from the previously established
-        connection with the host.
-        """
-        chunks_received = []
-        bytes_received_so_far = 0
-        done = False
-        while not done:
-            rec_bytes = self.client_socket.recv(buffer_size)
-            chunks_received.append(rec_bytes)
-            bytes_received_so_far += len(rec_bytes)
-            done = (rec_bytes == b'') or (bytes_received_so_far >= buffer_size)
-
-        received_bytes = b''.join(chunks_received)
-        message_str = received_bytes.decode('utf-8')
-        message = json.loads(message_str)
-        decrypted = self.successive_decrypt(message['encrypted_data'])
-        payload = base64.urlsafe_b64decode(decrypted['data']).decode("UTF-8")
-        return payload
+            try:
+                stream, seq, last, compressed, data = pm.parse_fragment(fragment)
+            except ValueError:
+                raise OnionRuntimeError(
+                    "ERROR    Received a malformed answer fragment\n"
+                )
+        except OnionRuntimeError:
+            # the rest of the answers cannot be read
+            self.client_socket.close()
+            self.client_socket = None
+            raise
+        cells = pm.cell_count(len(fragment))
+        # the fragment was received: give the circuit credit back
+        for _ in range(self._receive_window.deliver(cells)):
+            self._send_sendme()
+
+        fragment = (seq, last, compressed, data, cells, pm.fragment_failed(fragment))
+        with self._streams_condition:
+            fragments = self._streams.get(stream)
+            if fragments is not None:
+                fragments.append(fragment)
+                return
+            window = self._abandoned_streams.get(stream)
+            if window is None:
+                print("ERROR    Received a fragment of unknown stream", stream, "\n")
+                return
+        self._drop_fragment(stream, window, fragment)
+
+    def _drop_fragment(self, stream, window, fragment):
+        """ drops a fragment of an abandoned stream, acknowledging it so that the answer goes on """
+        seq, last, compressed, data, cells, failed = fragment
+        if last:
+            with self._streams_condition:
+                self._abandoned_streams.pop(stream, None)
+            return
+        for _ in range(window.deliver(cells)):
+            self._send_sendme(stream)
 
     def _contact_dir_node(self, dir_ip, dir_port):
         """
@@ -150,12 +336,13 @@ class OnionClient():
 
         with socket.socket() as client_socket:
             client_socket.connect((dir_ip, dir_port))
-            client_socket.sendall(pkt.encode())
+            framing.send_frame(client_socket, pkt.encode())
 
-            rec_bytes = client_socket.recv(BUFFER_SIZE)
-            message = json.loads(rec_bytes.decode())
+            rec_bytes = framing.recv_frame(client_socket)
+            if rec_bytes is not None:
+                message = json.loads(rec_bytes.decode())
 
-        if message == -1 or message['type'] != "dir":
+        if message is None or message['type'] != "dir":
             raise OnionRuntimeError(
                 "ERROR    Unexpected answer from directory\n"
             )
@@ -217,39 +404,48 @@ class OnionClient():
             else:
                 self._send_extend_packet(node, index)
 
+    def _send_sendme(self, stream=None):
+        """
+        acknowledges to the exit node fc.SENDME_INCREMENT cells of the answers
+        of the circuit, or fc.STREAM_SENDME_INCREMENT cells of a stream
+        """
+        with self._send_lock:
+            pm.send_packet(self.client_socket,
+                           self.successive_encrypt(pm.new_payload(0, 0, "", stream=stream),
+                                                   self.number_of_nodes_in_circuit, "sendme"))
+
+    def _connect_to_entry_node(self):
+        """ opens the connection to the entry node, used for the whole circuit """
+        self.client_socket = socket.create_connection((self._entry_node['ip'],
+                                                       self._entry_node['port']))
+        links.configure_socket(self.client_socket)
+
     def _send_create_packet(self, node):
         assert self.client_socket is None
         assert self.circuit_id is not None
         assert self._entry_node is not None
         # first link is special: only one to get control "create" packet
+        # the connection stays open: the extends and the requests go through it
+        self._connect_to_entry_node()
 
-        # NOTE: validate how we create and/or reuse sockets.
-        self.client_socket = socket.socket()
-        self.client_socket.connect((self._entry_node['ip'],
-                                    self._entry_node['port']))
-
-        key = enc.generate_fernet_key()
-        self.sender_key_table.add_key_entry(self.circuit_id, 0, key)
-        ciphered_shared_key = enc.encrypt_RSA(
-            key,
-            node['public_exp'],
-            node['modulus'])
-        payload = pm.new_payload(self.ip, self.port, ciphered_shared_key)
+        state, handshake_data = hs.client_create(node)
+        payload = pm.new_payload(self.ip, self.port, handshake_data,
+                                 self.relay_crypto, hs.get_handshake(node), self.compression)
 
         # Create the custom control packet
         pkt = pm.new_control_packet(self.circuit_id, "create", payload)
 
         # send first half of key exchange
-        self.client_socket.sendall(pkt.encode())
+        pm.send_packet(self.client_socket, pkt)
 
         # Obtain a response packet
-        rec_bytes = self.client_socket.recv(BUFFER_SIZE)
-        message = json.loads(rec_bytes.decode())
+        command, created = self._recv_packet(0)
 
-        if message == -1 or message['command'] != 'created':
+        if command != 'created':
             raise OnionRuntimeError(
                 "ERROR    Did not receive expected confirmation packet\n"
             )
+        self._finish_handshake(node, state, created, 0)
 
         # received "created" packet successfully -- store info in tables
         # store connection to first circID, the entry point to the circuit
@@ -259,59 +455,104 @@ class OnionClient():
             self.circuit_id)
         print("Successfully sent the first 'create' packet")
 
-        # TODO: Make sure that we should really reuse the same socket.
-        self.client_socket.close()
-        self.client_socket = None
-
     def _send_extend_packet(self, node, layer):
         """
         Send an 'extend' to the rest of the nodes in the circuit that we are
         building.
         """
-        assert self.client_socket is None
+        assert self.client_socket is not None
         assert self.circuit_id is not None
         assert self._entry_node is not None
 
-        # NOTE: validate how we create and/or reuse sockets.
-        self.client_socket = socket.socket()
-        self.client_socket.connect((self._entry_node['ip'],
-                                    self._entry_node['port']))
-
-        key = enc.generate_fernet_key()
-        ciphered_shared_key = enc.encrypt_RSA(
-            key,
-            node['public_exp'],
-            node['modulus'])
+        state, handshake_data = hs.client_create(node)
 
         # data to be placed in "extend" packet payload. nodes will use circIDs to navigate,
         # until a node has decrypted the payload and finds the ip and port of the new node
         encrypted_data = pm.new_relay_payload(
             node['ip'],
             node['port'],
-            ciphered_shared_key)
+            handshake_data,
+            self.relay_crypto,
+            hs.get_handshake(node),
+            self.compression)
 
         # apply layers of encryption on shared key + key exchange before sending it
-        encrypted_data = self.successive_encrypt(encrypted_data, layer)
-
-        pkt = pm.new_relay_packet(self.circuit_id, "extend", encrypted_data)
+        pkt = self.successive_encrypt(encrypted_data, layer, "extend")
 
         # send first half of key exchange
-        self.client_socket.sendall(pkt.encode())
+        pm.send_packet(self.client_socket, pkt)
 
-        rec_bytes = self.client_socket.recv(BUFFER_SIZE)
+        command, created = self._recv_packet(layer)
 
-        message = json.loads(rec_bytes.decode())
-
-        if message == -1 or message['command'] != 'extended':
+        if command != 'extended':
             raise OnionRuntimeError(
                 "ERROR    Did not receive expected confirmation packet\n"
             )
             print("         Circuit building exiting. . .")
 
-        self.sender_key_table.add_key_entry(self.circuit_id, layer, key)
+        self._finish_handshake(node, state, created, layer)
 
-        self.client_socket.close()
-        self.client_socket = None
+    def _finish_handshake(self, node, state, created, layer):
+        """
+        complete the handshake with the node at the given layer from its
+        "created" answer, sealed by the node before it (see _recv_packet).
+        the answer holds the node's handshake reply, and a confirmation encrypted
+        by the new node with the shared key; opening it checks that the node got
+        the key (and keeps the relay crypto state of every node in step with the client)
+        """
+        handshake_reply, confirmation = pm.parse_created_payload(created)
+
+        key = hs.client_finish(node, state, handshake_reply)
+        self.sender_key_table.add_key_entry(self.circuit_id, layer, key, self.relay_crypto)
+        cipher = self.sender_key_table.get_cipher(self.circuit_id, layer)
+        if cipher.open(cipher.decrypt(confirmation)) is None:
+            raise OnionRuntimeError(
+                "ERROR    Could not confirm the shared key with the new node\n"
+            )
+
+    def _recv_packet(self, layer_count=None):
+        """
+        receives the cells of one packet from the entry node
+        returns (command, payload): the payload of a control packet (see
+        pm.parse_packet), or the data sealed by the node a relay packet comes
+        from, once the layers of the first layer_count nodes of the circuit
+        (all of them by default) are removed
+        """
+        if self._reader is None or self._reader.sock is not self.client_socket:
+            self._reader = pm.new_cell_reader(self.client_socket)
+            self._packets = pm.PacketAssembler()
+        if layer_count is None:
+            layer_count = self.number_of_nodes_in_circuit
+        ciphers = self.sender_key_table.get_ciphers(self.circuit_id, layer_count)
+        while True:
+            cell = pm.recv_cell(self._reader)
+            if cell is None:
+                raise OnionRuntimeError(
+                    "ERROR    Connection to the entry node closed before a complete packet was received\n"
+                )
+            try:
+                circID, command, length = pm.parse_cell_header(cell)
+                payload = self._open_cell(cell, circID, command, length, ciphers)
+            except ValueError:
+                raise OnionRuntimeError(
+                    "ERROR    Received malformed cells from the entry node\n"
+                )
+            if payload is not None:
+                return command, payload
+
+    def _open_cell(self, cell, circID, command, length, ciphers):
+        """
+        adds a cell to its packet: the layers of the given ciphers are removed
+        from each cell, or from the whole packet if they cover whole packets
+        returns the payload of the packet once it is complete, else None
+        """
+        if command in pm.CONTROL_COMMANDS:
+            body = self._packets.add(circID, command, length, pm.cell_body(cell))
+            return None if body is None else pm.parse_packet(circID, command, body)['payload']
+        if ciphers and ciphers[0].cell_layers:
+            return self._packets.add(circID, command, length, self._open_layers(pm.sealed_body(cell), ciphers))
+        body = self._packets.add(circID, command, length, pm.cell_body(cell))
+        return None if body is None else self._open_layers(body, ciphers)
 
     def send_through_circuit(self, message):
         """
@@ -326,26 +567,35 @@ class OnionClient():
         """
         return recv(buffer_size)
 
-    def successive_encrypt(self, message, layer_count):
+    def successive_encrypt(self, message, layer_count, command="relay_data"):
         assert self.circuit_id is not None
         """
         apply three encryption layers to message
+        returns the cells of the relay packet carrying it to node layer_count - 1
         """
         # apply layers of encryption on shared key + key exchange before sending it
         # e.g. for node 2, apply layer 1 then layer 0
-        encrypted_data = message
-        for j in range(layer_count - 1, -1, -1):
-            key = self.sender_key_table.get_key(self.circuit_id, j)
-            encrypted_data = enc.encrypt_fernet(encrypted_data, key)
-        return encrypted_data
+        # the message is serialized once; the layers are applied on bytes
+        ciphers = self.sender_key_table.get_ciphers(self.circuit_id, layer_count)
+        return pm.new_sealed_packet(self.circuit_id, command, enc.serialize_payload(message), ciphers)
 
-    def successive_decrypt(self, data):
+    def successive_decrypt(self, cells):
         """
-        remove encryption layers (from node 0 to node 2)
+        remove encryption layers (from node 0 to node 2) from the cells of a
+        relay packet, returns the message it carries
         """
-        layer = self.sender_key_table.get_key(self.circuit_id, 0)
-        payload = enc.decrypt_fernet(data, layer)
-        for i in range(1, self.number_of_nodes_in_circuit):
-            layer = self.sender_key_table.get_key(self.circuit_id, i)
-            payload = enc.decrypt_fernet(payload, layer)
+        ciphers = self.sender_key_table.get_ciphers(self.circuit_id, self.number_of_nodes_in_circuit)
+        for offset in range(0, len(cells), pm.CELL_SIZE):
+            cell = cells[offset:offset + pm.CELL_SIZE]
+            circID, command, length = pm.parse_cell_header(cell)
+            payload = self._open_cell(cell, circID, command, length, ciphers)
+        return enc.deserialize_payload(payload)
+
+    def _open_layers(self, data, ciphers):
+        """ remove encryption layers, returns the sealed payload (bytes-like) """
+        payload = enc.decrypt_layers(data, ciphers)
+        if payload is None:
+            raise OnionRuntimeError(
+                "ERROR    Received data that was not sent by a node of the circuit\n"
+            )
         return payload
@@ -1,26 +1,212 @@
 import json
+import struct
+
+import encryption as enc
+import framing
+
+# reason of a "destroy" packet sent by a node that is too busy to accept a circuit
+DESTROY_RESOURCE_LIMIT = "resource_limit"
+
+"""
+    Cells
+
+    Control and relay packets are sequences of fixed-size cells, sent back to
+    back on the connections between the nodes (see new_cell_reader):
+        header (CELL_HEADER_SIZE) | body (CELL_BODY_SIZE, zero-padded)
+    header:
+        circID     (4): circuit ID of the packet
+        command    (1): COMMANDS[command]
+        length     (4): bytes of the packet body still to come, from this cell on;
+                        the last cell of a packet has length <= CELL_BODY_SIZE
+        recognized (2): zero once every layer is removed from the cell
+        digest     (4): running digest of the cells sealed on the circuit so far
+    A node routes every cell from its circID, command and length (ROUTING_HEADER)
+    as soon as it is read; only the node a packet is meant for gathers its cells.
+    On circuits whose layers cover each cell (enc.RelayCrypto), recognized, digest
+    and body are the sealed part of the cell (sealed_body): they are sealed by the
+    node the cell comes from, every node adds or removes its layer on them, and
+    only the node the cell is meant for recognizes them (see new_sealed_packet).
+    Fernet layers cover whole packets: the cells of a relay packet are gathered
+    by every node to remove its layer, and recognized and digest stay zero, as
+    in control packets.
+"""
+CELL_SIZE = 512
+CELL_HEADER = struct.Struct(">IBIH4s")
+CELL_HEADER_SIZE = CELL_HEADER.size
+CELL_BODY_SIZE = CELL_SIZE - CELL_HEADER_SIZE
+ROUTING_HEADER = struct.Struct(">IBI")
+
+COMMANDS = {
+    "create": 1,
+    "created": 2,
+    "destroy": 3,
+    "extend": 4,
+    "extended": 5,
+    "relay_data": 6,
+    "relay_ans": 7,
+    "sendme": 8,
+}
+COMMAND_NAMES = {code: command for command, code in COMMANDS.items()}
+CONTROL_COMMANDS = ("create", "created", "destroy")
+# relay packets going from the client towards the end of the circuit
+FORWARD_COMMANDS = ("extend", "relay_data", "sendme")
+
+
+def new_cells(circID, command, body):
+    """ splits a packet body (bytes) into cells; returns them as one bytes object """
+    code = COMMANDS[command]
+    cells = []
+    offset = 0
+    while True:
+        cells.append(CELL_HEADER.pack(circID, code, len(body) - offset, 0, bytes(4)))
+        cells.append(body[offset:offset + CELL_BODY_SIZE].ljust(CELL_BODY_SIZE, b'\0'))
+        offset += CELL_BODY_SIZE
+        if offset >= len(body):
+            return b''.join(cells)
+
+
+def new_cell(circID, command, length, sealed_body):
+    """ one cell, from its routing header and its sealed part (see sealed_body) """
+    return ROUTING_HEADER.pack(circID, COMMANDS[command], length) + sealed_body
+
+
+def new_sealed_packet(circID, command, payload, ciphers):
+    """
+    cells of a relay packet carrying payload (bytes) to the node of the last
+    of ciphers, which seals it; the layers of every cipher are added, the last
+    one first (ciphers are ordered from the nearest node, see enc.encrypt_layers)
+    with ciphers that layer each cell (cell_layers), every cell is sealed and
+    layered on its own: the nodes relay it without waiting for the others
+    """
+    if not ciphers[-1].cell_layers:
+        return new_cells(circID, command, enc.encrypt_layers(payload, ciphers))
+    cells = []
+    offset = 0
+    while True:
+        body = payload[offset:offset + CELL_BODY_SIZE].ljust(CELL_BODY_SIZE, b'\0')
+        cells.append(new_cell(circID, command, len(payload) - offset, enc.encrypt_layers(body, ciphers)))
+        offset += CELL_BODY_SIZE
+        if offset >= len(payload):
+            return b''.join(cells)
+
+
+def cell_count(length):
+    """ number of cells of a packet whose body is length bytes long """
+    return max(1, -(-length // CELL_BODY_SIZE))
+
+
+def parse_cell_header(cell):
+    """
+    returns (circID, command, length) of a cell, from its first ROUTING_HEADER bytes
+    raises ValueError if the cell is not understood
+    """
+    circID, code, length = ROUTING_HEADER.unpack_from(cell)
+    if code not in COMMAND_NAMES:
+        raise ValueError("Unrecognized cell")
+    return circID, COMMAND_NAMES[code], length
+
+
+def cell_body(cell):
+    """ the body of a cell, whose length first bytes at most belong to its packet """
+    return cell[CELL_HEADER_SIZE:]
+
+
+def sealed_body(cell):
+    """ recognized, digest and body of a cell: the part covered by cell layers (see new_sealed_packet) """
+    return cell[ROUTING_HEADER.size:]
+
+
+class PacketAssembler():
+    """
+    Gathers the cells of the packets meant for a node (or a client), per
+    circuit, until a packet is complete. The cells of a packet arrive in
+    order, and are not mixed with the cells of another packet of the same
+    circuit.
+    """
+
+    def __init__(self):
+        # circID -> (command, length still to come, body so far)
+        self._packets = {}
+
+    def add(self, circID, command, length, body):
+        """
+        adds a cell of a packet, given by its header and its body (see cell_body)
+        returns the body of the packet (bytes-like) once its last cell was added, else None
+        raises ValueError if the cell does not follow the previous cells of the circuit
+        """
+        data = body[:min(length, CELL_BODY_SIZE)]
+        packet = self._packets.pop(circID, None)
+        if packet is None:
+            if length <= CELL_BODY_SIZE:
+                return bytes(data)
+            packet = (command, length, bytearray())
+        elif packet[:2] != (command, length):
+            raise ValueError("Cell out of order")
+        packet[2].extend(data)
+        if length <= CELL_BODY_SIZE:
+            return packet[2]
+        self._packets[circID] = (command, length - CELL_BODY_SIZE, packet[2])
+        return None
+
+    def remove(self, circID):
+        """ drops the cells received so far of a packet of circuit circID """
+        self._packets.pop(circID, None)
+
+
+def parse_packet(circID, command, body):
+    """
+    returns the packet as a dict:
+        {'type': "control", 'circID', 'command', 'payload'} or
+        {'type': "relay", 'circID', 'command', 'encrypted_data'}
+    """
+    if command not in CONTROL_COMMANDS:
+        return {'type': "relay", 'circID': circID, 'command': command, 'encrypted_data': body}
+    if command == "create":
+        payload = json.loads(body.decode('utf-8'))
+    elif command == "destroy":
+        payload = body.decode('utf-8')
+    else:
+        payload = body
+    return {'type': "control", 'circID': circID, 'command': command, 'payload': payload}
+
+
+def new_cell_reader(sock):
+    """ returns a framing.FrameReader of the cells received on a socket (see recv_cell) """
+    return framing.FrameReader(sock, record_size=CELL_SIZE)
+
+
+def recv_cell(reader):
+    """
+    reads one cell from a reader made by new_cell_reader
+    returns the cell as a memoryview of the buffer of the reader, valid until
+    the next read, or None if the connection was closed
+    """
+    return reader.read_frame_view()
+
+
+def send_packet(sock, packet):
+    """ sends the cells of a packet """
+    sock.sendall(packet)
 
-####################################### #
-# TODO: padding for fixed packet length #
-#########################################
 
 def new_control_packet(circID, command, data):
     """
-    build a packet (header + payload) according to its type
+    build a packet (header + payload) according to its type, as cells
     circID: circuit ID. different for each connection between nodes.
 
     control: packet is to be interpreted by the node
-        -> create   : create a new circuit (circID arg will be ignored)
-        -> created  : new circuit has been created
-        -> destroy  : destroy a circuit
+        -> create   : create a new circuit (circID arg will be ignored); data is a payload dict
+        -> created  : new circuit has been created; data is bytes (see new_created_payload)
+        -> destroy  : destroy a circuit; data is the reason (e.g. DESTROY_RESOURCE_LIMIT)
 
     """
-    return json.dumps({
-        'type' : "control",
-        'circID': circID,
-        'command': command,
-        'payload': data
-    })
+    if command == "create":
+        body = json.dumps(data).encode('utf-8')
+    elif command == "destroy":
+        body = (data or "").encode('utf-8')
+    else:
+        body = bytes(data)
+    return new_cells(circID, command, body)
 
 
 def new_dir_packet(command, info, data):
@@ -40,15 +226,16 @@ def new_dir_packet(command, info, data):
             'command' : command
         })
     elif command == "dir_update":
+        # data: public node descriptor (OnionNode.descriptor), e.g. public_exp and modulus
         ip, port = info
-        return json.dumps({
+        packet = {
             'type' : "dir",
             'command' : command,
             'ip' : ip,
-            'port' : port,
-            'public_exp' : data["public"],
-            'modulus' : data["modulus"]
-        })
+            'port' : port
+        }
+        packet.update(data)
+        return json.dumps(packet)
     elif command == "dir_answer":
         return json.dumps({
             'type' : "dir",
@@ -57,50 +244,140 @@ def new_dir_packet(command, info, data):
             'table' : data
         })
 
-# TODO: complete this header with additional Tor functionality e.g. multiple streams (if needed)
-#       if this feature is not added, merge this with create_control_packet method and add "relay" command
 def new_relay_packet(circID, command, encrypted_data):
     """
 
-    relay:      packet is to be forwarded by the node
-                -> TODO additional header fields: checksum, length of payload, stream cmds
+    relay:      packet is to be forwarded by the node, as cells
+                encrypted_data: bytes, whose layers cover the whole packet
+                (packets sealed cell by cell are made by new_sealed_packet)
+                the streams of a circuit are told apart inside the encrypted data
+                (the 'stream' of new_payload, and the header of new_fragment)
 
     valid commands:
         -> extend: packet contains RSA key and next node's IP addr
         -> extended: circuit was successfully extended
         -> relay_data : packet contains forward message (client -> server)
-        -> relay_ans :  packet message contains backward message (server -> client)
+        -> relay_ans :  packet message contains backward message (server -> client),
+                        one fragment of it (see new_fragment)
+        -> sendme :     the client acknowledges cells of the answers of the circuit,
+                        or of one stream (see flow_control.py)
     """
 
-    return json.dumps({
-            'type' : "relay",
-            'circID': circID,
-            'command': command,
-            'encrypted_data': encrypted_data
-    })
+    return new_cells(circID, command, bytes(encrypted_data))
 
 
-def new_relay_payload(ip, port, data):
+def new_relay_payload(ip, port, data, mode=None, handshake=None, compression=None):
     """
     list used for relay packet payload
     contains the part of the relay packet that needs to be encrypted
+    mode: relay crypto mode of the circuit, only given for "extend"
+    handshake: handshake used with the new node (see handshake.py), only given for "extend"
+    compression: compression of the answers asked to the new node (see compression.py),
+                 only given for "extend"
     """
 
-    return {'isDecrypted': True,
-            'ip': ip,
-            'port': port,
-            'data': data
+    payload = {'isDecrypted': True,
+               'ip': ip,
+               'port': port,
+               'data': data
     }
+    if mode is not None:
+        payload['mode'] = mode
+    if handshake is not None:
+        payload['handshake'] = handshake
+    if compression is not None:
+        payload['compression'] = compression
+    return payload
 
 
-def new_payload(ip, port, data):
+def new_payload(ip, port, data, mode=None, handshake=None, compression=None, stream=None):
     """
     list used for relay packet payload
     contains the part of the relay packet that needs to be encrypted
+    mode: relay crypto mode of the circuit, only given for "create"
+    handshake: handshake used with the node (see handshake.py), only given for "create"
+    compression: compression of the answers asked to the node (see compression.py),
+                 only given for "create"
+    stream: stream of a "relay_data" request, from 1 to MAX_STREAM_ID (several
+            requests can be answered at once on a circuit), or of the cells
+            acknowledged by a "sendme"; only given for those
     """
 
-    return {'isDecrypted': True,
-            'ip': ip,
-            'port': port,
-            'data': data
-    }
\ No newline at end of file
+    payload = {'isDecrypted': True,
+               'ip': ip,
+               'port': port,
+               'data': data
+    }
+    if mode is not None:
+        payload['mode'] = mode
+    if handshake is not None:
+        payload['handshake'] = handshake
+    if compression is not None:
+        payload['compression'] = compression
+    if stream is not None:
+        payload['stream'] = stream
+    return payload
+
+
+def new_created_payload(handshake_reply, confirmation):
+    """
+    payload of a "created" packet, as bytes:
+        length of handshake_reply (2) | handshake_reply | confirmation
+    handshake_reply: the node's half of the handshake, readable before the shared key is known
+    confirmation: data encrypted with the new shared key, to check the key
+    """
+    return struct.pack(">H", len(handshake_reply)) + handshake_reply + confirmation
+
+
+def parse_created_payload(data):
+    """ returns (handshake_reply, confirmation) """
+    length, = struct.unpack_from(">H", data)
+    return bytes(data[2:2 + length]), data[2 + length:]
+
+
+"""
+    Fragments
+
+    The answer of the exit node is sent back as a sequence of "relay_ans"
+    packets, one per fragment, that every node forwards as soon as it is
+    received. The sealed payload of each packet is:
+        stream (2): stream of the request answered (see new_payload); the
+                    answers of the streams of a circuit are interleaved
+        seq   (4): position of the fragment in the answer, from 0
+        flags (1): FRAGMENT_LAST for the last fragment of the answer,
+                   FRAGMENT_COMPRESSED if data is compressed (see compression.py),
+                   FRAGMENT_FAILED on the last fragment if the exit node could
+                   not receive the whole answer (it was cut short)
+        data     : FRAGMENT_DATA_SIZE bytes of the answer at most, before compression
+"""
+FRAGMENT_HEADER = struct.Struct(">HIB")
+FRAGMENT_DATA_SIZE = 16 * 1024
+FRAGMENT_LAST = 1
+FRAGMENT_COMPRESSED = 2
+FRAGMENT_FAILED = 4
+MAX_STREAM_ID = 0xFFFF
+
+
+def new_fragment(stream, seq, data, last=False, compressed=False, failed=False):
+    """ payload of one fragment of the answer on a stream, as bytes """
+    flags = (FRAGMENT_LAST if last else 0) | (FRAGMENT_COMPRESSED if compressed else 0)
+    if failed:
+        flags |= FRAGMENT_LAST | FRAGMENT_FAILED
+    return FRAGMENT_HEADER.pack(stream, seq, flags) + data
+
+
+def parse_fragment(data):
+    """
+    returns (stream, seq, last, compressed, data) of a fragment
+    raises ValueError if data is not a fragment
+    """
+    if len(data) < FRAGMENT_HEADER.size:
+        raise ValueError("Incomplete fragment")
+    stream, seq, flags = FRAGMENT_HEADER.unpack_from(data)
+    return (stream, seq, bool(flags & FRAGMENT_LAST), bool(flags & FRAGMENT_COMPRESSED),
+            bytes(data[FRAGMENT_HEADER.size:]))
+
+
+def fragment_failed(data):
+    """ True if data is the last fragment of an answer that was cut short (see new_fragment) """
+    return len(data) >= FRAGMENT_HEADER.size and bool(FRAGMENT_HEADER.unpack_from(data)[2] & FRAGMENT_FAILED)
\ No newline at end of file
@@ -17,13 +17,39 @@ class ClosableQueue(Queue):
         if self.closed:
             raise RuntimeError("Queue Already Closed.")
         else:
-            self.put(self.SENTINEL)
+            self.closed = True
+            self._put_sentinel()
+
+    def _put_sentinel(self):
+        # the sentinel is queued even if the queue is full, so that closing never blocks
+        with self.mutex:
+            self._put(self.SENTINEL)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def remove_if(self, predicate):
+        """ removes the queued items for which predicate(item) is true; returns them """
+        removed = []
+        with self.mutex:
+            kept = type(self.queue)()
+            for item in self.queue:
+                if item is not self.SENTINEL and predicate(item):
+                    removed.append(item)
+                else:
+                    kept.append(item)
+            if removed:
+                self.queue = kept
+                self.unfinished_tasks -= len(removed)
+                self.not_full.notify(len(removed))
+        return removed
 
     def __iter__(self):
         while True:
             item = self.get()
             try:
                 if item is self.SENTINEL:
+                    # leave it for the other consumers, then exit
+                    self._put_sentinel()
                     return  # Cause the thread to exit.
                 yield item
             finally:
@@ -2,23 +2,32 @@
 """
 This module defines the Workers/Threads that are used to handle relaying
 messages from one socket to another.
+
+The relays are run by a RelayMultiplexer: a single thread that owns many
+(left, right) socket pairs, and that is only woken up (by a selector) when
+one of the sockets is readable or writable.
 """
 import json
+import selectors
 import socket
 from socket import SocketType
-from threading import Thread
+from threading import Thread, Lock, Event
 from typing import List
 
 import errors
 from errors import OnionRuntimeError
+import framing
 from messaging import OnionMessage
 import workers
 from workers import SocketReader
 
 BUFFER_SIZE = 4096
 
+# reading from a side stops while this many bytes wait to be sent to the other side
+MAX_PENDING_BYTES = 1024 * 1024
+
 
-class IntermediateRelay(Thread):
+class IntermediateRelay():
     """
     Relays messages from one socket to another, using the provided functions.
 
@@ -29,10 +38,15 @@ class IntermediateRelay(Thread):
         left_socket before putting it on right_socket.
         - right_to_left: function to be applied for each item taken from
         right_socket before putting it on left_socket.
+        - multiplexer: RelayMultiplexer running the relay (default: the one
+        shared by all the relays, see get_multiplexer).
 
         NOTE: the functions given should be function(JSON) -> JSON (or
         OnionMessage, for that matter.)
 
+    When one of the sockets is closed by its peer, the messages received
+    from it are sent to the other side, which is then closed.
+
     TODO: Would it be a good idea to use a field in a message, to indicate if
     the connection is to be held open, or closed ?
     (analogous to TCP's 'connection' field?)
@@ -42,10 +56,10 @@ class IntermediateRelay(Thread):
                  left_socket: SocketType,
                  right_socket: SocketType,
                  left_to_right=None,
-                 right_to_left=None
+                 right_to_left=None,
+                 multiplexer=None
                  ):
         """ Initializes the relay. """
-        super().__init__()
         self.left_socket = left_socket
         self.right_socket = right_socket
 
@@ -53,88 +67,253 @@ class IntermediateRelay(Thread):
         self.left_to_right = left_to_right
         self.right_to_left = right_to_left
 
-        self._left_buffer = []  # messages received from the left socket.
-        self._right_buffer = []  # messages received from the right socket.
-
-        self.left_reader = SocketReader(self.left_socket, self._left_buffer)
-        self.right_reader = SocketReader(self.right_socket, self._right_buffer)
+        self.multiplexer = multiplexer
+        self._closed = Event()
 
     def start(self):
         """ Starts the Relay. """
-        self.left_reader.start()
-        self.right_reader.start()
-        super().start()
+        if self.multiplexer is None:
+            self.multiplexer = get_multiplexer()
+        self.multiplexer.add(self)
+
+    @property
+    def closed(self):
+        """ True once both sockets are closed """
+        return self._closed.is_set()
+
+    def join(self, timeout=None):
+        """ waits until both sockets are closed """
+        return self._closed.wait(timeout)
+
+
+class _RelaySide():
+    """
+    One socket of a relay, in the multiplexer: frames are decoded from what
+    is read from it, and what is to be written to it waits in its buffer.
+    """
+
+    def __init__(self, sock, transform):
+        self.sock = sock
+        self.fd = sock.fileno()
+        # applied to the messages read from this side
+        self.transform = transform
+        self.decoder = framing.FrameDecoder(buffer_size=BUFFER_SIZE)
+        self.outgoing = bytearray()
+        self.other = None
+        self.relay = None
+        # the peer closed its end: nothing more to read
+        self.finished = False
+        # close the socket once the outgoing bytes are sent
+        self.closing = False
+        self.closed = False
+        self.events = 0
+
+
+def _encode(message):
+    """ a message as the bytes of a frame """
+    if isinstance(message, OnionMessage):
+        # serialized once, even if it is sent more than once
+        message_bytes = message.to_bytes()
+    else:
+        message_bytes = json.dumps(message).encode()
+    return framing.encode_frame(message_bytes)
+
+
+class RelayMultiplexer(Thread):
+    """
+    Runs many relays (see IntermediateRelay) in one thread.
+    The thread sleeps in a selector until a socket of one of its relays is
+    readable, or writable while it has bytes to send; the messages are then
+    transformed and forwarded frame by frame.
+    Relays can be added from any thread.
+    """
+
+    def __init__(self, buffer_size=BUFFER_SIZE, max_pending_bytes=MAX_PENDING_BYTES):
+        super().__init__(daemon=True)
+        self.buffer_size = buffer_size
+        self.max_pending_bytes = max_pending_bytes
+        self._selector = selectors.DefaultSelector()
+        self._lock = Lock()
+        self._new_relays = []
+        self._relay_count = 0
+        self._running = True
+        # written to from other threads to wake the multiplexer up
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._selector.register(self._wakeup_receiver, selectors.EVENT_READ, None)
+
+    def add(self, relay):
+        """ starts relaying the sockets of relay """
+        with self._lock:
+            self._new_relays.append(relay)
+        self._wake_up()
+
+    def stop(self):
+        """ closes every relay, then stops the thread """
+        self._running = False
+        self._wake_up()
+
+    @property
+    def relay_count(self):
+        """ number of relays that still have an open socket """
+        return self._relay_count
+
+    def _wake_up(self):
+        try:
+            self._wakeup_sender.send(b'\0')
+        except (BlockingIOError, OSError):
+            # already woken up, or stopped
+            pass
 
     def run(self):
-        """ Begin relaying messages from one socket to another.
-        idea:
-            - Listen for messages from left
-            - copy the messages to the right socket
-
-            AND
-
-            - Listen for messages from right socket
-            - copy the messages to the left socket
-
-            until either of them closes its side of the connection.
-        """
-
-        while (not self.left_reader.closed) and (not self.right_reader.closed):
-            # send to next node
-            for message in self._left_buffer:
-                if self.left_to_right:
-                    # If we were given a function to execute
-                    message = self.left_to_right(message)
-                self._send(message, self.right_socket)
-                self._left_buffer.remove(message)
-
-            # send to prev node
-            for message in self._right_buffer:
-                if self.right_to_left:
-                    # If we were given a function to execute
-                    message = self.right_to_left(message)
-                self._send(message, self.left_socket)
-                self._right_buffer.remove(message)
-
-        # One of the two closed.
-
-        # IMPORTANT: whenever one of the nodes closes its socket, we assume
-        # that whatever message may come after that point can be dumped.
-
-        if self.left_reader.closed:
-            # Prev is done sending messages. Send the the rest of its messages
-            # over to next, then close next.
-            for message in self._left_buffer:
-                if self.left_to_right:
-                    # If we were given a function to execute
-                    message = self.left_to_right(message)
-                self._send(message, self.right_socket)
-                self._left_buffer.remove(message)
-            self.right_socket.close()
-
-        elif self.right_reader.closed:
-            # Prev is done sending messages. Send the the rest of its messages
-            # over to next, then close next.
-            for message in self._right_buffer:
-                if self.right_to_left:
-                    # If we were given a function to execute
-                    message = self.right_to_left(message)
-                self._send(message, self.left_socket)
-                self._right_buffer.remove(message)
-            self.left_socket.close()
+        while self._running:
+            for key, mask in self._selector.select():
+                if key.data is None:
+                    self._take_new_relays()
+                    continue
+                side = key.data
+                try:
+                    if mask & selectors.EVENT_WRITE and not side.closed:
+                        self._write(side)
+                    if mask & selectors.EVENT_READ and not side.closed:
+                        self._read(side)
+                except Exception as e:
+                    # a socket was closed from outside, sent something that is not a
+                    # message, or a transform failed: only this relay is closed
+                    print("ERROR    Closing relay:", repr(e))
+                    self._close(side)
+                    self._close(side.other)
 
+        for key in list(self._selector.get_map().values()):
+            if key.data is not None:
+                self._close(key.data)
+        self._selector.close()
+        self._wakeup_receiver.close()
+        self._wakeup_sender.close()
+
+    def _take_new_relays(self):
+        try:
+            while self._wakeup_receiver.recv(self.buffer_size):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            relays, self._new_relays = self._new_relays, []
+        for relay in relays:
+            left = _RelaySide(relay.left_socket, relay.left_to_right)
+            right = _RelaySide(relay.right_socket, relay.right_to_left)
+            left.other, right.other = right, left
+            left.relay = right.relay = relay
+            self._relay_count += 1
+            for side in (left, right):
+                stale_key = self._selector.get_map().get(side.fd)
+                if stale_key is not None:
+                    # the socket of a relay was closed from outside, and its fd reused
+                    self._close(stale_key.data)
+            try:
+                for side in (left, right):
+                    side.sock.setblocking(False)
+                    self._update(side)
+            except (OSError, ValueError) as e:
+                print("ERROR    Could not start relay:", e)
+                self._close(left)
+                self._close(right)
+
+    def _update(self, side):
+        """ registers the side for the events it is waiting for; a closed side waits for none """
+        if side.closed:
+            return
+        events = 0
+        if not side.finished and len(side.other.outgoing) < self.max_pending_bytes:
+            events |= selectors.EVENT_READ
+        if side.outgoing:
+            events |= selectors.EVENT_WRITE
+        if events == side.events:
+            return
+        if side.events == 0:
+            self._selector.register(side.fd, events, side)
+        elif events == 0:
+            self._selector.unregister(side.fd)
         else:
-            raise OnionRuntimeError("Some weird error ocurred.")
-
-    def _send(self, message, destination_socket):
-        """ Processes, then sends the given message to the given
-        destination_socket.
-
-        NOTE: This should never be called outside the relay, as indicated by
-        the "_" field prefix.
-        """
-        # convert to bytes.
-        message_str = json.dumps(message)
-        message_bytes = message_str.encode()
-        # send to previous node
-        destination_socket.sendall(message_bytes)
+            self._selector.modify(side.fd, events, side)
+        side.events = events
+
+    def _read(self, side):
+        try:
+            received = side.decoder.recv_into(side.sock)
+        except BlockingIOError:
+            return
+        except OSError:
+            received = 0
+        if not received:
+            # the peer is done sending messages: send the rest of its messages
+            # over to the other side, then close it
+            side.finished = True
+            self._close(side)
+            side.other.closing = True
+            self._flush(side.other)
+            return
+
+        # decoded straight from the buffer of the decoder
+        for message in side.decoder.views():
+            message = json.loads(str(message, 'utf-8'))
+            if side.transform:
+                # If we were given a function to execute
+                message = side.transform(message)
+            side.other.outgoing += _encode(message)
+        self._flush(side.other)
+        self._update(side)
+
+    def _write(self, side):
+        self._flush(side)
+        # reading from the other side may resume
+        if not side.other.closed:
+            self._update(side.other)
+
+    def _flush(self, side):
+        """ sends what the socket accepts of the outgoing bytes of side """
+        if side.closed:
+            return
+        try:
+            while side.outgoing:
+                sent = side.sock.send(side.outgoing)
+                del side.outgoing[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            # the peer is gone: nothing more can be relayed
+            side.outgoing.clear()
+            self._close(side)
+            if not side.other.closed:
+                self._close(side.other)
+            return
+        if side.closing and not side.outgoing:
+            self._close(side)
+        else:
+            self._update(side)
+
+    def _close(self, side):
+        if side.closed:
+            return
+        side.closed = True
+        if side.events:
+            self._selector.unregister(side.fd)
+            side.events = 0
+        side.sock.close()
+        if side.other.closed:
+            self._relay_count -= 1
+            side.relay._closed.set()
+
+
+_multiplexer = None
+_multiplexer_lock = Lock()
+
+
+def get_multiplexer():
+    """ returns the RelayMultiplexer shared by the relays, starting it the first time """
+    global _multiplexer
+    with _multiplexer_lock:
+        if _multiplexer is None:
+            _multiplexer = RelayMultiplexer()
+            _multiplexer.start()
+        return _multiplexer
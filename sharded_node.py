@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+"""
+Sharded onion node: one node (ip, port and keys) served by several
+processes, to relay on more than one core (an OnionNode is one process).
+
+Every shard is an OnionNode binding the port of the node with SO_REUSEPORT;
+the kernel spreads the connections made to the node across the shards.
+A shard owns the circuits arriving on the connections it accepted: their
+packets, and the answers coming back on the links the shard opened to the
+next nodes, never reach another shard, so the shards share no table.
+Each shard gives the circuits it extends circIDs from its own range (see
+shard_circuit_ids), so that circuits extended by different shards never get
+the same circID at the next node.
+The supervisor, ShardedNode, makes the keys of the node and registers it
+with the directory node, once for all the shards.
+"""
+import multiprocessing
+import os
+import socket
+
+import handshake as hs
+import node_switchboard as ns
+from errors import OnionRuntimeError
+from node import OnionNode
+
+
+def shard_circuit_ids(index, shards, circuit_ids=ns.CIRCUIT_IDS):
+    """ (lowest, highest) circID given by shard number index of a node with that many shards """
+    lowest, highest = circuit_ids
+    span = (highest - lowest + 1) // shards
+    if span < 1:
+        raise ValueError("{} shards cannot share {} circIDs".format(shards, highest - lowest + 1))
+    return lowest + index * span, lowest + (index + 1) * span - 1
+
+
+def _run_shard(ip, port, handshake, keys, network_list, circuit_ids, options, stop_event):
+    """ process of a shard: runs an OnionNode until stop_event is set """
+    onion_node = OnionNode(ip, port, handshake=handshake, keys=keys, reuse_port=True,
+                           circuit_ids=circuit_ids, **options)
+    # registered with the directory by the supervisor
+    onion_node.network_list = network_list
+    onion_node.initialized = True
+    onion_node.start()
+    stop_event.wait()
+    onion_node.stop()
+    onion_node.join()
+
+
+class ShardedNode():
+    """
+    A node of the onion network served by several processes (shards).
+
+    Params:
+        - ip, port: address of the node, shared by all its shards.
+        - shards: number of shard processes (default: one per core).
+        - key_pool, keystore, handshake: as for OnionNode; the keys are made
+          once, by the supervisor, and given to every shard.
+        - options: other parameters of the OnionNode of each shard (engine,
+          connection_workers...). The shards do their handshakes themselves
+          unless handshake_workers is given.
+    """
+
+    def __init__(self, ip, port, shards=None, key_pool=None, keystore=None,
+                 handshake=hs.RSA_HANDSHAKE, **options):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise OnionRuntimeError("SO_REUSEPORT is not supported on this platform")
+        self.ip = ip
+        self.port = port
+        self.shards = shards or os.cpu_count() or 1
+        self.handshake = handshake
+        self.options = options
+        self.options.setdefault('handshake_workers', 0)
+
+        # never started: holds the keys of the node, and registers it
+        self.node = OnionNode(ip, port, key_pool, keystore, handshake)
+        self.processes = []
+        self._stop_event = multiprocessing.Event()
+
+    def connect(self, dir_ip, dir_port):
+        """ registers the node with the directory node (see OnionNode.connect) """
+        self.node.connect(dir_ip, dir_port)
+
+    def start(self):
+        """ starts the shard processes """
+        if not self.node.initialized:
+            print("ERROR    Node not initialized. Call node.connect() first")
+            return
+        if self.handshake == hs.NTOR_HANDSHAKE:
+            keys = self.node.ntor_keys
+        else:
+            keys = self.node.rsa_keys
+        for index in range(self.shards):
+            process = multiprocessing.Process(
+                target=_run_shard,
+                args=(self.ip, self.port, self.handshake, keys, self.node.network_list,
+                      shard_circuit_ids(index, self.shards), self.options, self._stop_event),
+                name="{}:{} shard {}".format(self.ip, self.port, index),
+                daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def is_alive(self):
+        return any(process.is_alive() for process in self.processes)
+
+    def stop(self):
+        """ tells the shards to shutdown. """
+        self._stop_event.set()
+
+    def join(self, timeout=None):
+        for process in self.processes:
+            process.join(timeout)
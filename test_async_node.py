@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+import asyncio
+import socket
+import http.client
+import threading
+import unittest
+
+import get_request as gr
+import packet_manager as pm
+from async_node import AsyncLinkManager
+from node_switchboard import AnswerFragments
+
+
+class AsyncLinkManagerTestCase(unittest.TestCase):
+    def test_packets_sent_while_connecting_are_delivered(self):
+        async def exchange():
+            received = asyncio.Queue()
+
+            async def read(link):
+                packets = pm.PacketAssembler()
+                while True:
+                    cell = await link.read_cell()
+                    circID, command, length = pm.parse_cell_header(cell)
+                    body = packets.add(circID, command, length, pm.cell_body(cell))
+                    if body is not None:
+                        await received.put((circID, body))
+                        return
+
+            server_manager = AsyncLinkManager(lambda link: server_manager.spawn(read(link)))
+            server = await asyncio.start_server(server_manager.accept, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+
+            client_manager = AsyncLinkManager(lambda link: None)
+            link = client_manager.get_link("127.0.0.1", port)
+            self.assertIs(link, client_manager.get_link("127.0.0.1", port))
+            link.send(pm.new_relay_packet(3, "relay_data", b"x" * 2000))
+            message = await asyncio.wait_for(received.get(), 5)
+
+            client_manager.close()
+            server_manager.close()
+            server.close()
+            return message
+
+        self.assertEqual((3, b"x" * 2000), asyncio.run(exchange()))
+
+
+class AsyncWebRequestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.listening_socket = socket.socket()
+        self.listening_socket.bind(("127.0.0.1", 0))
+        self.listening_socket.listen()
+        self.url = "127.0.0.1:{}".format(self.listening_socket.getsockname()[1])
+        self.body = b"z" * 50000
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def tearDown(self):
+        self.listening_socket.close()
+
+    def _serve(self):
+        while True:
+            try:
+                connection, _ = self.listening_socket.accept()
+            except OSError:
+                return
+            with connection:
+                request = connection.recv(4096)
+                if request.startswith(b"GET /moved "):
+                    connection.sendall(b"HTTP/1.0 302 Found\r\nLocation: /page\r\n\r\n")
+                elif request.startswith(b"GET /page "):
+                    connection.sendall(b"HTTP/1.0 200 OK\r\nContent-Encoding: gzip\r\n"
+                                       b"Content-Length: 50000\r\n\r\n" + self.body)
+                elif request.startswith(b"GET /truncated "):
+                    connection.sendall(b"HTTP/1.0 200 OK\r\nContent-Length: 100000\r\n\r\n" + self.body)
+                else:
+                    connection.sendall(b"HTTP/1.0 404 Not Found\r\n\r\n")
+
+    def _request(self, path):
+        async def request():
+            headers, chunks = await gr.web_request_stream_async(self.url + path, 16384)
+            return headers, [chunk async for chunk in chunks]
+        return asyncio.run(request())
+
+    def test_redirect_is_followed(self):
+        headers, chunks = self._request("/moved")
+        self.assertEqual("gzip", headers.get('content-encoding'))
+        self.assertEqual(self.body, b"".join(chunks))
+        self.assertTrue(all(len(chunk) <= 16384 for chunk in chunks))
+
+    def test_failed_request_has_no_answer(self):
+        self.assertEqual(({}, []), self._request("/missing"))
+
+    def test_truncated_answer_raises(self):
+        with self.assertRaises(http.client.IncompleteRead):
+            self._request("/truncated")
+
+    def test_truncated_answer_ends_with_a_failed_fragment(self):
+        async def request():
+            headers, chunks = await gr.web_request_stream_async(self.url + "/truncated", 16384)
+            return [fragment async for fragment in AnswerFragments(None).fragments_async(chunks)]
+        fragments = asyncio.run(request())
+        self.assertEqual(self.body, b"".join(pm.parse_fragment(fragment)[4] for fragment in fragments))
+        self.assertTrue(pm.fragment_failed(fragments[-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import unittest
+
+import benchmark_crypto as bc
+import encryption as enc
+
+
+class BaselineTestCase(unittest.TestCase):
+    def test_slower_results_are_regressions(self):
+        baseline = {"a": bc.result(100.0), "b": bc.result(100.0), "c": bc.result(100.0)}
+        results = {"a": bc.result(95.0), "b": bc.result(50.0), "d": bc.result(1.0)}
+        self.assertEqual({"b": (100.0, 50.0)}, bc.find_regressions(results, baseline, threshold=0.1))
+
+    def test_saved_baseline_is_loaded(self):
+        results = {"encrypt_fernet payload=1024": bc.result(10.0, 1024)}
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "baseline.json")
+            bc.save_baseline(results, filename)
+            self.assertEqual(results, bc.load_baseline(filename))
+
+
+class LayersBenchmarkTestCase(unittest.TestCase):
+    def test_layers_benchmark_runs_in_every_mode(self):
+        results = bc.benchmark_layers(payload_sizes=[1024], layer_counts=[1, 3], min_time=0.001)
+        for mode in (enc.FERNET_MODE, enc.STREAM_MODE):
+            values = results["successive_decrypt mode={} layers=3 payload=1024".format(mode)]
+            self.assertGreater(values['ops_per_s'], 0)
+            self.assertEqual(values['ops_per_s'] * 1024, values['bytes_per_s'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+
+import unittest
+
+import circuit_tables as ct
+import encryption as enc
+import flow_control as fc
+
+
+class NodeKeyTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.table = ct.node_key_table()
+        self.key = enc.generate_fernet_key()
+
+    def test_cipher_is_prepared_when_key_is_added(self):
+        self.table.add_key_entry(10, self.key)
+        cipher = self.table.get_cipher(10)
+        self.assertIs(cipher, self.table.get_cipher(10))
+        self.assertEqual(b"data", cipher.decrypt(cipher.encrypt(b"data")))
+
+    def test_cipher_is_evicted_with_key(self):
+        self.table.add_key_entry(10, self.key)
+        self.table.remove_key_entry(10)
+        self.assertEqual(-1, self.table.get_key(10))
+        self.assertEqual(-1, self.table.get_cipher(10))
+
+    def test_stream_windows(self):
+        self.table.add_key_entry(10, self.key)
+        window = self.table.add_stream(10, 1)
+        self.table.add_stream(10, 2)
+        self.table.add_stream(11, 1)
+        self.assertIs(window, self.table.get_stream_window(10, 1))
+        self.assertEqual(fc.STREAM_WINDOW, window.size)
+
+        self.table.remove_stream(10, 1)
+        self.assertIsNone(self.table.get_stream_window(10, 1))
+        self.table.remove_key_entry(10)
+        self.assertIsNone(self.table.get_stream_window(10, 2))
+        self.assertIsNotNone(self.table.get_stream_window(11, 1))
+
+
+class SenderKeyTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.table = ct.sender_key_table()
+        for nodeNo in range(3):
+            self.table.add_key_entry(10, nodeNo, enc.generate_fernet_key())
+        self.table.add_key_entry(20, 0, enc.generate_fernet_key())
+
+    def test_get_ciphers_is_ordered_from_entry_node(self):
+        ciphers = self.table.get_ciphers(10, 3)
+        for nodeNo, cipher in enumerate(ciphers):
+            self.assertEqual(self.table.get_key(10, nodeNo), cipher.key)
+
+    def test_remove_circuit_evicts_only_that_circuit(self):
+        self.table.remove_circuit(10)
+        self.assertEqual(-1, self.table.get_cipher(10, 0))
+        self.assertNotEqual(-1, self.table.get_cipher(20, 0))
@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+
+import unittest
+
+import compression as cmp
+
+
+class CompressionTestCase(unittest.TestCase):
+    def test_answer_is_decompressed_fragment_by_fragment(self):
+        chunks = [b"<html>" * 1000, b"hello" * 3000, b""]
+        compressor = cmp.new_compressor(cmp.ZLIB_COMPRESSION)
+        fragments = [compressor.compress(chunk) for chunk in chunks] + [compressor.finish()]
+        self.assertLess(sum(map(len, fragments)), sum(map(len, chunks)))
+
+        decompressor = cmp.Decompressor(max_output_size=1000)
+        received = []
+        for fragment in fragments:
+            pieces = list(decompressor.decompress(fragment))
+            self.assertTrue(all(len(piece) <= 1000 for piece in pieces))
+            received.extend(pieces)
+        self.assertEqual(b"".join(chunks), b"".join(received))
+        self.assertTrue(decompressor.finished)
+
+    def test_compressed_answers_are_passed_through(self):
+        self.assertIsNone(cmp.new_compressor(cmp.ZLIB_COMPRESSION, "gzip"))
+        self.assertIsNone(cmp.new_compressor(cmp.ZLIB_COMPRESSION, "identity, GZIP"))
+        self.assertIsNone(cmp.new_compressor(None))
+        self.assertIsNotNone(cmp.new_compressor(cmp.ZLIB_COMPRESSION, "identity"))
+
+    def test_negotiate(self):
+        self.assertEqual(cmp.ZLIB_COMPRESSION, cmp.negotiate(cmp.ZLIB_COMPRESSION))
+        self.assertIsNone(cmp.negotiate("lzma"))
+        self.assertIsNone(cmp.negotiate(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
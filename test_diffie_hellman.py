@@ -32,4 +32,28 @@ class DiffieHellmanTestCase(unittest.TestCase):
             receiver_public_key,
             compute_public_key(server_private_key)
         )
+        self.assertIn(
+            (compute_public_key(client_private_key), shared_secret),
+            server_shared_secrets.values()
+        )
         # self.assertDictContainsSubset(server_shared_secrets, {shared_secret})
+
+    def test_both_sides_compute_the_same_secret(self):
+        for group in GROUPS:
+            a = generate_private_key(group)
+            b = generate_private_key(group)
+            self.assertEqual(
+                compute_shared_secret(a, compute_public_key(b, group), group),
+                compute_shared_secret(b, compute_public_key(a, group), group)
+            )
+
+    def test_fixed_base_table_matches_pow(self):
+        table = FixedBaseTable(PUBLIC_BASE, PUBLIC_ROOT, 64, window_bits=5)
+        for exponent in (0, 1, 2, 31, 32, 2 ** 63 + 12345, 2 ** 64 - 1, 2 ** 200 + 1):
+            self.assertEqual(pow(PUBLIC_BASE, exponent, PUBLIC_ROOT), table.pow(exponent))
+
+    def test_invalid_public_keys_are_rejected(self):
+        private_key = generate_private_key()
+        for public_key in (0, 1, PUBLIC_ROOT - 1, PUBLIC_ROOT):
+            with self.assertRaises(ValueError):
+                compute_shared_secret(private_key, public_key)
@@ -2,6 +2,7 @@
 
 import unittest
 from encryption import *
+from cryptography.fernet import Fernet, InvalidToken
 
 
 class SimpleAdditionEncriptorTestCase(unittest.TestCase):
@@ -25,3 +26,147 @@ class SimpleAdditionEncriptorTestCase(unittest.TestCase):
 
 
 
+class LayeredEncryptionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.ciphers = [new_cipher(generate_fernet_key()) for _ in range(3)]
+        self.payload = {'isDecrypted': True, 'ip': 0, 'port': 0, 'data': "some data"}
+
+    def test_decrypt_layers_equals_original_payload(self):
+        data = encrypt_layers(serialize_payload(self.payload), self.ciphers)
+        decrypted = decrypt_layers(data, self.ciphers)
+        self.assertEqual(self.payload, deserialize_payload(decrypted))
+
+    def test_each_node_removes_one_layer(self):
+        data = encrypt_layers(serialize_payload(self.payload), self.ciphers)
+        for key in self.ciphers:
+            self.assertTrue(is_layered(data))
+            data = decrypt_layer(data, key)
+        self.assertFalse(is_layered(data))
+        self.assertEqual(self.payload, deserialize_payload(data))
+
+    def test_overhead_per_layer_is_constant(self):
+        message = serialize_payload({'data': "a" * 10000})
+        sizes = [len(message)] + [len(encrypt_layers(message, self.ciphers[:i])) for i in range(1, 4)]
+        # version + timestamp + IV + HMAC, plus at most one block of padding
+        for before, after in zip(sizes, sizes[1:]):
+            self.assertLessEqual(after - before, 57 + 16)
+
+    def test_packet_data_round_trip(self):
+        data = encrypt_layers(serialize_payload(self.payload), self.ciphers)
+        self.assertEqual(data, from_packet_data(to_packet_data(data)))
+
+    def test_layer_cipher_is_fernet_compatible(self):
+        key = generate_fernet_key()
+        token = new_cipher(key).encrypt(b"some data")
+        self.assertEqual(b"some data", Fernet(key).decrypt(base64.urlsafe_b64encode(token)))
+
+    def test_wrong_cipher_does_not_decrypt(self):
+        data = encrypt_layer(b"some data", self.ciphers[0])
+        with self.assertRaises(InvalidToken):
+            decrypt_layer(data, self.ciphers[1])
+
+
+class StreamRelayCryptoTestCase(unittest.TestCase):
+    def setUp(self):
+        keys = [generate_fernet_key() for _ in range(3)]
+        self.client = [new_cipher(key, STREAM_MODE, origin=True) for key in keys]
+        self.nodes = [new_cipher(key, STREAM_MODE) for key in keys]
+
+    def send_forward(self, payload):
+        """ returns the index of the node that recognized the payload, and the payload """
+        data = encrypt_layers(payload, self.client)
+        for index, node in enumerate(self.nodes):
+            data = node.decrypt(data)
+            recognized = node.open(data)
+            if recognized is not None:
+                return index, recognized
+        return None, None
+
+    def send_backward(self, payload, origin):
+        data = self.nodes[origin].encrypt(self.nodes[origin].seal(payload))
+        for node in reversed(self.nodes[:origin]):
+            data = node.encrypt(data)
+        return decrypt_layers(data, self.client)
+
+    def test_only_last_node_recognizes_forward_cells(self):
+        for i in range(5):
+            payload = "cell number {}".format(i).encode()
+            self.assertEqual((2, payload), self.send_forward(payload))
+
+    def test_backward_cells_are_recognized_by_client(self):
+        for i in range(5):
+            payload = "answer number {}".format(i).encode()
+            self.assertEqual(payload, self.send_backward(payload, 2))
+
+    def test_backward_cell_from_middle_node(self):
+        self.assertEqual(b"extended", self.send_backward(b"extended", 1))
+        self.assertEqual(b"answer", self.send_backward(b"answer", 2))
+
+    def test_overhead_does_not_depend_on_layer_count(self):
+        payload = b"a" * 1000
+        self.assertEqual(len(payload) + RelayCrypto.HEADER_LENGTH,
+                         len(encrypt_layers(payload, self.client)))
+
+    def test_tampered_cell_is_not_recognized(self):
+        data = bytearray(encrypt_layers(b"some data", self.client))
+        data[-1] ^= 1
+        for node in self.nodes:
+            data = node.decrypt(bytes(data))
+            self.assertIsNone(node.open(data))
+
+
+class PrimeGenerationTestCase(unittest.TestCase):
+    def test_check_if_prime_small_numbers(self):
+        primes = [p for p in range(3000) if all(p % d for d in range(2, int(p ** 0.5) + 1)) and p > 1]
+        self.assertEqual(primes, [p for p in range(3000) if checkIfPrime(p)])
+
+    def test_check_if_prime_large_numbers(self):
+        self.assertTrue(checkIfPrime(2**127 - 1))
+        self.assertFalse(checkIfPrime((2**89 - 1) * (2**61 - 1)))
+        # no factor in the small prime table: only Miller-Rabin can reject it
+        self.assertFalse(checkIfPrime((2**61 - 1) * (2**31 - 1)))
+
+    def test_large_prime_has_requested_length(self):
+        for length in (64, 200, 256):
+            prime = getLargePrime(length)
+            self.assertEqual(length, prime.bit_length())
+            self.assertTrue(checkIfPrime(prime))
+
+    def test_small_prime_has_requested_length(self):
+        # every candidate is in the small prime table
+        for length in range(2, 13):
+            prime = getLargePrime(length)
+            self.assertEqual(length, prime.bit_length())
+            self.assertTrue(checkIfPrime(prime))
+
+    def test_rsa_keys_encrypt_and_decrypt_shared_key(self):
+        rsa_keys = get_private_key_rsa()
+        self.assertEqual(DEFAULT_RSA_KEY_SIZE, rsa_keys["modulus"].bit_length())
+        key = generate_fernet_key()
+        ciphertext = encrypt_RSA(key, rsa_keys["public"], rsa_keys["modulus"])
+        self.assertEqual(key, decrypt_RSA(ciphertext, rsa_keys["private"], rsa_keys["modulus"]))
+
+    def test_crt_decryption_equals_plain_decryption(self):
+        rsa_keys = get_private_key_rsa(1024)
+        for _ in range(5):
+            key = generate_fernet_key()
+            ciphertext = encrypt_RSA(key, rsa_keys["public"], rsa_keys["modulus"])
+            self.assertEqual(decrypt_RSA(ciphertext, rsa_keys["private"], rsa_keys["modulus"]),
+                             decrypt_RSA_keys(ciphertext, rsa_keys))
+
+    def test_decrypt_without_crt_parameters(self):
+        rsa_keys = get_private_key_rsa()
+        old_keys = {k: rsa_keys[k] for k in ("modulus", "public", "private")}
+        key = generate_fernet_key()
+        ciphertext = encrypt_RSA(key, rsa_keys["public"], rsa_keys["modulus"])
+        self.assertEqual(key, decrypt_RSA_keys(ciphertext, old_keys))
+
+    def test_buffered_random_read_sizes(self):
+        rng = BufferedRandom(block_size=16)
+        data = b''.join(rng.read(n) for n in (5, 16, 40, 1))
+        self.assertEqual(62, len(data))
+
+    def test_buffered_random_randbelow_in_range(self):
+        rng = BufferedRandom()
+        for n in (2, 3, 1000, 2**130 + 1):
+            self.assertTrue(all(0 <= rng.randbelow(n) < n for _ in range(100)))
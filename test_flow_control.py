@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+import asyncio
+import threading
+import time
+import unittest
+
+import flow_control as fc
+
+
+class SendWindowTestCase(unittest.TestCase):
+    def test_closed_window_waits_for_sendme(self):
+        window = fc.SendWindow(size=100, increment=50)
+        self.assertTrue(window.consume(60))
+        self.assertFalse(window.consume(60, timeout=0.05))
+        self.assertEqual(40, window.available)
+
+        threading.Timer(0.05, window.replenish).start()
+        self.assertTrue(window.consume(60, timeout=5))
+        self.assertEqual(30, window.available)
+
+    def test_window_is_never_overdrawn(self):
+        window = fc.SendWindow(size=100, increment=50)
+        self.assertTrue(window.consume(100))
+        self.assertFalse(window.consume(1, timeout=0.05))
+        self.assertEqual(0, window.available)
+
+    def test_fragment_larger_than_the_window_waits_for_all_of_it(self):
+        window = fc.SendWindow(size=10, increment=10)
+        self.assertTrue(window.consume(1))
+        self.assertFalse(window.consume(20, timeout=0.05))
+        window.refund(1)
+        self.assertTrue(window.consume(20, timeout=0.05))
+
+    def test_sendme_beyond_the_window_is_refused(self):
+        window = fc.SendWindow(size=100, increment=50)
+        self.assertFalse(window.replenish())
+        window.consume(50)
+        self.assertTrue(window.replenish())
+        self.assertEqual(100, window.available)
+
+    def test_consume_async(self):
+        window = fc.SendWindow(size=10, increment=10)
+
+        async def consume():
+            self.assertTrue(await window.consume_async(10))
+            self.assertFalse(await window.consume_async(1, timeout=0.05))
+            asyncio.get_running_loop().call_later(0.05, window.replenish)
+            start = time.monotonic()
+            self.assertTrue(await window.consume_async(1, timeout=5))
+            return time.monotonic() - start
+
+        self.assertLess(asyncio.run(consume()), 5)
+        self.assertEqual(9, window.available)
+
+
+class ConsumeAllTestCase(unittest.TestCase):
+    def test_credit_is_taken_from_every_window(self):
+        stream = fc.SendWindow(size=50, increment=10)
+        circuit = fc.SendWindow(size=100, increment=10)
+        self.assertTrue(fc.consume_all((stream, circuit), 30))
+        self.assertEqual((20, 70), (stream.available, circuit.available))
+
+    def test_credit_is_given_back_on_timeout(self):
+        stream = fc.SendWindow(size=50, increment=10)
+        circuit = fc.SendWindow(size=100, increment=10)
+        circuit.consume(90)
+        self.assertFalse(fc.consume_all((stream, circuit), 30, timeout=0.05))
+        self.assertEqual((50, 10), (stream.available, circuit.available))
+
+    def test_credit_is_given_back_on_timeout_async(self):
+        stream = fc.SendWindow(size=50, increment=10)
+        circuit = fc.SendWindow(size=100, increment=10)
+        circuit.consume(90)
+        self.assertFalse(asyncio.run(fc.consume_all_async((stream, circuit), 30, timeout=0.05)))
+        self.assertEqual((50, 10), (stream.available, circuit.available))
+
+
+class ReceiveWindowTestCase(unittest.TestCase):
+    def test_one_sendme_per_increment(self):
+        window = fc.ReceiveWindow(increment=100)
+        self.assertEqual(0, window.deliver(99))
+        self.assertEqual(1, window.deliver(1))
+        self.assertEqual(3, window.deliver(350))
+        self.assertEqual(50, window.delivered)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+
+import socket
+import threading
+import unittest
+
+import framing
+
+
+class FrameDecoderTestCase(unittest.TestCase):
+    def test_frames_split_at_every_byte(self):
+        messages = [b"", b"{", b"hello", bytes(range(256)) * 40]
+        stream = b"".join(framing.encode_frame(message) for message in messages)
+
+        decoder = framing.FrameDecoder()
+        received = []
+        for i in range(len(stream)):
+            decoder.feed(stream[i:i + 1])
+            received.extend(decoder)
+        self.assertEqual(messages, received)
+        self.assertEqual(0, decoder.buffered)
+
+    def test_incomplete_frame_is_kept(self):
+        decoder = framing.FrameDecoder()
+        frame = framing.encode_frame(b"abcdef")
+        decoder.feed(frame[:-1])
+        self.assertIsNone(decoder.next_frame())
+        decoder.feed(frame[-1:] + frame[:3])
+        self.assertEqual(b"abcdef", decoder.next_frame())
+        self.assertIsNone(decoder.next_frame())
+        self.assertEqual(3, decoder.buffered)
+
+    def test_too_large_frame_is_rejected(self):
+        decoder = framing.FrameDecoder(max_frame_size=10)
+        decoder.feed(framing.encode_frame(b"x" * 11))
+        with self.assertRaises(ValueError):
+            decoder.next_frame()
+
+    def test_large_frame_grows_then_shrinks_buffer(self):
+        decoder = framing.FrameDecoder(buffer_size=16)
+        decoder.feed(framing.encode_frame(b"z" * 100) + framing.encode_frame(b"small"))
+        self.assertEqual(b"z" * 100, decoder.next_frame())
+        decoder.feed(framing.encode_frame(b"after"))
+        self.assertEqual([b"small", b"after"], list(decoder))
+        decoder.feed(b"x" * 10)
+        self.assertEqual(16, len(decoder._buffer))
+
+    def test_recv_into_and_views(self):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            messages = [b"a" * 10, b"b" * 5000, b"c"]
+            sender.sendall(b"".join(framing.encode_frame(message) for message in messages))
+            sender.shutdown(socket.SHUT_WR)
+
+            decoder = framing.FrameDecoder(buffer_size=64)
+            received = []
+            while decoder.recv_into(receiver):
+                for message in decoder.views():
+                    self.assertIsInstance(message, memoryview)
+                    received.append(bytes(message))
+            self.assertEqual(messages, received)
+            self.assertEqual(0, decoder.buffered)
+
+class FrameReaderTestCase(unittest.TestCase):
+    def test_read_frames_from_socket(self):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            large_message = b"y" * 300000
+
+            def send():
+                framing.send_frame(sender, b"first")
+                framing.send_frame(sender, large_message)
+                sender.shutdown(socket.SHUT_WR)
+            sending_thread = threading.Thread(target=send)
+            sending_thread.start()
+
+            reader = framing.FrameReader(receiver, buffer_size=1000)
+            self.assertEqual(b"first", reader.read_frame())
+            self.assertEqual(large_message, reader.read_frame())
+            self.assertIsNone(reader.read_frame())
+            sending_thread.join()
+
+    def test_read_frame_view(self):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            framing.send_frame(sender, b"first")
+            framing.send_frame(sender, b"second")
+            reader = framing.FrameReader(receiver)
+            first = reader.read_frame_view()
+            self.assertIsInstance(first, memoryview)
+            self.assertEqual(b"first", first)
+            self.assertEqual(b"second", reader.read_frame_view())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+
+import http.client
+import socket
+import threading
+import unittest
+
+import get_request as gr
+import packet_manager as pm
+from node_switchboard import AnswerFragments
+
+
+class WebRequestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.listening_socket = socket.socket()
+        self.listening_socket.bind(("127.0.0.1", 0))
+        self.listening_socket.listen()
+        self.url = "127.0.0.1:{}".format(self.listening_socket.getsockname()[1])
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def tearDown(self):
+        self.listening_socket.close()
+
+    def _serve(self):
+        while True:
+            try:
+                connection, _ = self.listening_socket.accept()
+            except OSError:
+                return
+            with connection:
+                request = connection.recv(4096)
+                if request.startswith(b"GET /truncated "):
+                    # half of the announced body, then the connection is closed
+                    connection.sendall(b"HTTP/1.0 200 OK\r\nContent-Length: 100000\r\n\r\n" + b"z" * 50000)
+                else:
+                    connection.sendall(b"HTTP/1.0 200 OK\r\nContent-Length: 50000\r\n\r\n" + b"z" * 50000)
+
+    def test_complete_answer(self):
+        self.assertEqual(b"z" * 50000, gr.web_request(self.url + "/page"))
+
+    def test_truncated_answer_raises(self):
+        with self.assertRaises(http.client.IncompleteRead):
+            b"".join(gr.web_request_chunks(self.url + "/truncated"))
+        self.assertEqual('', gr.web_request(self.url + "/truncated"))
+
+    def test_truncated_answer_ends_with_a_failed_fragment(self):
+        answer = AnswerFragments(None)
+        fragments = list(answer.fragments(gr.web_request_chunks(self.url + "/truncated", 16384)))
+        self.assertEqual(b"z" * 50000, b"".join(pm.parse_fragment(fragment)[4] for fragment in fragments))
+        self.assertTrue(pm.parse_fragment(fragments[-1])[2])
+        self.assertTrue(pm.fragment_failed(fragments[-1]))
+        self.assertFalse(any(map(pm.fragment_failed, fragments[:-1])))
+
+
+if __name__ == '__main__':
+    unittest.main()
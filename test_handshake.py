@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+import unittest
+
+import encryption as enc
+import handshake as hs
+import packet_manager as pm
+from errors import OnionRuntimeError
+
+
+class NtorHandshakeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.ntor_keys = hs.generate_ntor_keys()
+        self.node = {
+            'ip': "127.0.0.1",
+            'port': 12346,
+            'handshake': hs.NTOR_HANDSHAKE,
+            'ntor_key': self.ntor_keys['public']
+        }
+
+    def server_reply(self, data, node_id="127.0.0.1:12346"):
+        return hs.server_reply(hs.NTOR_HANDSHAKE, data, node_id, ntor_keys=self.ntor_keys)
+
+    def test_both_sides_derive_the_same_key(self):
+        state, data = hs.client_create(self.node)
+        server_key, reply = self.server_reply(data)
+        client_key = hs.client_finish(self.node, state, reply)
+        self.assertEqual(server_key, client_key)
+
+    def test_key_works_with_every_relay_crypto_mode(self):
+        state, data = hs.client_create(self.node)
+        server_key, reply = self.server_reply(data)
+        client_key = hs.client_finish(self.node, state, reply)
+        for mode in (enc.FERNET_MODE, enc.STREAM_MODE):
+            client = enc.new_cipher(client_key, mode, origin=True)
+            server = enc.new_cipher(server_key, mode)
+            self.assertEqual(b"hello", server.open(server.decrypt(client.encrypt(client.seal(b"hello")))))
+
+    def test_handshakes_give_different_keys(self):
+        keys = set()
+        for _ in range(3):
+            state, data = hs.client_create(self.node)
+            keys.add(self.server_reply(data)[0])
+        self.assertEqual(3, len(keys))
+
+    def test_reply_from_another_node_is_rejected(self):
+        state, data = hs.client_create(self.node)
+        _, reply = self.server_reply(data, node_id="127.0.0.1:9999")
+        with self.assertRaises(OnionRuntimeError):
+            hs.client_finish(self.node, state, reply)
+
+    def test_tampered_reply_is_rejected(self):
+        state, data = hs.client_create(self.node)
+        _, reply = self.server_reply(data)
+        tampered = reply[:-1] + bytes([reply[-1] ^ 1])
+        with self.assertRaises(OnionRuntimeError):
+            hs.client_finish(self.node, state, tampered)
+
+    def test_truncated_reply_is_rejected(self):
+        state, data = hs.client_create(self.node)
+        _, reply = self.server_reply(data)
+        with self.assertRaises(OnionRuntimeError):
+            hs.client_finish(self.node, state, reply[:40])
+
+
+class RsaHandshakeTestCase(unittest.TestCase):
+    def test_both_sides_derive_the_same_key(self):
+        rsa_keys = enc.get_private_key_rsa()
+        node = {'ip': "127.0.0.1", 'port': 12346,
+                'public_exp': rsa_keys['public'], 'modulus': rsa_keys['modulus']}
+        self.assertEqual(hs.RSA_HANDSHAKE, hs.get_handshake(node))
+
+        state, data = hs.client_create(node)
+        server_key, reply = hs.server_reply(hs.RSA_HANDSHAKE, data, "127.0.0.1:12346", rsa_keys=rsa_keys)
+        self.assertEqual(b'', reply)
+        self.assertEqual(server_key, hs.client_finish(node, state, reply))
+
+
+class CreatedPayloadTestCase(unittest.TestCase):
+    def test_pack_and_parse(self):
+        created = pm.new_created_payload(b"reply", b"confirmation")
+        self.assertEqual((b"reply", b"confirmation"), pm.parse_created_payload(created))
+
+    def test_empty_reply(self):
+        created = pm.new_created_payload(b"", b"confirmation")
+        self.assertEqual((b"", b"confirmation"), pm.parse_created_payload(created))
+
+
+if __name__ == '__main__':
+    unittest.main()
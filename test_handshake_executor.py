@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+import time
+import unittest
+
+import handshake as hs
+from errors import OnionOverloadError
+from handshake_executor import HandshakeExecutor
+
+NODE_ID = "127.0.0.1:12346"
+
+
+def settled_metrics(executor):
+    """ metrics once the done callbacks of the finished handshakes have run """
+    deadline = time.time() + 5
+    while executor.depth > 0 and time.time() < deadline:
+        time.sleep(0.01)
+    return executor.metrics()
+
+
+class HandshakeExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.ntor_keys = hs.generate_ntor_keys()
+        self.node = {
+            'ip': "127.0.0.1",
+            'port': 12346,
+            'handshake': hs.NTOR_HANDSHAKE,
+            'ntor_key': self.ntor_keys['public']
+        }
+
+    def test_handshake_in_worker_process(self):
+        with HandshakeExecutor(NODE_ID, ntor_keys=self.ntor_keys, max_workers=1) as executor:
+            state, data = hs.client_create(self.node)
+            key, reply = executor.server_reply(hs.NTOR_HANDSHAKE, data)
+            self.assertEqual(key, hs.client_finish(self.node, state, reply))
+
+            metrics = settled_metrics(executor)
+            self.assertEqual(1, metrics['completed'])
+            self.assertEqual(0, metrics['queue_depth'])
+            self.assertGreater(metrics['mean_latency'], 0)
+
+    def test_full_queue_rejects_handshakes(self):
+        with HandshakeExecutor(NODE_ID, ntor_keys=self.ntor_keys, max_workers=1, max_pending=0) as executor:
+            _, data = hs.client_create(self.node)
+            with self.assertRaises(OnionOverloadError):
+                executor.submit(hs.NTOR_HANDSHAKE, data)
+            self.assertEqual(1, executor.metrics()['rejected'])
+
+    def test_invalid_handshake_fails(self):
+        with HandshakeExecutor(NODE_ID, ntor_keys=self.ntor_keys, max_workers=1) as executor:
+            with self.assertRaises(ValueError):
+                executor.server_reply(hs.NTOR_HANDSHAKE, "AAAA")
+            self.assertEqual(1, settled_metrics(executor)['failed'])
+
+    def test_closed_executor_rejects_handshakes(self):
+        executor = HandshakeExecutor(NODE_ID, ntor_keys=self.ntor_keys, max_workers=1)
+        executor.close()
+        _, data = hs.client_create(self.node)
+        with self.assertRaises(OnionOverloadError):
+            executor.submit(hs.NTOR_HANDSHAKE, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,6 +11,7 @@ import onion_client
 from onion_client import OnionClient
 
 from node import DirectoryNode, OnionNode
+from key_pool import KeyPool
 
 STARTING_PORT = 50000
 NODE_COUNT = 3
@@ -165,9 +166,10 @@ def generate_nodes():
     """
     directory_node = DirectoryNode(ip=DIR_IP, port=DIR_PORT)
     onion_nodes = []
-    for i in range(NODE_COUNT):
-        node_receiving_port = STARTING_PORT + i + 1
-        node = OnionNode(ip=socket.gethostname(), port=node_receiving_port)
-        onion_nodes.append(node)
+    with KeyPool(target_depth=NODE_COUNT) as key_pool:
+        for i in range(NODE_COUNT):
+            node_receiving_port = STARTING_PORT + i + 1
+            node = OnionNode(ip=socket.gethostname(), port=node_receiving_port, key_pool=key_pool)
+            onion_nodes.append(node)
 
     return directory_node, onion_nodes
@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+
+import time
+import unittest
+
+import encryption as enc
+from key_pool import KeyPool
+
+
+class KeyPoolTestCase(unittest.TestCase):
+    def assert_valid_keys(self, rsa_keys):
+        key = enc.generate_fernet_key()
+        ciphertext = enc.encrypt_RSA(key, rsa_keys["public"], rsa_keys["modulus"])
+        self.assertEqual(key, enc.decrypt_RSA(ciphertext, rsa_keys["private"], rsa_keys["modulus"]))
+
+    def test_pool_fills_up_to_target_depth(self):
+        with KeyPool(target_depth=2, max_workers=2) as key_pool:
+            deadline = time.time() + 30
+            while key_pool.depth < 2 and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(2, key_pool.depth)
+
+    def test_keys_from_pool_are_valid_and_distinct(self):
+        with KeyPool(target_depth=3, max_workers=3) as key_pool:
+            all_keys = [key_pool.get_keys() for _ in range(3)]
+        for rsa_keys in all_keys:
+            self.assert_valid_keys(rsa_keys)
+        self.assertEqual(3, len({rsa_keys["modulus"] for rsa_keys in all_keys}))
+
+    def test_pool_does_not_generate_more_than_max_keys(self):
+        with KeyPool(target_depth=2, max_workers=2, max_keys=3) as key_pool:
+            all_keys = [key_pool.get_keys() for _ in range(3)]
+            self.assertEqual(3, key_pool._scheduled)
+            self.assertEqual(0, key_pool.depth)
+        self.assertEqual(3, len({rsa_keys["modulus"] for rsa_keys in all_keys}))
+
+    def test_empty_pool_generates_keys_inline(self):
+        with KeyPool(target_depth=0, max_workers=1) as key_pool:
+            rsa_keys = key_pool.get_keys()
+        self.assert_valid_keys(rsa_keys)
+
+    def test_closed_pool_generates_keys_inline(self):
+        key_pool = KeyPool(target_depth=1, max_workers=1)
+        key_pool.close()
+        self.assert_valid_keys(key_pool.get_keys())
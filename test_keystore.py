@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+import os
+import stat
+import tempfile
+import unittest
+
+import encryption as enc
+import handshake as hs
+from keystore import KeyStore
+from node import OnionNode
+
+
+class KeyStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.generated = 0
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def generate(self):
+        self.generated += 1
+        return enc.get_private_key_rsa()
+
+    def test_keys_are_reused_after_restart(self):
+        keys = KeyStore(self.directory.name).get_keys("127.0.0.1", 12345, self.generate)
+        reloaded = KeyStore(self.directory.name).get_keys("127.0.0.1", 12345, self.generate)
+        self.assertEqual(keys, reloaded)
+        self.assertEqual(1, self.generated)
+
+    def test_keys_are_per_address(self):
+        keystore = KeyStore(self.directory.name)
+        keys_1 = keystore.get_keys("127.0.0.1", 12345, self.generate)
+        keys_2 = keystore.get_keys("127.0.0.1", 12346, self.generate)
+        self.assertNotEqual(keys_1, keys_2)
+
+    def test_rotate_makes_new_keys(self):
+        keystore = KeyStore(self.directory.name)
+        keys = keystore.get_keys("127.0.0.1", 12345, self.generate)
+        keystore.rotate("127.0.0.1", 12345)
+        self.assertNotEqual(keys, keystore.get_keys("127.0.0.1", 12345, self.generate))
+        self.assertEqual(2, self.generated)
+
+    def test_expired_keys_are_replaced(self):
+        keystore = KeyStore(self.directory.name, max_key_age=-1)
+        keystore.get_keys("127.0.0.1", 12345, self.generate)
+        keystore.get_keys("127.0.0.1", 12345, self.generate)
+        self.assertEqual(2, self.generated)
+
+    def test_key_file_is_private(self):
+        keystore = KeyStore(self.directory.name)
+        keystore.get_keys("127.0.0.1", 12345, self.generate)
+        mode = os.stat(keystore._path("127.0.0.1", 12345)).st_mode
+        self.assertEqual(0o600, stat.S_IMODE(mode))
+
+    def test_node_loads_keys_from_keystore(self):
+        keystore = KeyStore(self.directory.name)
+        node_1 = OnionNode("127.0.0.1", 12345, keystore=keystore)
+        node_2 = OnionNode("127.0.0.1", 12345, keystore=keystore)
+        self.assertEqual(node_1.rsa_keys, node_2.rsa_keys)
+
+    def test_ntor_node_loads_keys_from_keystore(self):
+        keystore = KeyStore(self.directory.name)
+        node_1 = OnionNode("127.0.0.1", 12345, keystore=keystore, handshake=hs.NTOR_HANDSHAKE)
+        node_2 = OnionNode("127.0.0.1", 12345, keystore=keystore, handshake=hs.NTOR_HANDSHAKE)
+        self.assertEqual(node_1.ntor_keys, node_2.ntor_keys)
+        self.assertIsNone(node_1.rsa_keys)
+        self.assertEqual(hs.NTOR_HANDSHAKE, node_1.descriptor()['handshake'])
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+import socket
+import threading
+import time
+import unittest
+
+import packet_manager as pm
+from links import LinkManager
+
+
+class LinkManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.listening_socket = socket.socket()
+        self.listening_socket.bind(("127.0.0.1", 0))
+        self.listening_socket.listen()
+        self.port = self.listening_socket.getsockname()[1]
+        self.links = []
+        self.manager = LinkManager(self.links.append)
+
+    def tearDown(self):
+        self.manager.close()
+        self.listening_socket.close()
+
+    def test_link_is_reused_for_every_circuit(self):
+        link = self.manager.get_link("127.0.0.1", self.port)
+        self.assertIs(link, self.manager.get_link("127.0.0.1", str(self.port)))
+        self.assertEqual([link], self.links)
+        self.assertTrue(link.outbound)
+        self.assertEqual(1, link.sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+        self.assertNotEqual(0, link.sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+
+        accepted_socket, address = self.listening_socket.accept()
+        inbound = self.manager.accept(accepted_socket, address)
+        for circID in (1, 2):
+            link.send(pm.new_relay_packet(circID, "relay_data", b"x" * 900))
+        circIDs = [pm.parse_cell_header(inbound.read_cell())[0] for _ in range(2 * pm.cell_count(900))]
+        self.assertEqual([1, 1, 2, 2], circIDs)
+
+    def test_neighbour_is_connected_to_once(self):
+        links = []
+
+        def get_link():
+            links.append(self.manager.get_link("127.0.0.1", self.port))
+        threads = [threading.Thread(target=get_link) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(5, len(links))
+        self.assertEqual(1, len(set(links)))
+        self.assertEqual(links[:1], self.links)
+
+    def test_slow_neighbour_does_not_hold_the_other_links(self):
+        # a neighbour whose backlog is full: connecting to it lasts until the timeout
+        with socket.socket() as slow_socket:
+            slow_socket.bind(("127.0.0.1", 0))
+            slow_socket.listen(0)
+            backlog = []
+            for _ in range(3):
+                pending = socket.socket()
+                pending.setblocking(False)
+                pending.connect_ex(slow_socket.getsockname())
+                backlog.append(pending)
+
+            self.manager.connect_timeout = 2
+            connecting = threading.Thread(target=self._get_link_or_fail, args=slow_socket.getsockname())
+            connecting.start()
+            time.sleep(0.1)
+            start = time.monotonic()
+            self.manager.get_link("127.0.0.1", self.port)
+            self.assertLess(time.monotonic() - start, 1)
+            connecting.join(5)
+            for pending in backlog:
+                pending.close()
+
+    def _get_link_or_fail(self, ip, port):
+        try:
+            self.manager.get_link(ip, port)
+        except OSError:
+            pass
+
+    def test_closed_link_is_replaced(self):
+        link = self.manager.get_link("127.0.0.1", self.port)
+        self.manager.link_closed(link)
+        self.assertIsNot(link, self.manager.get_link("127.0.0.1", self.port))
+
+    def test_circuits_are_forgotten_with_their_link(self):
+        client_socket = socket.create_connection(("127.0.0.1", self.port))
+        with client_socket:
+            accepted_socket, address = self.listening_socket.accept()
+            inbound = self.manager.accept(accepted_socket, address)
+            self.manager.set_circuit_link(7, inbound)
+            self.assertIs(inbound, self.manager.get_circuit_link(7))
+
+            client_socket.close()
+            self.assertIsNone(inbound.read_cell())
+            self.manager.link_closed(inbound)
+            self.assertIsNone(self.manager.get_circuit_link(7))
+            self.assertEqual(0, self.manager.metrics()['inbound_links'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,7 @@
 import json
 import unittest
 
-from messaging import OnionMessage
+from messaging import OnionMessage, IpInfo
 
 
 class ToFromJsonCase(unittest.TestCase):
@@ -57,3 +57,40 @@ class ToFromJsonCase(unittest.TestCase):
         str1 = obj1.to_json_string()
         str2 = json.dumps(obj2)
         self.assertEqual(str1, str2)
+
+
+class OnionMessageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.message = OnionMessage(
+            source=IpInfo("127.0.0.1", 12345),
+            destination=IpInfo("127.0.0.1", 12346),
+            data={"value": 10}
+        )
+
+    def test_has_no_instance_dict(self):
+        with self.assertRaises(AttributeError):
+            self.message.__dict__
+
+    def test_serialization_is_cached(self):
+        self.assertIs(self.message.to_bytes(), self.message.to_bytes())
+        self.assertIs(self.message.to_json_string(), self.message.to_json_string())
+
+    def test_assigning_a_field_drops_the_cache(self):
+        before = self.message.to_bytes()
+        self.message.data = {"value": 11}
+        self.assertNotEqual(before, self.message.to_bytes())
+        self.assertEqual({"value": 11}, json.loads(self.message.to_bytes())["data"])
+
+    def test_decoded_message_equals_original(self):
+        decoded = OnionMessage.from_json_string(self.message.to_bytes())
+        self.assertEqual(self.message, decoded)
+        self.assertEqual(IpInfo("127.0.0.1", 12345), decoded.source)
+
+        decoded.data = {"value": 11}
+        self.assertNotEqual(self.message, decoded)
+
+    def test_parse(self):
+        self.assertEqual(self.message, OnionMessage.parse(self.message.to_json_string()))
+        self.assertIsNone(OnionMessage.parse("{"))
+        self.assertIsNone(OnionMessage.parse('{"unknown": 1}'))
+
@@ -1,7 +1,11 @@
 #!/usr/bin/python3
+import socket
 import unittest
 import time
 from node import *
+import encryption as enc
+import handshake as hs
+import packet_manager as pm
 
 
 class NodeTestCase(unittest.TestCase):
@@ -18,3 +22,77 @@ class NodeTestCase(unittest.TestCase):
         time.sleep(1)
         dir_node.stop()
         onion_node.stop()
+
+
+class ServingNodeTestCase(unittest.TestCase):
+    """ a node serving raw connections, which play the previous node of its circuits """
+
+    def start_node(self, **kwargs):
+        with socket.socket() as free_socket:
+            free_socket.bind(("127.0.0.1", 0))
+            self.port = free_socket.getsockname()[1]
+        self.node = OnionNode("127.0.0.1", self.port, handshake=hs.NTOR_HANDSHAKE,
+                              handshake_workers=0, **kwargs)
+        # no directory node: the node only answers its neighbours
+        self.node.initialized = True
+        self.node.start()
+        self.addCleanup(self.node.join, 5)
+        self.addCleanup(self.node.stop)
+
+    def connect(self):
+        deadline = time.time() + 5
+        while True:
+            try:
+                sock = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+                break
+            except ConnectionRefusedError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.addCleanup(sock.close)
+        return sock
+
+    def create(self, sock, circID):
+        """ sends a "create" packet; returns the command of the answer, None if the connection was closed """
+        _, handshake_data = hs.client_create(self.node.descriptor())
+        payload = pm.new_payload("127.0.0.1", 1, handshake_data, enc.FERNET_MODE, hs.NTOR_HANDSHAKE)
+        pm.send_packet(sock, pm.new_control_packet(circID, "create", payload))
+        reader = pm.new_cell_reader(sock)
+        packets = pm.PacketAssembler()
+        while True:
+            try:
+                cell = pm.recv_cell(reader)
+            except ConnectionResetError:
+                return None
+            if cell is None:
+                return None
+            circID, command, length = pm.parse_cell_header(cell)
+            if packets.add(circID, command, length, pm.cell_body(cell)) is not None:
+                return command
+
+    def check_cells_of_unknown_circuits_are_dropped(self, engine):
+        self.start_node(engine=engine)
+        sock = self.connect()
+        pm.send_packet(sock, pm.new_relay_packet(4242, "relay_data", b"x" * 1000))
+        pm.send_packet(sock, pm.new_relay_packet(4242, "relay_ans", b"x" * 1000))
+        pm.send_packet(sock, pm.new_relay_packet(4242, "sendme", b""))
+        # the link, and the other circuits on it, are still served
+        self.assertEqual("created", self.create(sock, 7))
+
+    def test_cells_of_unknown_circuits_are_dropped(self):
+        self.check_cells_of_unknown_circuits_are_dropped(THREAD_ENGINE)
+
+    def test_cells_of_unknown_circuits_are_dropped_async(self):
+        self.check_cells_of_unknown_circuits_are_dropped(ASYNCIO_ENGINE)
+
+    def test_connection_past_the_workers_is_refused(self):
+        self.start_node(connection_workers=1, max_connection_wait=0.5)
+        first = self.connect()
+        self.assertEqual("created", self.create(first, 7))
+        # the only worker serves the first link until it is closed: the
+        # second connection is closed instead of left unanswered
+        second = self.connect()
+        self.assertIsNone(self.create(second, 8))
+        self.assertEqual(1, self.node.connection_pool.metrics()['expired'])
+        # the first link is still served
+        self.assertEqual("created", self.create(first, 9))
@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+
+import socket
+import unittest
+
+import encryption as enc
+import framing
+import packet_manager as pm
+
+
+def reassemble(cells):
+    """ the packets carried by cells, as (circID, command, body) """
+    packets = pm.PacketAssembler()
+    received = []
+    for offset in range(0, len(cells), pm.CELL_SIZE):
+        cell = cells[offset:offset + pm.CELL_SIZE]
+        circID, command, length = pm.parse_cell_header(cell)
+        body = packets.add(circID, command, length, pm.cell_body(cell))
+        if body is not None:
+            received.append((circID, command, bytes(body)))
+    return received
+
+
+class CellTestCase(unittest.TestCase):
+    def test_relay_packet_roundtrip(self):
+        for size in (0, 1, pm.CELL_BODY_SIZE, pm.CELL_BODY_SIZE + 1, 100000):
+            data = bytes(range(256)) * (size // 256) + bytes(size % 256)
+            cells = pm.new_relay_packet(42, "relay_data", data)
+            self.assertEqual(0, len(cells) % pm.CELL_SIZE)
+            self.assertEqual(max(1, -(-size // pm.CELL_BODY_SIZE)), len(cells) // pm.CELL_SIZE)
+            self.assertEqual([(42, "relay_data", data)], reassemble(cells))
+
+    def test_control_packet_roundtrip(self):
+        payload = pm.new_payload("127.0.0.1", 12345, "123456789", "fernet", "rsa")
+        [(circID, command, body)] = reassemble(pm.new_control_packet(7, "create", payload))
+        message = pm.parse_packet(circID, command, body)
+        self.assertEqual("control", message['type'])
+        self.assertEqual(payload, message['payload'])
+
+        [(circID, command, body)] = reassemble(pm.new_control_packet(7, "destroy", pm.DESTROY_RESOURCE_LIMIT))
+        self.assertEqual(pm.DESTROY_RESOURCE_LIMIT, pm.parse_packet(circID, command, body)['payload'])
+
+    def test_cell_count(self):
+        for size in (0, 1, pm.CELL_BODY_SIZE, pm.CELL_BODY_SIZE + 1, 20000):
+            self.assertEqual(len(pm.new_relay_packet(1, "relay_ans", bytes(size))) // pm.CELL_SIZE,
+                             pm.cell_count(size))
+
+    def test_route_from_header(self):
+        cells = pm.new_relay_packet(1234, "extend", b"x" * 2000)
+        circID, command, length = pm.parse_cell_header(cells[:pm.ROUTING_HEADER.size])
+        self.assertEqual((1234, "extend", 2000), (circID, command, length))
+        self.assertEqual((1234, "extend", 2000 - pm.CELL_BODY_SIZE),
+                         pm.parse_cell_header(cells[pm.CELL_SIZE:]))
+
+    def test_cells_of_packets_are_not_mixed(self):
+        first = pm.new_relay_packet(1, "relay_ans", b"x" * 1000)
+        second = pm.new_relay_packet(1, "relay_ans", b"y" * 1000)
+        with self.assertRaises(ValueError):
+            reassemble(first[:pm.CELL_SIZE] + second)
+        packets = pm.PacketAssembler()
+        packets.add(1, "relay_ans", 1000, pm.cell_body(first))
+        packets.remove(1)
+        self.assertEqual([(1, "relay_ans", b"y" * 1000)], reassemble(second))
+
+    def test_cells_of_circuits_are_gathered_apart(self):
+        first = pm.new_relay_packet(1, "relay_ans", b"x" * 1000)
+        second = pm.new_relay_packet(2, "relay_ans", b"y" * 1000)
+        mixed = b''.join(cells[offset:offset + pm.CELL_SIZE]
+                         for offset in range(0, len(first), pm.CELL_SIZE)
+                         for cells in (first, second))
+        self.assertEqual([(1, "relay_ans", b"x" * 1000), (2, "relay_ans", b"y" * 1000)],
+                         reassemble(mixed))
+
+    def test_unknown_commands_are_rejected(self):
+        header = pm.CELL_HEADER.pack(1, 0, 0, 0, bytes(4))
+        with self.assertRaises(ValueError):
+            pm.parse_cell_header(header)
+
+    def test_recv_cell(self):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            data = b"y" * 5000
+            pm.send_packet(sender, pm.new_relay_packet(5, "relay_ans", data))
+            pm.send_packet(sender, pm.new_relay_packet(6, "extended", b"z"))
+            reader = pm.new_cell_reader(receiver)
+            cells = [bytes(pm.recv_cell(reader)) for _ in range(pm.cell_count(len(data)) + 1)]
+            self.assertEqual([(5, "relay_ans", data), (6, "extended", b"z")], reassemble(b''.join(cells)))
+            sender.close()
+            self.assertIsNone(pm.recv_cell(reader))
+
+    def test_packets_outlive_the_buffer_of_the_reader(self):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            first, second = b"a" * 3000, b"b" * 3000
+            pm.send_packet(sender, pm.new_relay_packet(1, "relay_ans", first))
+            pm.send_packet(sender, pm.new_relay_packet(2, "relay_ans", second))
+            reader = framing.FrameReader(receiver, buffer_size=pm.CELL_SIZE, record_size=pm.CELL_SIZE)
+            packets = pm.PacketAssembler()
+            received = []
+            while len(received) < 2:
+                cell = pm.recv_cell(reader)
+                circID, command, length = pm.parse_cell_header(cell)
+                body = packets.add(circID, command, length, pm.cell_body(cell))
+                if body is not None:
+                    received.append(body)
+            self.assertEqual([first, second], received)
+
+
+class SealedCellTestCase(unittest.TestCase):
+    def setUp(self):
+        keys = [enc.generate_fernet_key() for _ in range(3)]
+        self.client = [enc.new_cipher(key, enc.STREAM_MODE, origin=True) for key in keys]
+        self.nodes = [enc.new_cipher(key, enc.STREAM_MODE) for key in keys]
+
+    def relay(self, cells, cipher):
+        """ what a node does with the cells of a packet going forwards (see NodeSwitchboard._relay_forward) """
+        relayed, recognized = [], []
+        for offset in range(0, len(cells), pm.CELL_SIZE):
+            cell = cells[offset:offset + pm.CELL_SIZE]
+            circID, command, length = pm.parse_cell_header(cell)
+            decrypted = enc.decrypt_layer(pm.sealed_body(cell), cipher)
+            data = cipher.open(decrypted)
+            if data is None:
+                relayed.append(pm.new_cell(circID + 1, command, length, decrypted))
+            else:
+                recognized.append(bytes(data[:min(length, pm.CELL_BODY_SIZE)]))
+        return b''.join(relayed), b''.join(recognized)
+
+    def test_cells_are_recognized_by_the_last_node_only(self):
+        payload = bytes(range(256)) * 10
+        cells = pm.new_sealed_packet(1, "relay_data", payload, self.client)
+        self.assertEqual(pm.cell_count(len(payload)) * pm.CELL_SIZE, len(cells))
+        for node in self.nodes[:-1]:
+            cells, recognized = self.relay(cells, node)
+            self.assertEqual(b"", recognized)
+        cells, recognized = self.relay(cells, self.nodes[-1])
+        self.assertEqual((b"", payload), (cells, recognized))
+
+    def test_cells_after_a_corrupted_cell_are_not_recognized(self):
+        cells = bytearray(pm.new_sealed_packet(1, "relay_data", b"x" * 1000, self.client[:1]))
+        self.assertEqual(3 * pm.CELL_SIZE, len(cells))
+        cells[pm.CELL_SIZE + pm.CELL_HEADER_SIZE] ^= 1
+        relayed, recognized = self.relay(bytes(cells), self.nodes[0])
+        self.assertEqual(b"x" * pm.CELL_BODY_SIZE, recognized)
+        self.assertEqual(2 * pm.CELL_SIZE, len(relayed))
+
+
+class FragmentTestCase(unittest.TestCase):
+    def test_fragment_roundtrip(self):
+        data = b"z" * pm.FRAGMENT_DATA_SIZE
+        self.assertEqual((1, 3, False, False, data), pm.parse_fragment(pm.new_fragment(1, 3, data)))
+        self.assertEqual((2, 4, True, True, b""),
+                         pm.parse_fragment(pm.new_fragment(2, 4, b"", last=True, compressed=True)))
+
+    def test_failed_fragment_is_the_last_one(self):
+        fragment = pm.new_fragment(1, 2, b"", failed=True)
+        self.assertEqual((1, 2, True, False, b""), pm.parse_fragment(fragment))
+        self.assertTrue(pm.fragment_failed(fragment))
+        self.assertFalse(pm.fragment_failed(pm.new_fragment(1, 2, b"", last=True)))
+
+    def test_incomplete_fragment_is_rejected(self):
+        with self.assertRaises(ValueError):
+            pm.parse_fragment(pm.new_fragment(1, 1, b"")[:-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,15 @@
 #!/usr/bin/python3
 
 import unittest
+import threading
 from threading import Thread
 import socket
 import sys
 import time
 import json
 
-from relaying import IntermediateRelay, SocketReader
+from relaying import IntermediateRelay, RelayMultiplexer, SocketReader
+import framing
 
 HOST = socket.gethostname()
 PORT = 12350
@@ -71,9 +73,9 @@ class IntermediateRelayTestCase(unittest.TestCase):
         )
         relay.start()
 
-        self.socket_a.sendall(test_message.encode())
+        framing.send_frame(self.socket_a, test_message.encode())
 
-        received_bytes = self.socket_d.recv(1024)
+        received_bytes = framing.recv_frame(self.socket_d)
         received_string = str(received_bytes, encoding="UTF-8")
         received_obj = json.loads(received_bytes)
         self.assertEqual(sent_obj, received_obj)
@@ -88,9 +90,9 @@ class IntermediateRelayTestCase(unittest.TestCase):
         )
         relay.start()
 
-        self.socket_d.sendall(test_message.encode())
+        framing.send_frame(self.socket_d, test_message.encode())
 
-        received_bytes = self.socket_a.recv(1024)
+        received_bytes = framing.recv_frame(self.socket_a)
         received_string = str(received_bytes, encoding="UTF-8")
         received_obj = json.loads(received_bytes)
         self.assertEqual(sent_obj, received_obj)
@@ -106,9 +108,9 @@ class IntermediateRelayTestCase(unittest.TestCase):
         )
         relay.start()
 
-        self.socket_a.sendall(test_message.encode())
+        framing.send_frame(self.socket_a, test_message.encode())
 
-        received_bytes = self.socket_d.recv(1024)
+        received_bytes = framing.recv_frame(self.socket_d)
         received_string = str(received_bytes, encoding="UTF-8")
         received_obj = json.loads(received_bytes)
         expected = sent_obj['value'] * 2
@@ -127,9 +129,9 @@ class IntermediateRelayTestCase(unittest.TestCase):
         )
         relay.start()
 
-        self.socket_d.sendall(test_message.encode())
+        framing.send_frame(self.socket_d, test_message.encode())
 
-        received_bytes = self.socket_a.recv(1024)
+        received_bytes = framing.recv_frame(self.socket_a)
         received_string = str(received_bytes, encoding="UTF-8")
         received_obj = json.loads(received_bytes)
         expected = sent_obj['value'] ** 2
@@ -179,6 +181,84 @@ class IntermediateRelayTestCase(unittest.TestCase):
             detected to be closed for your platform here.""")
 
 
+class RelayMultiplexerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.multiplexer = RelayMultiplexer(max_pending_bytes=1000)
+        self.multiplexer.start()
+
+    def tearDown(self):
+        self.multiplexer.stop()
+
+    def test_many_relays_in_one_thread(self):
+        threads_before = threading.active_count()
+        pairs = []
+        for _ in range(20):
+            socket_a, socket_b = socket.socketpair()
+            socket_c, socket_d = socket.socketpair()
+            IntermediateRelay(socket_b, socket_c, left_to_right=double_value,
+                              multiplexer=self.multiplexer).start()
+            pairs.append((socket_a, socket_d))
+        self.assertEqual(threads_before, threading.active_count())
+
+        for value, (socket_a, socket_d) in enumerate(pairs):
+            framing.send_frame(socket_a, json.dumps({"value": value}).encode())
+        for value, (socket_a, socket_d) in enumerate(pairs):
+            self.assertEqual({"value": value * 2}, json.loads(framing.recv_frame(socket_d)))
+            socket_a.close()
+            socket_d.close()
+
+    def test_messages_are_sent_before_closing(self):
+        socket_a, socket_b = socket.socketpair()
+        socket_c, socket_d = socket.socketpair()
+        relay = IntermediateRelay(socket_b, socket_c, multiplexer=self.multiplexer)
+        relay.start()
+
+        # more than max_pending_bytes: the relay has to wait for d to read
+        messages = [{"value": "x" * 100, "index": i} for i in range(50)]
+        def send():
+            for message in messages:
+                framing.send_frame(socket_a, json.dumps(message).encode())
+            socket_a.close()
+        sending_thread = threading.Thread(target=send)
+        sending_thread.start()
+
+        reader = framing.FrameReader(socket_d)
+        received = []
+        while True:
+            frame = reader.read_frame()
+            if frame is None:
+                break
+            received.append(json.loads(frame))
+        sending_thread.join()
+        socket_d.close()
+        self.assertEqual(messages, received)
+        self.assertTrue(relay.join(5))
+        self.assertEqual(0, self.multiplexer.relay_count)
+
+    def test_failing_transform_only_closes_its_relay(self):
+        socket_a, socket_b = socket.socketpair()
+        socket_c, socket_d = socket.socketpair()
+        IntermediateRelay(socket_b, socket_c, left_to_right=double_value,
+                          multiplexer=self.multiplexer).start()
+        # no "value": double_value raises KeyError
+        framing.send_frame(socket_a, json.dumps({"other": 1}).encode())
+        socket_d.settimeout(5)
+        self.assertEqual(b'', socket_d.recv(1024))
+        socket_a.close()
+        socket_d.close()
+
+        # the other relays keep being served
+        socket_a, socket_b = socket.socketpair()
+        socket_c, socket_d = socket.socketpair()
+        IntermediateRelay(socket_b, socket_c, left_to_right=double_value,
+                          multiplexer=self.multiplexer).start()
+        framing.send_frame(socket_a, json.dumps({"value": 2}).encode())
+        self.assertEqual({"value": 4}, json.loads(framing.recv_frame(socket_d)))
+        self.assertTrue(self.multiplexer.is_alive())
+        socket_a.close()
+        socket_d.close()
+
+
 def double_value(message):
     message['value'] *= 2
     return message
@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+
+import unittest
+
+import circuit_tables as ct
+import node_switchboard as ns
+from sharded_node import shard_circuit_ids
+
+
+class ShardCircuitIdsTestCase(unittest.TestCase):
+    def test_ranges_are_disjoint(self):
+        ranges = [shard_circuit_ids(index, 7) for index in range(7)]
+        ids = [set(range(lowest, highest + 1)) for lowest, highest in ranges]
+        for index, shard_ids in enumerate(ids):
+            for other in ids[index + 1:]:
+                self.assertFalse(shard_ids & other)
+        lowest, highest = ns.CIRCUIT_IDS
+        for shard_lowest, shard_highest in ranges:
+            self.assertLessEqual(lowest, shard_lowest)
+            self.assertLessEqual(shard_lowest, shard_highest)
+            self.assertLessEqual(shard_highest, highest)
+
+    def test_too_many_shards(self):
+        with self.assertRaises(ValueError):
+            shard_circuit_ids(0, 11, (0, 9))
+
+    def test_switchboard_uses_its_range(self):
+        circuit_ids = shard_circuit_ids(2, 4)
+        switchboard = ns.NodeSwitchboard(None, None, ct.circuit_table(), ct.node_key_table(),
+                                         ct.node_relay_table(), None, '127.0.0.1', 0,
+                                         circuit_ids=circuit_ids)
+        for _ in range(50):
+            circID = switchboard._generate_new_circID()
+            self.assertGreaterEqual(circID, circuit_ids[0])
+            self.assertLessEqual(circID, circuit_ids[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
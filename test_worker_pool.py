@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+import threading
+import time
+import unittest
+
+from errors import OnionOverloadError
+from queues import ClosableQueue
+from worker_pool import WorkerPool
+
+
+class ClosableQueueTestCase(unittest.TestCase):
+    def test_close_stops_every_consumer(self):
+        queue = ClosableQueue(1)
+        consumed = []
+        consumers = [threading.Thread(target=lambda: consumed.extend(queue)) for _ in range(3)]
+        for consumer in consumers:
+            consumer.start()
+        queue.put(1)
+        queue.close()
+        for consumer in consumers:
+            consumer.join(5)
+            self.assertFalse(consumer.is_alive())
+        self.assertEqual([1], consumed)
+        self.assertTrue(queue.closed)
+
+    def test_close_does_not_block_when_full(self):
+        queue = ClosableQueue(1)
+        queue.put(1)
+        queue.close()
+        self.assertEqual([1], list(queue))
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+    def test_items_are_handled(self):
+        handled = []
+        with WorkerPool(handled.append, workers=3, max_queued=100) as pool:
+            for i in range(50):
+                pool.submit(i)
+        self.assertEqual(list(range(50)), sorted(handled))
+        metrics = pool.metrics()
+        self.assertEqual(50, metrics['completed'])
+        self.assertEqual(0, metrics['queue_depth'])
+        self.assertEqual(0, metrics['busy'])
+
+    def test_overflow_is_rejected(self):
+        release = threading.Event()
+        pool = WorkerPool(lambda item: release.wait(5), workers=1, max_queued=2)
+        try:
+            pool.submit(0)
+            # wait for the worker to take the first item
+            deadline = time.monotonic() + 5
+            while pool.metrics()['busy'] == 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            pool.submit(1)
+            pool.submit(2)
+            with self.assertRaises(OnionOverloadError):
+                pool.submit(3)
+
+            metrics = pool.metrics()
+            self.assertEqual(1, metrics['rejected'])
+            self.assertEqual(2, metrics['queue_depth'])
+            self.assertEqual(1, metrics['busy'])
+            self.assertEqual(1.0, metrics['utilization'])
+        finally:
+            release.set()
+            pool.close(5)
+        metrics = pool.metrics()
+        self.assertEqual(3, metrics['completed'])
+        self.assertGreater(metrics['max_wait'], 0)
+
+    def test_items_waiting_too_long_expire(self):
+        release = threading.Event()
+        expired = []
+        pool = WorkerPool(lambda item: release.wait(5), workers=1, max_queued=2,
+                          max_wait=0.1, expired=expired.append)
+        try:
+            pool.submit(0)
+            pool.submit(1)
+            time.sleep(0.2)
+            pool.expire()
+            self.assertEqual([1], expired)
+            # the queue has room again
+            pool.submit(2)
+            pool.submit(3)
+            metrics = pool.metrics()
+            self.assertEqual(1, metrics['expired'])
+            self.assertEqual(2, metrics['queue_depth'])
+        finally:
+            release.set()
+            pool.close(5)
+        self.assertEqual(3, pool.metrics()['completed'])
+
+    def test_failures_do_not_stop_the_workers(self):
+        def handler(item):
+            if item % 2:
+                raise RuntimeError("odd item")
+        with WorkerPool(handler, workers=2) as pool:
+            for i in range(10):
+                pool.submit(i)
+        metrics = pool.metrics()
+        self.assertEqual(5, metrics['completed'])
+        self.assertEqual(5, metrics['failed'])
+
+    def test_closed_pool_rejects_items(self):
+        pool = WorkerPool(lambda item: None, workers=1)
+        pool.close(5)
+        with self.assertRaises(OnionOverloadError):
+            pool.submit(0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,36 +5,9 @@ import unittest
 import threading
 import time
 from workers import *
+import framing
 
 
-class SplitIntoObjectsTestCase(unittest.TestCase):
-    def test_split_into_objects_works(self):
-        strings = [
-            """{"name": "bob", "age": 21}""",
-            """
-            {
-                "name": "clarice",
-                "age": 14
-            }"""
-        ]
-        string = ''.join(strings)
-        results = split_into_objects_and_lengths(string)
-        for original_str in strings:
-            result = results.__next__()
-            result_object, length_used = result
-            self.assertEqual(json.loads(original_str), result_object)
-            self.assertEqual(len(original_str), length_used)
-
-    def test_split_into_objects_shows_correct_used_length(self):
-        useful_chars = "{'name': 'bob', 'age': 21}"
-        unused_chars = "123456789"
-        string = useful_chars + unused_chars
-
-        for result in split_into_objects(string):
-            obj, length = result
-            self.assertEqual(length, len(useful_chars))
-            self.assertEqual(obj, json.loads(useful_chars))
-
 HOST = socket.gethostname()
 PORT = 12345
 
@@ -65,6 +38,14 @@ class SocketReaderTestCase(unittest.TestCase):
         """
         self.assert_well_received(test_message)
 
+    def test_works_with_braces_inside_strings(self):
+        test_message = """
+        {
+            "value": "}{ not { a } brace }}"
+        }
+        """
+        self.assert_well_received(test_message)
+
     def test_works_with_long_messages(self):
         string = random_string(BUFFER_SIZE * 5)
         test_message = f"""
@@ -149,7 +130,7 @@ class TestMessageSender(threading.Thread):
 
     def run(self):
         self._socket.connect((socket.gethostname(), self.target_port))
-        self._socket.sendall(self.message_to_send.encode())
+        framing.send_frame(self._socket, self.message_to_send.encode())
 
     def close(self):
         self._socket.close()
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+"""
+Defines the WorkerPool, a fixed number of threads serving the connections
+accepted by a node (see OnionNode, connection_workers), instead of a new
+thread for every connection.
+"""
+from queue import Full
+from threading import Lock, Thread
+import time
+
+from errors import OnionOverloadError
+from queues import ClosableQueue
+
+DEFAULT_WORKERS = 16
+DEFAULT_MAX_QUEUED = 64
+DEFAULT_MAX_WAIT = 10  # seconds
+
+
+class WorkerPool():
+    """
+    Bounded thread pool: handler(item) is called in one of the worker
+    threads for every item submitted.
+    At most max_queued items can wait for a free worker; past that, new
+    items are rejected right away with an OnionOverloadError.
+    Items that wait more than max_wait seconds for a worker are given to
+    expired(item) instead (see expire), e.g. to close a connection that no
+    worker will free up for.
+
+    Params:
+        - handler: function called with each item, in a worker thread.
+        - workers: number of worker threads.
+        - max_queued: maximum number of items waiting for a worker.
+        - name: prefix of the names of the worker threads.
+        - max_wait: seconds an item can wait for a worker (None: no limit).
+        - expired: function called with each item that waited too long.
+    """
+
+    def __init__(self, handler, workers=DEFAULT_WORKERS, max_queued=DEFAULT_MAX_QUEUED,
+                 name="worker", max_wait=None, expired=None):
+        self.handler = handler
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.expired = expired
+
+        self._queue = ClosableQueue(max_queued)
+        self._lock = Lock()
+        self.closed = False
+
+        self._busy = 0
+        self._started = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._expired = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+        self._threads = [Thread(target=self._work, name="{}-{}".format(name, i), daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, item):
+        """
+        Queues an item for the next free worker.
+        Raises OnionOverloadError if the queue is full or the pool is closed.
+        """
+        with self._lock:
+            if not self.closed:
+                try:
+                    self._queue.put_nowait((item, time.perf_counter()))
+                    return
+                except Full:
+                    pass
+            self._rejected += 1
+        raise OnionOverloadError("ERROR    Too many queued connections")
+
+    def metrics(self):
+        """
+        returns a dict with the current queue depth, the number of busy
+        workers and the utilization of the pool (busy / workers), the number
+        of items completed, failed, rejected and expired, and the time items
+        waited in the queue (in seconds)
+        """
+        with self._lock:
+            queue_depth = self._queue.qsize()
+            if self.closed:
+                # the sentinel of the closed queue
+                queue_depth = max(0, queue_depth - 1)
+            return {
+                'queue_depth': queue_depth,
+                'max_queued': self.max_queued,
+                'workers': self.workers,
+                'busy': self._busy,
+                'utilization': self._busy / self.workers if self.workers else 0.0,
+                'completed': self._completed,
+                'failed': self._failed,
+                'rejected': self._rejected,
+                'expired': self._expired,
+                'mean_wait': self._total_wait / self._started if self._started else 0.0,
+                'max_wait': self._max_wait,
+            }
+
+    def expire(self):
+        """
+        takes the items that waited more than max_wait seconds out of the
+        queue, and gives them to expired; called regularly by the owner of the
+        pool (a worker checks the item it takes, too)
+        """
+        if self.max_wait is None:
+            return
+        oldest = time.perf_counter() - self.max_wait
+        for item, queued_at in self._queue.remove_if(lambda queued: queued[1] < oldest):
+            self._expire(item)
+
+    def _expire(self, item):
+        with self._lock:
+            self._expired += 1
+        if self.expired is not None:
+            try:
+                self.expired(item)
+            except Exception as e:
+                print("ERROR    Could not drop expired item:", e, "\n")
+
+    def close(self, timeout=None):
+        """
+        stops the workers once the queued items are handled; waits at most
+        timeout seconds for them
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._queue.close()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+    def _work(self):
+        for item, queued_at in self._queue:
+            wait = time.perf_counter() - queued_at
+            if self.max_wait is not None and wait > self.max_wait:
+                self._expire(item)
+                continue
+            with self._lock:
+                self._busy += 1
+                self._started += 1
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+            failed = False
+            try:
+                self.handler(item)
+            except Exception as e:
+                failed = True
+                print("ERROR    Worker failed:", e, "\n")
+            with self._lock:
+                self._busy -= 1
+                if failed:
+                    self._failed += 1
+                else:
+                    self._completed += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
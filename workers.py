@@ -3,6 +3,7 @@
 Defines Workers that will be used to carry out various tasks.
 """
 from contextlib import contextmanager
+import json
 from threading import Thread, Lock
 from typing import List
 import socket
@@ -10,6 +11,7 @@ from socket import SocketType
 
 from messaging import OnionMessage
 from queues import ClosableQueue
+import framing
 
 BUFFER_SIZE = 4096
 
@@ -18,6 +20,7 @@ class SocketReader(Thread):
     """
     Reads from a given socket, and whenever it receives a message, adds it
     in the given received_messages list.
+    Messages are JSON objects, each sent in one frame (see framing.py).
     """
     def __init__(self, _socket: SocketType, received_messages: List):
         super().__init__()
@@ -26,88 +29,23 @@ class SocketReader(Thread):
         self.closed = False
 
     def run(self):
-        received_so_far = ""
+        decoder = framing.FrameDecoder(buffer_size=BUFFER_SIZE)
 
         empty = False
 
         while not empty:
             try:
-                received_bytes = self.recv_socket.recv(BUFFER_SIZE)
+                received = decoder.recv_into(self.recv_socket)
             except ConnectionAbortedError as e:
                 break
             else:
-                empty = (received_bytes == b'')
+                empty = (received == 0)
                 if empty:
                     break
-                received_string = str(received_bytes, encoding="UTF-8")
-                received_so_far += received_string
 
-                received_objects = split_into_objects_and_lengths(received_so_far)
-
-                for obj, length in received_objects:
-                    self.received_messages.append(obj)
-                    # Remove the bytes we used.
-                    received_so_far = received_so_far[length:]
+                # decoded straight from the buffer of the decoder
+                for message in decoder.views():
+                    self.received_messages.append(json.loads(str(message, 'utf-8')))
 
         self.recv_socket.close()
         self.closed = True
-
-
-def split_into_objects_and_lengths(string):
-    """
-    splits the given string into a series of tuples:
-    (JSON object, length of string used to create that object).
-    """
-    import json
-    string_so_far = ""
-    open_bracket_count = 0
-    closed_bracket_count = 0
-    for char in string:
-        string_so_far += char
-        if char == '{':
-            open_bracket_count += 1
-        elif char == '}':
-            closed_bracket_count += 1
-        if open_bracket_count == closed_bracket_count:
-            try:
-                obj = json.loads(string_so_far)
-                # Return the object, since the parsing worked.
-                yield (obj, len(string_so_far))
-
-            except json.JSONDecodeError:
-                pass  # OK. that wasn't a valid json. Keep trying.
-
-            else:
-                # No exceptions ocurred. We reset the counter variables.
-                string_so_far = ""
-                open_bracket_count = 0
-                closed_bracket_count = 0
-
-
-def split_into_objects(string):
-    """
-    splits the given string into a series of JSON objects.
-    """
-    import json
-    string_so_far = ""
-    open_bracket_count = 0
-    closed_bracket_count = 0
-    for char in string:
-        string_so_far += char
-        if char == '{':
-            open_bracket_count += 1
-        elif char == '}':
-            closed_bracket_count += 1
-        if open_bracket_count == closed_bracket_count:
-            try:
-                obj = json.loads(string_so_far)
-                yield obj  # Return the object, since the parsing worked.
-
-            except json.JSONDecodeError:
-                pass  # OK. that wasn't a valid json. Keep trying.
-
-            else:
-                # No exceptions ocurred. We reset the counter variables.
-                string_so_far = ""
-                open_bracket_count = 0
-                closed_bracket_count = 0